@@ -0,0 +1,148 @@
+# bench_chunker.py: So sánh chunker mới (tokenize theo lô, nhớ số token) với cài đặt gốc
+#
+# Cài đặt gốc gọi tokenizer.tokenize() cho từng câu và tokenize lại các câu khi dựng phần gối đầu.
+# Benchmark chạy cả hai trên cùng một văn bản đã làm sạch, báo thời gian và tốc độ,
+# và thoát với mã lỗi 1 nếu danh sách chunk khác nhau dù chỉ một ký tự.
+# Cũng chạy pipeline.chunk_stream (văn bản đến theo từng trang) với ngưỡng PIPELINE_MAX_SECTION_CHARS nhỏ
+# (--stream-section-chars) để section dài bị chunk dần theo câu, và đối chiếu với kết quả chunk cả văn bản.
+#
+# Chạy từ thư mục gốc repo:
+#   python -m backend.benchmarks.bench_chunker --text results/<pdf>/<pdf>_clean.txt --repeat 20
+#   python -m backend.benchmarks.bench_chunker --workers 4          # văn bản tổng hợp, tách câu song song
+
+import argparse
+import random
+import sys
+import time
+
+from transformers import AutoTokenizer
+from underthesea import sent_tokenize
+
+from backend.core import embeding, model_registry
+
+_WORDS = (
+    "an toàn thông tin mạng hệ thống cơ quan tổ chức cá nhân trách nhiệm bảo vệ dữ liệu "
+    "sự cố ứng cứu giám sát phát hiện tấn công mã độc phần mềm máy chủ quy định điều khoản "
+    "theo quy định của pháp luật được thực hiện nhằm bảo đảm kiểm tra đánh giá rủi ro"
+).split()
+
+
+def reference_split(tokenizer, text, chunk_size=512, overlap=50):
+    """Cài đặt gốc của split_text_to_chunks_vi_tokenized_with_section (giữ nguyên để đối chiếu)."""
+    sections = embeding.split_sections(text)
+    all_chunks = []
+    for section in sections:
+        sentences = sent_tokenize(section)
+        current_chunk = []
+        current_tokens = 0
+        for sentence in sentences:
+            num_tokens = len(tokenizer.tokenize(sentence))
+            if current_tokens + num_tokens > chunk_size:
+                chunk_text = '\n'.join(current_chunk).strip()
+                all_chunks.append(chunk_text)
+                overlap_chunk = []
+                total = 0
+                for s in reversed(current_chunk):
+                    toks = len(tokenizer.tokenize(s))
+                    if total + toks > overlap:
+                        break
+                    overlap_chunk.insert(0, s)
+                    total += toks
+                current_chunk = overlap_chunk + [sentence]
+                current_tokens = total + num_tokens
+            else:
+                current_chunk.append(sentence)
+                current_tokens += num_tokens
+        if current_chunk:
+            all_chunks.append(' '.join(current_chunk).strip())
+    return all_chunks
+
+
+def synthetic_text(num_sections, seed):
+    """Văn bản giống văn bản luật đã làm sạch: mục I./1./a) với các câu dài ngắn khác nhau."""
+    rng = random.Random(seed)
+    parts = []
+    for i in range(num_sections):
+        header = rng.choice([f"{i + 1}.", f"{'IVX'[i % 3]}.", f"{'abcd'[i % 4]})"])
+        sentences = [
+            " ".join(rng.choice(_WORDS) for _ in range(rng.randint(4, 60))).capitalize() + "."
+            for _ in range(rng.randint(1, 40))
+        ]
+        parts.append(header + " " + " ".join(sentences))
+    return "\n".join(parts)
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--text", help="File văn bản đã làm sạch (mặc định: văn bản tổng hợp)")
+    parser.add_argument("--repeat", type=int, default=1, help="Nhân văn bản lên N lần để có input lớn")
+    parser.add_argument("--sections", type=int, default=2000, help="Số section của văn bản tổng hợp")
+    parser.add_argument("--tokenizer", default=embeding.EMBEDDING_MODEL_PATH)
+    parser.add_argument("--chunk-size", type=int, default=512)
+    parser.add_argument("--overlap", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=1, help="Số process tách câu của chunker mới")
+    parser.add_argument("--stream-section-chars", type=int, default=2000,
+                        help="PIPELINE_MAX_SECTION_CHARS khi kiểm tra chunk_stream (0 = bỏ qua)")
+    parser.add_argument("--page-chars", type=int, default=3000, help="Số ký tự mỗi đoạn đưa vào chunk_stream")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.text:
+        with open(args.text, "r", encoding="utf-8") as f:
+            text = f.read()
+    else:
+        text = synthetic_text(args.sections, args.seed)
+    text = "\n".join([text] * args.repeat)
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    model_registry.set_model("embedding_tokenizer", tokenizer)
+    embeding.CHUNKER_PARALLEL_MIN_CHARS = 0
+    print(f"Văn bản: {len(text):,} ký tự, tokenizer {type(tokenizer).__name__} (fast={tokenizer.is_fast})")
+
+    ref_chunks, ref_time = timed(reference_split, tokenizer, text, args.chunk_size, args.overlap)
+    new_chunks, new_time = timed(
+        embeding.split_text_to_chunks_vi_tokenized_with_section,
+        text, args.chunk_size, args.overlap, workers=args.workers,
+    )
+    # Chạy lại lần hai để không tính thời gian khởi động process pool
+    if args.workers > 1:
+        new_chunks, new_time = timed(
+            embeding.split_text_to_chunks_vi_tokenized_with_section,
+            text, args.chunk_size, args.overlap, workers=args.workers,
+        )
+
+    print(f"gốc: {len(ref_chunks)} chunk trong {ref_time:.2f}s ({len(text) / ref_time / 1e6:.2f} triệu ký tự/s)")
+    print(f"mới: {len(new_chunks)} chunk trong {new_time:.2f}s ({len(text) / new_time / 1e6:.2f} triệu ký tự/s)")
+    print(f"tăng tốc: {ref_time / new_time:.2f}x")
+    if new_chunks != ref_chunks:
+        first = next((i for i, (a, b) in enumerate(zip(ref_chunks, new_chunks)) if a != b), min(len(ref_chunks), len(new_chunks)))
+        print(f"❌ Kết quả khác cài đặt gốc từ chunk {first}")
+        sys.exit(1)
+    print("✅ Kết quả giống hệt cài đặt gốc")
+
+    if args.stream_section_chars:
+        from backend.core import pipeline
+
+        pipeline.PIPELINE_MAX_SECTION_CHARS = args.stream_section_chars
+        long_sections = sum(len(s) > args.stream_section_chars for s in embeding.split_sections(text))
+        pages = [text[i:i + args.page_chars] for i in range(0, len(text), args.page_chars)]
+        stream_chunks, stream_time = timed(
+            lambda: [chunk for chunk, _ in pipeline.chunk_stream(pages, args.chunk_size, args.overlap)])
+        print(f"chunk_stream: {len(stream_chunks)} chunk trong {stream_time:.2f}s, "
+              f"{long_sections} section dài hơn {args.stream_section_chars} ký tự được chunk dần")
+        if stream_chunks != new_chunks:
+            first = next((i for i, (a, b) in enumerate(zip(new_chunks, stream_chunks)) if a != b),
+                         min(len(new_chunks), len(stream_chunks)))
+            print(f"❌ chunk_stream khác kết quả chunk cả văn bản từ chunk {first}")
+            sys.exit(1)
+        print("✅ chunk_stream giống hệt kết quả chunk cả văn bản")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+# bench_context_packing.py: Số token prefill của prompt khi nối nguyên các chunk so với xếp ngữ cảnh (context_packer)
+#
+# Chunk một văn bản (mặc định: văn bản tổng hợp của bench_chunker) với overlap như lúc ingest, ghi vào một kho
+# chunk tạm kèm số token tính lúc ingest, rồi mô phỏng các truy vấn top_k (một phần chunk truy xuất được là
+# chunk liền kề nhau, như khi các chunk gối đầu cùng khớp câu hỏi). Mỗi truy vấn dựng prompt hai cách:
+#   - cách cũ: tokenize từng chunk lúc truy vấn, cắt 512 token, nối nguyên
+#   - context_packer.pack_context: số liệu lúc ingest, bỏ phần gối đầu, trong ngân sách của cửa sổ ngữ cảnh
+# In số token prompt (tokenize thật), thời gian dựng ngữ cảnh, và kiểm tra mọi câu của các chunk truy xuất được
+# vẫn có trong ngữ cảnh mới; thoát mã 1 nếu tỉ lệ câu giữ lại dưới --min-coverage.
+#
+# Chạy từ thư mục gốc repo:
+#   python -m backend.benchmarks.bench_context_packing --tokenizer <LLM_MODEL_PATH> --queries 200
+#   python -m backend.benchmarks.bench_context_packing --text results/<pdf>/<pdf>_clean.txt --adjacent 0.5
+
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+import numpy as np
+from transformers import AutoTokenizer
+
+from backend.core import embeding, model_registry
+from backend.core.chunk_store import ChunkStore
+from backend.core.context_packer import pack_context
+from backend.core.rag import build_prompt
+from backend.benchmarks.bench_chunker import synthetic_text
+
+_SENTENCE = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+def old_context(tokenizer, view, chunk_ids, max_tokens_per_chunk=512):
+    """Cách dựng ngữ cảnh trước đây (rag.chunk_texts cũ): tokenize lúc truy vấn, cắt, nối nguyên."""
+    context_chunks = []
+    for chunk_id in chunk_ids:
+        chunk = view.text_by_id(chunk_id)
+        tokens = tokenizer.tokenize(chunk)
+        if len(tokens) > max_tokens_per_chunk:
+            chunk = tokenizer.convert_tokens_to_string(tokens[:max_tokens_per_chunk])
+        context_chunks.append(chunk.strip())
+    return context_chunks
+
+
+def make_queries(num_chunks, count, top_k, adjacent, seed):
+    """Danh sách chunk ID theo thứ tự liên quan; tỉ lệ adjacent các chunk sau chunk đầu nằm sát chunk trước đó."""
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(count):
+        ids = [rng.randrange(num_chunks)]
+        while len(ids) < min(top_k, num_chunks):
+            if rng.random() < adjacent:
+                candidate = rng.choice(ids) + rng.choice((-1, 1))
+            else:
+                candidate = rng.randrange(num_chunks)
+            if 0 <= candidate < num_chunks and candidate not in ids:
+                ids.append(candidate)
+        queries.append(ids)
+    return queries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--text", help="File văn bản đã làm sạch (mặc định: văn bản tổng hợp)")
+    parser.add_argument("--sections", type=int, default=200, help="Số section của văn bản tổng hợp")
+    parser.add_argument("--tokenizer", default=os.getenv("LLM_MODEL_PATH"), help="Tokenizer của LLM")
+    parser.add_argument("--embedding-tokenizer", default=embeding.EMBEDDING_MODEL_PATH, help="Tokenizer của chunker")
+    parser.add_argument("--chunk-size", type=int, default=512)
+    parser.add_argument("--overlap", type=int, default=50)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--adjacent", type=float, default=0.5, help="Tỉ lệ chunk truy xuất nằm sát một chunk khác")
+    parser.add_argument("--context-window", type=int, default=4096)
+    parser.add_argument("--max-new-tokens", type=int, default=512)
+    parser.add_argument("--min-coverage", type=float, default=1.0, help="Tỉ lệ câu của các chunk tối thiểu phải giữ lại")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.text:
+        with open(args.text, "r", encoding="utf-8") as f:
+            text = f.read()
+    else:
+        text = synthetic_text(args.sections, args.seed)
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    model_registry.set_model("embedding_tokenizer", AutoTokenizer.from_pretrained(args.embedding_tokenizer))
+    model_registry.set_model("llm_tokenizer", tokenizer)
+
+    chunks = embeding.split_text_to_chunks_vi_tokenized_with_section(text, args.chunk_size, args.overlap)
+    started = time.perf_counter()
+    token_stats = embeding.chunk_token_stats(chunks)
+    ingest_seconds = time.perf_counter() - started
+    with_overlap = sum(1 for _, chars, _ in token_stats if chars)
+    print(f"📝 {len(chunks)} chunk, {with_overlap} chunk có phần gối đầu; số liệu token lúc ingest: {ingest_seconds:.2f}s")
+
+    with tempfile.TemporaryDirectory() as root:
+        store = ChunkStore(root)
+        store.append("bench", chunks, np.zeros((len(chunks), 8), dtype=np.float32), token_stats=token_stats)
+        view = store.view()
+        frame = len(tokenizer(build_prompt(["{context}"], "{question}").replace("{context}", "")).input_ids)
+        budget = args.context_window - frame - args.max_new_tokens
+
+        old_tokens, new_tokens, estimates = [], [], []
+        old_seconds = new_seconds = 0.0
+        kept = total = dropped = 0
+        for chunk_ids in make_queries(len(chunks), args.queries, args.top_k, args.adjacent, args.seed):
+            t0 = time.perf_counter()
+            old = old_context(tokenizer, view, chunk_ids)
+            old_seconds += time.perf_counter() - t0
+            t0 = time.perf_counter()
+            packed = pack_context(view, chunk_ids, budget)
+            new_seconds += time.perf_counter() - t0
+            dropped += packed.dropped
+
+            old_tokens.append(len(tokenizer(build_prompt(old, "{question}")).input_ids))
+            new_tokens.append(len(tokenizer(build_prompt(packed.chunks, "{question}")).input_ids))
+            estimates.append((packed.tokens, len(tokenizer("\n---\n".join(packed.chunks)).input_ids)))
+            packed_text = "\n".join(packed.chunks)
+            # Đối chiếu với nguyên văn các chunk (ngữ cảnh cũ bị cắt theo token có thể lệch ký tự khi giải mã)
+            for sentence in _SENTENCE.split("\n".join(view.text_by_id(i) for i in chunk_ids)):
+                if sentence.strip():
+                    total += 1
+                    kept += sentence.strip() in packed_text
+
+    old_tokens, new_tokens = np.array(old_tokens), np.array(new_tokens)
+    error = np.mean([abs(est - real) / max(real, 1) for est, real in estimates])
+    print(f"{'nối nguyên':>12}: prompt trung bình {old_tokens.mean():7.1f} token (p95 {np.percentile(old_tokens, 95):.0f}), "
+          f"dựng ngữ cảnh {old_seconds / args.queries * 1000:.2f} ms/truy vấn")
+    print(f"{'xếp ngữ cảnh':>12}: prompt trung bình {new_tokens.mean():7.1f} token (p95 {np.percentile(new_tokens, 95):.0f}), "
+          f"dựng ngữ cảnh {new_seconds / args.queries * 1000:.2f} ms/truy vấn, ngân sách {budget} token")
+    print(f"⚡ Token prefill giảm {1 - new_tokens.sum() / old_tokens.sum():.1%}; "
+          f"sai số ước lượng token ngữ cảnh {error:.1%}; {dropped} chunk không vừa ngân sách")
+    coverage = kept / max(total, 1)
+    print(f"🔎 Câu của các chunk truy xuất được còn trong ngữ cảnh mới: {coverage:.1%}")
+    if coverage < args.min_coverage:
+        print(f"❌ Tỉ lệ câu giữ lại {coverage:.1%} < {args.min_coverage:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
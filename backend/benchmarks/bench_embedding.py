@@ -0,0 +1,73 @@
+# bench_embedding.py: Đo chunks/s của engine embed gom lô theo độ dài token với nhiều ngân sách token
+#
+# So với model.encode(batch_size=32) mặc định, cho từng EMBED_TOKEN_BUDGET:
+#   - số lô, tỉ lệ padding, chunks/s
+#   - độ lệch cosine nhỏ nhất so với model.encode (phải ~1.0: chỉ khác thứ tự tính)
+# Dùng kết quả để chọn EMBED_TOKEN_BUDGET / EMBED_THREADS cho từng máy.
+#
+# Chạy từ thư mục gốc repo:
+#   python -m backend.benchmarks.bench_embedding --model <EMBEDDING_MODEL_PATH> --num-chunks 512 --budgets 4096,8192,16384,32768
+#   python -m backend.benchmarks.bench_embedding --backend onnx      # engine trên backend ONNX Runtime
+
+import argparse
+import os
+import random
+import time
+
+import numpy as np
+import torch
+
+from backend.core import embed_engine
+from backend.core.embedding_backend import load_embedding_backend
+from backend.benchmarks.bench_chunker import _WORDS
+
+
+def make_chunks(num_chunks, seed):
+    """Chunk có độ dài lệch như thực tế: đa số ngắn, một phần dài gần 512 token."""
+    rng = random.Random(seed)
+    chunks = []
+    for _ in range(num_chunks):
+        words = int(min(380, rng.expovariate(1 / 90) + 3))
+        chunks.append(" ".join(rng.choice(_WORDS) for _ in range(words)))
+    return chunks
+
+
+def min_cosine(a, b):
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return float(np.min(np.sum(a * b, axis=1)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default=os.getenv("EMBEDDING_MODEL_PATH"))
+    parser.add_argument("--num-chunks", type=int, default=512)
+    parser.add_argument("--budgets", default="4096,8192,16384,32768")
+    parser.add_argument("--backend", default="torch", help="Backend chạy engine: torch | onnx (tham chiếu luôn là torch)")
+    parser.add_argument("--max-batch", type=int, default=embed_engine.EMBED_MAX_BATCH)
+    parser.add_argument("--threads", type=int, default=embed_engine.EMBED_THREADS)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    model = load_embedding_backend(args.model, "torch", device="cpu")
+    backend = model if args.backend == "torch" else load_embedding_backend(args.model, args.backend)
+    embed_engine.configure_threads(args.threads)
+    chunks = make_chunks(args.num_chunks, args.seed)
+    print(f"{len(chunks)} chunk, {torch.get_num_threads()} thread torch")
+
+    start = time.perf_counter()
+    reference = model.encode(chunks, batch_size=32)
+    seconds = time.perf_counter() - start
+    print(f"model.encode(batch_size=32): {len(chunks) / seconds:8.2f} chunk/s")
+
+    for budget in [int(b) for b in args.budgets.split(",")]:
+        stats = {}
+        vectors = embed_engine.encode_chunks(backend, chunks, token_budget=budget, max_batch=args.max_batch, stats=stats)
+        print(
+            f"budget {budget:>6}: {stats['chunks_per_second']:8.2f} chunk/s, {stats['batches']:>4} lô, "
+            f"padding {stats['padding_ratio']:.1%}, cosine nhỏ nhất {min_cosine(reference, vectors):.6f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# bench_embedding_backends.py: So sánh backend embedding torch / onnx / onnx-int8
+#
+# Cho từng backend:
+#   - độ khớp: cosine nhỏ nhất / trung bình với vector của PyTorch trên cùng tập chunk và câu hỏi
+#   - độ trễ một câu hỏi (p50/p95, như encode_query khi chat) và thông lượng encode theo lô
+# Thoát với mã lỗi 1 nếu cosine nhỏ nhất thấp hơn ngưỡng (--min-cosine cho float32, --min-cosine-int8 cho int8).
+#
+# Chạy từ thư mục gốc repo:
+#   python -m backend.benchmarks.bench_embedding_backends --model <EMBEDDING_MODEL_PATH> --backends torch,onnx,onnx-int8
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+from backend.core.embedding_backend import load_embedding_backend
+from backend.benchmarks.bench_embedding import make_chunks
+from backend.benchmarks.bench_chunker import _WORDS
+
+
+def cosines(a, b):
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return np.sum(a * b, axis=1)
+
+
+def make_queries(num_queries, seed):
+    rng = np.random.default_rng(seed)
+    return [
+        "query: " + " ".join(rng.choice(_WORDS, size=int(rng.integers(4, 20)))) + "?"
+        for _ in range(num_queries)
+    ]
+
+
+def load(model_path, name):
+    if name == "torch":
+        return load_embedding_backend(model_path, "torch", device="cpu")
+    if name == "onnx":
+        return load_embedding_backend(model_path, "onnx", quantize="")
+    if name == "onnx-int8":
+        return load_embedding_backend(model_path, "onnx", quantize="int8")
+    raise ValueError(f"Backend không hợp lệ: {name}")
+
+
+def single_query_latency(backend, queries):
+    backend.encode(queries[:2])  # khởi động
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        backend.encode([query])
+        timings.append((time.perf_counter() - start) * 1000)
+    return np.percentile(timings, 50), np.percentile(timings, 95)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default=os.getenv("EMBEDDING_MODEL_PATH"))
+    parser.add_argument("--backends", default="torch,onnx,onnx-int8")
+    parser.add_argument("--num-chunks", type=int, default=256)
+    parser.add_argument("--num-queries", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--min-cosine", type=float, default=0.9999)
+    parser.add_argument("--min-cosine-int8", type=float, default=0.98)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    chunks = ["passage: " + c for c in make_chunks(args.num_chunks, args.seed)]
+    queries = make_queries(args.num_queries, args.seed)
+    reference = load(args.model, "torch")
+    ref_chunks = reference.encode(chunks, batch_size=args.batch_size)
+    ref_queries = reference.encode(queries, batch_size=args.batch_size)
+    print(f"{len(chunks)} chunk, {len(queries)} câu hỏi, lô {args.batch_size}")
+
+    failed = False
+    for name in args.backends.split(","):
+        backend = reference if name == "torch" else load(args.model, name)
+        p50, p95 = single_query_latency(backend, queries)
+        start = time.perf_counter()
+        vectors = backend.encode(chunks, batch_size=args.batch_size)
+        throughput = len(chunks) / (time.perf_counter() - start)
+        sims = np.concatenate([cosines(ref_chunks, vectors), cosines(ref_queries, backend.encode(queries))])
+        threshold = args.min_cosine_int8 if name.endswith("int8") else args.min_cosine
+        ok = sims.min() >= threshold
+        failed |= not ok
+        print(
+            f"{name:>10}: câu hỏi p50 {p50:7.2f} ms, p95 {p95:7.2f} ms | lô {throughput:8.2f} chunk/s | "
+            f"cosine nhỏ nhất {sims.min():.6f}, trung bình {sims.mean():.6f} {'✅' if ok else '❌'} (ngưỡng {threshold})"
+        )
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# bench_generation.py: Thông lượng sinh token của bộ lập lịch gom lô liên tục so với model.generate() từng request
+#
+# Mô phỏng N người dùng đồng thời (mỗi người một thread gửi liên tiếp --requests-per-user prompt):
+#   - baseline: mỗi request gọi model.generate() riêng, dùng chung một khóa (như phục vụ tuần tự)
+#   - scheduler: mọi request đi qua GenerationScheduler
+# In tokens/s, độ trễ p50/p95 mỗi request và kích thước lô trung bình cho từng mức đồng thời.
+# Trước đó kiểm tra lấy mẫu: với cùng seed và cùng tham số sinh của rag (GENERATION_KWARGS), bộ lập lịch phải cho
+# đúng các token như model.generate() (thoát mã 1 nếu khác).
+#
+# Chạy từ thư mục gốc repo:
+#   python -m backend.benchmarks.bench_generation --model <LLM_MODEL_PATH> --users 1,8,16 --max-new-tokens 64
+#   python -m backend.benchmarks.bench_generation --load-4bit        # LLM 4-bit như khi phục vụ (cần GPU)
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+import numpy as np
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from backend.core.generation import GenerationScheduler
+from backend.core.rag import SAMPLING_KWARGS
+from backend.benchmarks.bench_chunker import _WORDS
+
+
+def make_prompts(count, seed):
+    rng = random.Random(seed)
+    return [
+        "<|im_start|>user\n" + " ".join(rng.choice(_WORDS) for _ in range(rng.randint(20, 200))) + "<|im_end|>\n<|im_start|>assistant\n"
+        for _ in range(count)
+    ]
+
+
+def run_users(users, prompts, handle):
+    """Chạy users thread, mỗi thread xử lý một phần prompts bằng handle(prompt) -> số token; trả (tokens, giây, độ trễ)."""
+    latencies = []
+    tokens = [0]
+    lock = threading.Lock()
+
+    def user(items):
+        for prompt in items:
+            start = time.perf_counter()
+            n = handle(prompt)
+            with lock:
+                latencies.append(time.perf_counter() - start)
+                tokens[0] += n
+
+    threads = [threading.Thread(target=user, args=(prompts[i::users],)) for i in range(users)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return tokens[0], time.perf_counter() - start, latencies
+
+
+def check_sampling(model, tokenizer, prompts, max_new_tokens, seed):
+    """Số prompt mà bộ lập lịch (từng request một, cùng seed) sinh đúng các token như model.generate()."""
+    scheduler = GenerationScheduler(model, tokenizer, max_batch=1)
+    matched = 0
+    for prompt in prompts:
+        input_ids = tokenizer(prompt).input_ids
+        torch.manual_seed(seed)
+        with torch.inference_mode():
+            out = model.generate(torch.tensor([input_ids], device=model.device), max_new_tokens=max_new_tokens,
+                                 pad_token_id=scheduler.pad_id, **SAMPLING_KWARGS)
+        expected = []
+        for token_id in out[0, len(input_ids):].tolist():
+            if token_id in scheduler.eos_ids:
+                break
+            expected.append(token_id)
+        torch.manual_seed(seed)
+        matched += scheduler.submit(input_ids, max_new_tokens=max_new_tokens, **SAMPLING_KWARGS).result() == expected
+    scheduler.close()
+    return matched
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default=os.getenv("LLM_MODEL_PATH"))
+    parser.add_argument("--load-4bit", action="store_true", help="Nạp LLM qua model_registry (4-bit, GPU)")
+    parser.add_argument("--users", default="1,8,16")
+    parser.add_argument("--requests-per-user", type=int, default=2)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--max-batch", type=int, default=16)
+    parser.add_argument("--skip-baseline", action="store_true")
+    parser.add_argument("--check-prompts", type=int, default=8, help="Số prompt kiểm tra lấy mẫu so với generate()")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.load_4bit:
+        from backend.core import model_registry
+
+        model_registry.LLM_MODEL_PATH = args.model
+        model, tokenizer = model_registry.get_llm(), model_registry.get_llm_tokenizer()
+    else:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        dtype = torch.float16 if device == "cuda" else torch.float32
+        tokenizer = AutoTokenizer.from_pretrained(args.model)
+        tokenizer.pad_token = tokenizer.eos_token
+        model = AutoModelForCausalLM.from_pretrained(args.model, torch_dtype=dtype).to(device).eval()
+    if args.check_prompts:
+        matched = check_sampling(model, tokenizer, make_prompts(args.check_prompts, args.seed), args.max_new_tokens,
+                                 args.seed)
+        print(f"🔎 Lấy mẫu {SAMPLING_KWARGS}: {matched}/{args.check_prompts} prompt giống model.generate()")
+        if matched < args.check_prompts:
+            sys.exit(1)
+    # Greedy + sinh đủ max_new_tokens để hai cách so sánh trên cùng số token
+    scheduler = GenerationScheduler(model, tokenizer, max_batch=args.max_batch)
+    scheduler.eos_ids = set()
+
+    def baseline(prompt, lock=threading.Lock()):
+        encoding = tokenizer(prompt, return_tensors="pt").to(model.device)
+        with lock, torch.inference_mode():
+            out = model.generate(**encoding, max_new_tokens=args.max_new_tokens, min_new_tokens=args.max_new_tokens,
+                                 do_sample=False, pad_token_id=tokenizer.eos_token_id)
+        return out.shape[1] - encoding.input_ids.shape[1]
+
+    def scheduled(prompt):
+        return len(scheduler.submit(tokenizer(prompt).input_ids, max_new_tokens=args.max_new_tokens).result())
+
+    for users in [int(u) for u in args.users.split(",")]:
+        prompts = make_prompts(users * args.requests_per_user, args.seed)
+        modes = [("scheduler", scheduled)] if args.skip_baseline else [("generate", baseline), ("scheduler", scheduled)]
+        for name, handle in modes:
+            before = scheduler.stats()
+            tokens, seconds, latencies = run_users(users, prompts, handle)
+            after = scheduler.stats()
+            steps = after["decode_steps"] - before["decode_steps"]
+            batch = ""
+            if name == "scheduler" and steps:
+                rows = after["mean_batch_size"] * after["decode_steps"] - (before["mean_batch_size"] or 0) * before["decode_steps"]
+                batch = f", lô trung bình {rows / steps:.1f}"
+            print(
+                f"{users:>3} người dùng | {name:>9}: {tokens / seconds:8.1f} token/s, "
+                f"p50 {np.percentile(latencies, 50):6.2f}s, p95 {np.percentile(latencies, 95):6.2f}s{batch}"
+            )
+    # Dừng thread lập lịch trước khi thoát (thread daemon còn giữ torch lúc tắt interpreter có thể làm process abort)
+    scheduler.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# bench_index_modes.py: So sánh các chế độ FAISS index (flat / hnsw / ivfpq) trên kho tổng hợp
+#
+# Báo cáo recall@k so với flat (chính xác) và độ trễ tìm kiếm p50/p99 cho một truy vấn,
+# với nhiều giá trị nprobe/efSearch, để chọn FAISS_INDEX_MODE cho từng máy chủ.
+#
+# Chạy từ thư mục gốc repo:
+#   python -m backend.benchmarks.bench_index_modes --num-vectors 100000 --dim 1024
+
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from backend.core.chunk_store import ChunkStore
+from backend.core import vector_index
+
+
+def make_corpus(num_vectors, dim, num_clusters, seed):
+    """Sinh vector có cấu trúc cụm (gần với embedding thật hơn phân phối đều), đã chuẩn hóa L2."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((num_clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, num_clusters, size=num_vectors)
+    vectors = centers[labels] + 0.6 * rng.standard_normal((num_vectors, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def make_queries(corpus, num_queries, seed):
+    rng = np.random.default_rng(seed + 1)
+    picks = corpus[rng.integers(0, len(corpus), size=num_queries)]
+    queries = picks + 0.3 * rng.standard_normal(picks.shape).astype(np.float32) / np.sqrt(corpus.shape[1])
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return np.ascontiguousarray(queries, dtype=np.float32)
+
+
+def build_store(root, corpus, doc_size):
+    store = ChunkStore(root)
+    for start in range(0, len(corpus), doc_size):
+        part = corpus[start:start + doc_size]
+        store.append(f"doc_{start // doc_size:05d}", [""] * len(part), part)
+    return store.view()
+
+
+def measure(index, queries, k, truth):
+    latencies = []
+    hits = 0
+    for i, query in enumerate(queries):
+        t0 = time.perf_counter()
+        _, ids = index.search(query.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - t0) * 1000)
+        hits += len(set(ids[0].tolist()) & set(truth[i].tolist()))
+    return hits / (len(queries) * k), np.percentile(latencies, 50), np.percentile(latencies, 99)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-vectors", type=int, default=50000)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--num-queries", type=int, default=200)
+    parser.add_argument("--num-clusters", type=int, default=256)
+    parser.add_argument("--doc-size", type=int, default=500, help="số chunk mỗi tài liệu giả lập")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--modes", default="flat,hnsw,ivfpq")
+    parser.add_argument("--nprobe", default="1,4,16,64")
+    parser.add_argument("--ef-search", default="16,32,64,128")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.num_vectors, args.dim, args.num_clusters, args.seed)
+    queries = make_queries(corpus, args.num_queries, args.seed)
+
+    with tempfile.TemporaryDirectory() as root:
+        view = build_store(root, corpus, args.doc_size)
+        flat = vector_index.build_from_view(view, "flat")
+        _, truth = flat.search(queries, args.k)
+
+        print(f"Kho tổng hợp: {args.num_vectors} vector x {args.dim} chiều, {args.num_queries} truy vấn, k={args.k}")
+        print(f"{'mode':<8}{'tham số':<16}{'build (s)':>10}{f'recall@{args.k}':>12}{'p50 (ms)':>10}{'p99 (ms)':>10}")
+        for mode in args.modes.split(","):
+            t0 = time.perf_counter()
+            index = vector_index.build_from_view(view, mode)
+            build_s = time.perf_counter() - t0
+            actual = vector_index.index_mode(index)
+            if actual == "hnsw":
+                settings = [("efSearch", int(v)) for v in args.ef_search.split(",")]
+            elif actual == "ivfpq":
+                settings = [("nprobe", int(v)) for v in args.nprobe.split(",")]
+            else:
+                settings = [("-", None)]
+            for name, value in settings:
+                vector_index.configure_search(index, nprobe=value, ef_search=value)
+                recall, p50, p99 = measure(index, queries, args.k, truth)
+                label = f"{name}={value}" if value else "-"
+                print(f"{actual:<8}{label:<16}{build_s:>10.2f}{recall:>12.3f}{p50:>10.3f}{p99:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# bench_ocr_render.py: So sánh đường render trang cho OCR cũ và mới
+#
+#   - cũ: RGB 2.5x -> PNG encode -> PIL decode -> chuyển xám
+#   - mới: render thẳng ảnh xám, dựng ảnh PIL từ buffer pixmap, độ phóng chọn theo trang
+# Báo cáo thời gian render và (nếu có tesseract, không dùng --skip-ocr) thời gian OCR mỗi trang.
+#
+# Chạy từ thư mục gốc repo:
+#   python -m backend.benchmarks.bench_ocr_render backend/data/initial_docs/Luat/Luat-29-2018-QH14.pdf --pages 5
+
+import argparse
+import statistics
+import time
+
+import fitz
+import pytesseract
+
+from backend.core import ocr
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def run_ocr(img, skip_ocr):
+    if skip_ocr:
+        return "", 0.0
+    # Cùng lời gọi như core/ocr.py (ngôn ngữ nằm trong OCR_CONFIG: -l vie+eng)
+    return timed(pytesseract.image_to_string, img, config=ocr.OCR_CONFIG)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("pdf")
+    parser.add_argument("--pages", type=int, default=5, help="Số trang đầu đem đo")
+    parser.add_argument("--skip-ocr", action="store_true", help="Chỉ đo bước render")
+    args = parser.parse_args()
+
+    rows = []
+    with fitz.open(args.pdf) as doc:
+        for page_num in range(min(args.pages, len(doc))):
+            page = doc.load_page(page_num)
+            legacy_img, legacy_render = timed(ocr.render_page_legacy, page)
+            legacy_text, legacy_ocr = run_ocr(legacy_img, args.skip_ocr)
+            zoom, zoom_ms = timed(ocr.choose_zoom, page)
+            new_img, new_render = timed(ocr.render_page_gray, page, zoom)
+            new_text, new_ocr = run_ocr(new_img, args.skip_ocr)
+            rows.append((legacy_render, legacy_ocr, new_render + zoom_ms, new_ocr))
+            print(
+                f"trang {page_num + 1:>3}: cũ {legacy_img.size[0]}x{legacy_img.size[1]} "
+                f"render {legacy_render:7.1f}ms ocr {legacy_ocr:8.1f}ms ({len(legacy_text)} ký tự) | "
+                f"mới zoom {zoom:.2f} {new_img.size[0]}x{new_img.size[1]} "
+                f"render {new_render + zoom_ms:7.1f}ms ocr {new_ocr:8.1f}ms ({len(new_text)} ký tự)"
+            )
+
+    if not rows:
+        print("PDF không có trang nào")
+        return
+    cols = list(zip(*rows))
+    print(
+        f"\nTrung vị mỗi trang: cũ render {statistics.median(cols[0]):.1f}ms / ocr {statistics.median(cols[1]):.1f}ms, "
+        f"mới render {statistics.median(cols[2]):.1f}ms / ocr {statistics.median(cols[3]):.1f}ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# bench_prefix_cache.py: Thời gian tới token đầu (TTFT) khi prefill có / không dùng KV cache của khối system prompt
+#
+# Dựng prompt thật bằng rag.build_prompt (ngữ cảnh ngẫu nhiên, cả hai template), gửi lần lượt từng prompt
+# qua GenerationScheduler hai lượt: tắt prefix cache (prefix_cache_size=0) rồi bật (prefix_length = khối
+# system cố định). In TTFT p50/p95 của mỗi bên và kiểm tra token sinh ra (greedy) trùng nhau;
+# thoát mã 1 nếu tỉ lệ trùng dưới --min-match.
+#
+# Chạy từ thư mục gốc repo (nên dùng model nhỏ, vd. một checkpoint vài chục triệu tham số):
+#   python -m backend.benchmarks.bench_prefix_cache --model <LLM_MODEL_PATH> --prompts 30
+#   python -m backend.benchmarks.bench_prefix_cache --context-words 50,400
+
+import argparse
+import os
+import random
+import sys
+
+import numpy as np
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from backend.core.generation import GenerationScheduler
+from backend.core.rag import build_prompt, system_prompt_prefixes
+from backend.benchmarks.bench_chunker import _WORDS
+
+
+def make_prompts(count, context_words, seed):
+    rng = random.Random(seed)
+    prompts = []
+    for i in range(count):
+        words = context_words[i % len(context_words)]
+        context = [" ".join(rng.choice(_WORDS) for _ in range(words))]
+        question = " ".join(rng.choice(_WORDS) for _ in range(rng.randint(5, 15))) + "?"
+        prompts.append(build_prompt(context, question))
+    return prompts
+
+
+def run(scheduler, prompts, prefix_ids, max_new_tokens):
+    """Gửi từng prompt (tuần tự), trả về (danh sách TTFT giây, token sinh ra của từng prompt)."""
+    ttft, outputs = [], []
+    for input_ids in prompts:
+        length = next((len(ids) for ids in prefix_ids if input_ids[:len(ids)] == ids), 0)
+        request = scheduler.submit(input_ids, max_new_tokens=max_new_tokens, prefix_length=length)
+        outputs.append(request.result())
+        ttft.append(request.first_token_at - request.submitted_at)
+    return ttft, outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default=os.getenv("LLM_MODEL_PATH"))
+    parser.add_argument("--prompts", type=int, default=30)
+    parser.add_argument("--context-words", default="20,150,400", help="Số từ ngữ cảnh, xoay vòng giữa các prompt")
+    parser.add_argument("--max-new-tokens", type=int, default=4)
+    parser.add_argument("--min-match", type=float, default=0.9, help="Tỉ lệ prompt tối thiểu sinh ra token giống nhau")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    dtype = torch.float16 if device == "cuda" else torch.float32
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    tokenizer.pad_token = tokenizer.eos_token
+    model = AutoModelForCausalLM.from_pretrained(args.model, torch_dtype=dtype).to(device).eval()
+
+    # Như rag.prefix_length: bỏ token cuối của prefix vì có thể bị gộp với phần ngữ cảnh phía sau
+    prefix_ids = [tokenizer(text).input_ids[:-1] for text in system_prompt_prefixes()]
+    context_words = [int(w) for w in args.context_words.split(",")]
+    prompts = [tokenizer(p).input_ids for p in make_prompts(args.prompts, context_words, args.seed)]
+    prompt_tokens = np.mean([len(p) for p in prompts])
+    print(f"📝 {len(prompts)} prompt, trung bình {prompt_tokens:.0f} token; prefix system: "
+          f"{', '.join(str(len(ids)) for ids in prefix_ids)} token")
+
+    # Một bộ lập lịch (một thread giải mã) cho cả hai lượt, chỉ bật/tắt prefix cache
+    scheduler = GenerationScheduler(model, tokenizer, max_batch=1)
+    scheduler.eos_ids = set()  # sinh đủ max_new_tokens để so sánh token
+    results = {}
+    for name, size in (("không cache", 0), ("prefix cache", scheduler.prefix_cache_size or 4)):
+        scheduler.prefix_cache_size = size
+        scheduler.clear_prefix_cache()
+        run(scheduler, prompts[:2], prefix_ids, 1)  # warm-up (và tính KV prefix khi bật cache)
+        ttft, outputs = run(scheduler, prompts, prefix_ids, args.max_new_tokens)
+        results[name] = (ttft, outputs)
+        print(f"{name:>12}: TTFT p50 {np.percentile(ttft, 50) * 1000:7.1f} ms, "
+              f"p95 {np.percentile(ttft, 95) * 1000:7.1f} ms")
+    print(f"📦 {scheduler.stats()['prefix_cache']}")
+    scheduler.close()
+
+    base, cached = results["không cache"], results["prefix cache"]
+    print(f"⚡ TTFT p50 nhanh hơn {np.percentile(base[0], 50) / np.percentile(cached[0], 50):.2f}x")
+    match = np.mean([a == b for a, b in zip(base[1], cached[1])])
+    print(f"🔎 Token sinh ra trùng nhau: {match:.0%} số prompt")
+    if match < args.min_match:
+        print(f"❌ Tỉ lệ trùng {match:.0%} < {args.min_match:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
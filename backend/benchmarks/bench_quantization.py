@@ -0,0 +1,73 @@
+# bench_quantization.py: Kiểm tra recall và dung lượng của index nén (float16 / int8)
+#
+# So với index float32 chính xác, báo cáo cho từng kiểu lưu vector:
+#   - số byte mỗi vector trong index (bộ nhớ thường trú khi khởi động)
+#   - recall@k khi tìm trực tiếp trên mã nén và khi chấm lại bằng float32 từ kho chunk
+# Thoát với mã lỗi 1 nếu recall sau khi chấm lại thấp hơn --min-recall.
+#
+# Chạy từ thư mục gốc repo:
+#   python -m backend.benchmarks.bench_quantization --num-vectors 100000 --dim 1024
+
+import argparse
+import sys
+import tempfile
+
+import faiss
+
+from backend.core import vector_index
+from backend.benchmarks.bench_index_modes import make_corpus, make_queries, build_store
+
+
+def recall_at_k(ids, truth, k):
+    hits = sum(len(set(row[:k].tolist()) & set(ref[:k].tolist())) for row, ref in zip(ids, truth))
+    return hits / (len(truth) * k)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-vectors", type=int, default=50000)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--num-queries", type=int, default=200)
+    parser.add_argument("--num-clusters", type=int, default=256)
+    parser.add_argument("--doc-size", type=int, default=500)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--mode", default="flat", choices=["flat", "hnsw"])
+    parser.add_argument("--storages", default="float32,float16,int8")
+    parser.add_argument("--rescore-factor", type=int, default=vector_index.RESCORE_FACTOR)
+    parser.add_argument("--min-recall", type=float, default=0.95)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.num_vectors, args.dim, args.num_clusters, args.seed)
+    queries = make_queries(corpus, args.num_queries, args.seed)
+
+    failed = False
+    with tempfile.TemporaryDirectory() as root:
+        view = build_store(root, corpus, args.doc_size)
+        exact = vector_index.build_from_view(view, "flat", "float32")
+        _, truth = exact.search(queries, args.k)
+
+        print(f"Kho tổng hợp: {args.num_vectors} vector x {args.dim} chiều, mode={args.mode}, k={args.k}")
+        print(f"{'storage':<10}{'byte/vector':>12}{'tỉ lệ':>8}{'recall (nén)':>14}{'recall (chấm lại)':>19}")
+        baseline_bytes = None
+        for storage in args.storages.split(","):
+            index = vector_index.build_from_view(view, args.mode, storage)
+            bytes_per_vector = len(faiss.serialize_index(index)) / index.ntotal
+            baseline_bytes = baseline_bytes or bytes_per_vector
+            _, raw_ids = vector_index.search(index, view, queries, args.k, rescore_factor=0)
+            _, rescored_ids = vector_index.search(index, view, queries, args.k, rescore_factor=args.rescore_factor)
+            raw_recall = recall_at_k(raw_ids, truth, args.k)
+            rescored_recall = recall_at_k(rescored_ids, truth, args.k)
+            print(
+                f"{storage:<10}{bytes_per_vector:>12.0f}{baseline_bytes / bytes_per_vector:>7.1f}x"
+                f"{raw_recall:>14.3f}{rescored_recall:>19.3f}"
+            )
+            if rescored_recall < args.min_recall:
+                failed = True
+                print(f"❌ {storage}: recall {rescored_recall:.3f} < {args.min_recall}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+# admission.py: Kiểm soát tiếp nhận (admission control) trước bước sinh của LLM
+#
+# Mỗi request chat phải lấy một "chỗ" trước khi chạy pipeline RAG + sinh:
+#   - tối đa ADMISSION_MAX_CONCURRENT request chạy cùng lúc
+#   - phần còn lại chờ trong hàng đợi có giới hạn (ADMISSION_MAX_QUEUE), mỗi request có hạn chờ riêng
+#     (ADMISSION_QUEUE_TIMEOUT giây); hết hạn thì trả 503 thay vì treo tới khi proxy cắt
+#   - hàng đợi chia theo người dùng, chỗ trống được cấp xoay vòng giữa các người dùng đang chờ nên một
+#     người gửi dồn dập không chặn được người khác; mỗi người chờ tối đa ADMISSION_MAX_QUEUE_PER_USER request
+#   - từ chối ngay (429 vượt hạn mức của người dùng, 503 hàng đợi đầy / thời gian chờ ước tính vượt hạn chờ)
+#     kèm thời gian chờ ước tính cho header Retry-After
+# Thời gian chờ ước tính = số lượt phía trước / số chỗ x thời gian giữ chỗ trung bình (EWMA).
+
+import os
+import math
+import time
+import asyncio
+import threading
+from collections import OrderedDict, deque
+
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", os.getenv("GEN_MAX_BATCH", "8")))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+ADMISSION_MAX_QUEUE_PER_USER = int(os.getenv("ADMISSION_MAX_QUEUE_PER_USER", "4"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "30"))
+# Thời gian giữ chỗ giả định khi chưa đo được request nào (giây)
+ADMISSION_INITIAL_SERVICE_SECONDS = float(os.getenv("ADMISSION_INITIAL_SERVICE_SECONDS", "5"))
+
+_EWMA_ALPHA = 0.2
+_WAIT_SAMPLES = 1024
+
+
+class AdmissionRejected(Exception):
+    """Request bị từ chối: status_code 429/503 và retry_after (giây) để trả cho client."""
+
+    def __init__(self, status_code: int, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """Một lượt xin chỗ; giữ chỗ từ lúc được cấp tới khi release()."""
+
+    def __init__(self, user_key: str, deadline: float, loop=None):
+        self.user_key = user_key
+        self.deadline = deadline
+        self.enqueued_at = time.monotonic()
+        self.admitted_at = None
+        self.released = False
+        self._event = threading.Event()
+        self._loop = loop
+        self._future = loop.create_future() if loop is not None else None
+
+    def _grant(self) -> None:
+        self.admitted_at = time.monotonic()
+        self._event.set()
+        if self._future is not None:
+            self._loop.call_soon_threadsafe(lambda: self._future.done() or self._future.set_result(True))
+
+
+class AdmissionController:
+    def __init__(self, max_concurrent: int | None = None, max_queue: int | None = None,
+                 max_queue_per_user: int | None = None, queue_timeout: float | None = None):
+        self.max_concurrent = max_concurrent or ADMISSION_MAX_CONCURRENT
+        self.max_queue = ADMISSION_MAX_QUEUE if max_queue is None else max_queue
+        self.max_queue_per_user = max_queue_per_user or ADMISSION_MAX_QUEUE_PER_USER
+        self.queue_timeout = queue_timeout or ADMISSION_QUEUE_TIMEOUT
+        self._lock = threading.Lock()
+        self._queues = OrderedDict()  # user_key -> deque[Ticket]; thứ tự = lượt xoay vòng
+        self._waiting = 0
+        self._active = 0
+        self._service_seconds = ADMISSION_INITIAL_SERVICE_SECONDS
+        self._waits = deque(maxlen=_WAIT_SAMPLES)
+        self._counters = {"admitted": 0, "rejected_user_limit": 0, "rejected_queue_full": 0,
+                          "rejected_wait_estimate": 0, "timed_out": 0}
+
+    # ------------------------------------------------------------------ API
+    def acquire(self, user_key: str, timeout: float | None = None) -> Ticket:
+        """Chờ (chặn thread) tới khi được cấp chỗ; raise AdmissionRejected nếu bị từ chối hoặc quá hạn chờ."""
+        ticket = self._enqueue(user_key, timeout, None)
+        if not ticket._event.wait(max(0.0, ticket.deadline - time.monotonic())):
+            self._expire(ticket)
+        return ticket
+
+    async def acquire_async(self, user_key: str, timeout: float | None = None) -> Ticket:
+        """Như acquire() nhưng chờ trên event loop, không chiếm thread."""
+        ticket = self._enqueue(user_key, timeout, asyncio.get_running_loop())
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket._future), max(0.0, ticket.deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            self._expire(ticket)
+        except asyncio.CancelledError:
+            # Client bỏ đi khi đang chờ: rút khỏi hàng đợi hoặc trả lại chỗ vừa được cấp
+            if not self._withdraw(ticket):
+                self.release(ticket)
+            raise
+        return ticket
+
+    def release(self, ticket: Ticket) -> None:
+        """Trả chỗ và cấp cho người chờ kế tiếp (xoay vòng theo người dùng). Gọi nhiều lần không sao."""
+        with self._lock:
+            if ticket.released or ticket.admitted_at is None:
+                return
+            ticket.released = True
+            self._active -= 1
+            held = time.monotonic() - ticket.admitted_at
+            self._service_seconds += _EWMA_ALPHA * (held - self._service_seconds)
+            self._dispatch()
+
+    def estimated_wait(self, ahead: int | None = None) -> float:
+        """Số giây ước tính một request mới phải chờ (ahead: số lượt đang chờ phía trước)."""
+        ahead = self._waiting if ahead is None else ahead
+        if self._active + ahead < self.max_concurrent:
+            return 0.0
+        return (ahead // self.max_concurrent + 1) * self._service_seconds
+
+    def stats(self) -> dict:
+        with self._lock:
+            waits = sorted(self._waits)
+            counters = dict(self._counters)
+            queue_by_user = {key: len(q) for key, q in self._queues.items()}
+            active, waiting = self._active, self._waiting
+        return {
+            "active": active,
+            "max_concurrent": self.max_concurrent,
+            "queue_depth": waiting,
+            "max_queue": self.max_queue,
+            "waiting_users": len(queue_by_user),
+            "max_queue_per_user": max(queue_by_user.values(), default=0),
+            **counters,
+            "wait_p50_seconds": round(waits[len(waits) // 2], 3) if waits else None,
+            "wait_p95_seconds": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else None,
+            "service_seconds_ewma": round(self._service_seconds, 3),
+            "estimated_wait_seconds": round(self.estimated_wait(), 1),
+        }
+
+    # ------------------------------------------------------------------ nội bộ
+    def _reject(self, counter: str, status_code: int, reason: str, wait: float) -> None:
+        self._counters[counter] += 1
+        raise AdmissionRejected(status_code, reason, max(1, math.ceil(wait)))
+
+    def _enqueue(self, user_key: str, timeout: float | None, loop) -> Ticket:
+        timeout = self.queue_timeout if timeout is None else timeout
+        ticket = Ticket(user_key, time.monotonic() + timeout, loop)
+        with self._lock:
+            if self._active < self.max_concurrent and self._waiting == 0:
+                self._admit(ticket)
+                return ticket
+            wait = self.estimated_wait()
+            user_queue = self._queues.get(user_key)
+            if user_queue is not None and len(user_queue) >= self.max_queue_per_user:
+                self._reject("rejected_user_limit", 429, "Too many pending requests for this user",
+                             wait + len(user_queue) * self._service_seconds)
+            if self._waiting >= self.max_queue:
+                self._reject("rejected_queue_full", 503, "Generation queue is full", wait)
+            if wait > timeout:
+                # Chắc chắn không kịp hạn chờ: từ chối ngay thay vì giữ client chờ vô ích
+                self._reject("rejected_wait_estimate", 503, "Estimated wait exceeds the queue deadline", wait)
+            self._queues.setdefault(user_key, deque()).append(ticket)
+            self._waiting += 1
+        return ticket
+
+    def _admit(self, ticket: Ticket) -> None:
+        self._active += 1
+        self._counters["admitted"] += 1
+        self._waits.append(time.monotonic() - ticket.enqueued_at)
+        ticket._grant()
+
+    def _dispatch(self) -> None:
+        """Cấp chỗ trống cho người dùng đứng đầu vòng xoay rồi đưa người đó xuống cuối vòng."""
+        now = time.monotonic()
+        while self._active < self.max_concurrent and self._queues:
+            user_key, user_queue = next(iter(self._queues.items()))
+            ticket = user_queue.popleft()
+            self._waiting -= 1
+            if user_queue:
+                self._queues.move_to_end(user_key)
+            else:
+                del self._queues[user_key]
+            if ticket.deadline <= now:
+                continue  # người chờ này sắp tự hết hạn; nhường chỗ cho người kế tiếp
+            self._admit(ticket)
+
+    def _withdraw(self, ticket: Ticket) -> bool:
+        """Rút ticket chưa được cấp khỏi hàng đợi; False nếu nó đã được cấp chỗ."""
+        with self._lock:
+            if ticket.admitted_at is not None:
+                return False
+            user_queue = self._queues.get(ticket.user_key)
+            if user_queue is not None and ticket in user_queue:
+                user_queue.remove(ticket)
+                self._waiting -= 1
+                if not user_queue:
+                    del self._queues[ticket.user_key]
+            return True
+
+    def _expire(self, ticket: Ticket) -> None:
+        if not self._withdraw(ticket):
+            return  # được cấp đúng lúc hết hạn: dùng luôn
+        with self._lock:
+            self._counters["timed_out"] += 1
+            wait = self.estimated_wait()
+        raise AdmissionRejected(503, "Timed out waiting for a generation slot", max(1, math.ceil(wait)))
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_admission() -> AdmissionController:
+    """Bộ kiểm soát tiếp nhận dùng chung cả process."""
+    global _controller
+    with _controller_lock:
+        if _controller is None:
+            _controller = AdmissionController()
+        return _controller
+
+
+def admission_stats() -> dict:
+    return get_admission().stats()
@@ -0,0 +1,177 @@
+# cache.py: Các cache trong bộ nhớ cho pipeline RAG, an toàn đa luồng, có bộ đếm hit/miss
+#   - LRUCache: giới hạn số entry + TTL (embedding câu hỏi, kết quả truy xuất)
+#   - AnswerCache: giới hạn theo byte, hỗ trợ tra câu hỏi gần trùng (câu trả lời LLM)
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    Cache LRU đơn giản:
+    - maxsize: số entry tối đa, vượt quá thì bỏ entry ít dùng gần đây nhất
+    - ttl: số giây một entry còn hiệu lực (None = không hết hạn)
+    """
+
+    def __init__(self, maxsize: int, ttl: float | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING:
+                expires_at, value = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value) -> None:
+        if self.maxsize <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+def cache_from_env(prefix: str, default_size: int, default_ttl: float | None = None) -> LRUCache:
+    """Tạo LRUCache với kích thước/TTL đọc từ biến môi trường {prefix}_SIZE và {prefix}_TTL."""
+    size = int(os.getenv(f"{prefix}_SIZE", str(default_size)))
+    ttl = os.getenv(f"{prefix}_TTL")
+    return LRUCache(size, float(ttl) if ttl else default_ttl)
+
+
+class AnswerCache:
+    """
+    Cache câu trả lời của LLM, giới hạn theo tổng dung lượng (byte), bỏ entry cũ nhất khi đầy.
+
+    Khóa gồm câu hỏi đã chuẩn hóa và context_key (phạm vi tài liệu, tập chunk ID đã truy xuất,
+    phiên bản prompt/model). Nếu bật similarity_threshold, câu hỏi gần trùng (cosine giữa
+    embedding >= ngưỡng) với cùng context_key cũng dùng lại câu trả lời.
+    """
+
+    def __init__(self, max_bytes: int, similarity_threshold: float = 0.0):
+        self.max_bytes = max_bytes
+        self.similarity_threshold = similarity_threshold
+        self._data = OrderedDict()  # (query, context_key) -> (answer, query_vector, size)
+        self._buckets = {}  # context_key -> set các query đang có trong cache
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _entry_size(query: str, answer: str, query_vector) -> int:
+        size = len(query.encode("utf-8")) + len(answer.encode("utf-8")) + 200
+        if query_vector is not None:
+            size += query_vector.nbytes
+        return size
+
+    def get(self, query: str, context_key, query_vector=None):
+        with self._lock:
+            entry = self._data.get((query, context_key))
+            if entry is not None:
+                self._data.move_to_end((query, context_key))
+                self.hits += 1
+                return entry[0]
+            if self.similarity_threshold > 0 and query_vector is not None:
+                best_key, best_score = None, self.similarity_threshold
+                norm = float(np.linalg.norm(query_vector)) or 1.0
+                for other in self._buckets.get(context_key, ()):
+                    other_vector = self._data[(other, context_key)][1]
+                    if other_vector is None:
+                        continue
+                    score = float(np.dot(query_vector, other_vector)) / (norm * (float(np.linalg.norm(other_vector)) or 1.0))
+                    if score >= best_score:
+                        best_key, best_score = (other, context_key), score
+                if best_key is not None:
+                    self._data.move_to_end(best_key)
+                    self.hits += 1
+                    self.semantic_hits += 1
+                    return self._data[best_key][0]
+            self.misses += 1
+            return None
+
+    def put(self, query: str, context_key, answer: str, query_vector=None) -> None:
+        size = self._entry_size(query, answer, query_vector)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._remove((query, context_key))
+            self._data[(query, context_key)] = (answer, query_vector, size)
+            self._buckets.setdefault(context_key, set()).add(query)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def _remove(self, key) -> None:
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= entry[2]
+        bucket = self._buckets.get(key[1])
+        if bucket is not None:
+            bucket.discard(key[0])
+            if not bucket:
+                del self._buckets[key[1]]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._buckets.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
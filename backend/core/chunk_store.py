@@ -0,0 +1,645 @@
+# chunk_store.py: Kho lưu chunk dạng cột trên đĩa, mở bằng mmap (thay cho all_embeddings.pkl)
+#
+# Bố cục thư mục:
+#   manifest.json               - danh sách segment và các tài liệu còn sống trong từng segment
+#   seg_000001/embeddings.npy   - ma trận float32 [n, dim]
+#   seg_000001/offsets.npy      - int64 [n + 1], vị trí byte đầu/cuối của từng chunk trong texts.bin
+#   seg_000001/texts.bin        - nội dung các chunk nối liền, mã hóa UTF-8
+#   seg_000001/tokens.npy       - int32 [n, 3], tính lúc ingest cho bộ xếp ngữ cảnh (context_packer.py):
+#                                 số token LLM của chunk, số ký tự / số token đầu chunk trùng phần cuối
+#                                 chunk liền trước cùng tài liệu (gối đầu của chunker); -1 = chưa tính
+#
+# Mỗi lần ingest ghi thêm một segment mới (không ghi lại dữ liệu cũ). Xóa tài liệu chỉ sửa
+# manifest; các hàng "chết" được dọn khi compact chạy nền.
+#
+# Segment đang ghi nằm trong seg_xxxxxx.tmp/ kèm file writer.owner ("host:pid" của process ghi). Khi mở kho,
+# thư mục tạm chỉ bị dọn nếu process ghi đã chết hoặc (không kiểm tra được, vd. máy khác) không được ghi trong
+# CHUNK_STORE_TMP_MAX_AGE giây, vì process khác (benchmark, worker khác) có thể dùng chung thư mục kho.
+# Segment bị bỏ (compact, xóa tài liệu) mà chưa xóa được - trên Windows file đang được mmap bởi một ảnh chụp
+# cũ thì không xóa được - được thử xóa lại ở các lần dọn sau và khi mở kho lần tới.
+#
+# Mỗi chunk có một ID 64-bit ổn định: first_id của tài liệu + chỉ số chunk trong tài liệu.
+# ID không đổi khi compact, nên FAISS index (IndexIDMap2) không cần dựng lại.
+
+import os
+import json
+import mmap
+import pickle
+import re
+import shutil
+import socket
+import bisect
+import struct
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+MANIFEST_NAME = "manifest.json"
+MAX_SEGMENTS = int(os.getenv("CHUNK_STORE_MAX_SEGMENTS", "8"))
+COMPACT_TARGET_ROWS = int(os.getenv("CHUNK_STORE_COMPACT_ROWS", "50000"))
+COMPACT_DEAD_RATIO = float(os.getenv("CHUNK_STORE_COMPACT_DEAD_RATIO", "0.3"))
+CHUNK_STORE_TMP_MAX_AGE = float(os.getenv("CHUNK_STORE_TMP_MAX_AGE", "3600"))
+WRITER_OWNER_FILE = "writer.owner"
+_SEGMENT_NAME = re.compile(r"^seg_(\d+)$")
+# Chừa sẵn chỗ cho header .npy để ghi embeddings dần dần khi chưa biết trước số hàng
+_NPY_HEADER_BYTES = 128
+_UNKNOWN_TOKEN_STATS = (-1, -1, -1)
+
+
+class Segment:
+    """Một segment bất biến trên đĩa, mở bằng mmap (không đọc toàn bộ vào RAM)."""
+
+    def __init__(self, path: str, rows: int):
+        self.path = path
+        self.rows = rows
+        self.embeddings = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        # Segment ghi trước khi có tokens.npy: bộ xếp ngữ cảnh tự ước lượng
+        tokens_path = os.path.join(path, "tokens.npy")
+        self.token_stats = np.load(tokens_path, mmap_mode="r") if os.path.exists(tokens_path) else None
+        texts_path = os.path.join(path, "texts.bin")
+        self._texts = b""
+        if os.path.getsize(texts_path) > 0:
+            with open(texts_path, "rb") as f:
+                self._texts = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def text(self, row: int) -> str:
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        return self._texts[start:end].decode("utf-8")
+
+    def token_stats_row(self, row: int):
+        """(số token, số ký tự gối đầu, số token gối đầu) của một hàng; None nếu chưa tính."""
+        if self.token_stats is None or self.token_stats[row, 0] < 0:
+            return None
+        return tuple(int(v) for v in self.token_stats[row])
+
+
+class ChunkStoreView:
+    """
+    Ảnh chụp chỉ-đọc của kho tại một phiên bản manifest.
+    Truy cập theo chỉ số hàng toàn cục (thứ tự các chunk còn sống theo segment, rồi theo
+    tài liệu) hoặc theo chunk ID ổn định (khóa của FAISS index).
+    """
+
+    def __init__(self, version: int, segments: list):
+        self.version = version
+        # (global_start, segment, local_start, count, pdf_name, first_id)
+        self._ranges = []
+        self._doc_ranges = {}
+        total = 0
+        for segment, docs in segments:
+            for doc in docs:
+                self._ranges.append((total, segment, doc["start"], doc["count"], doc["pdf_name"], doc["first_id"]))
+                self._doc_ranges[doc["pdf_name"]] = (total, doc["count"], doc["first_id"], len(self._ranges) - 1)
+                total += doc["count"]
+        self._starts = [r[0] for r in self._ranges]
+        # Tra cứu theo chunk ID: danh sách (first_id, vị trí trong _ranges) đã sắp xếp
+        id_order = sorted(range(len(self._ranges)), key=lambda i: self._ranges[i][5])
+        self._id_starts = [self._ranges[i][5] for i in id_order]
+        self._id_order = id_order
+        self.num_chunks = total
+
+    def __len__(self) -> int:
+        return self.num_chunks
+
+    def _locate(self, row: int):
+        if row < 0 or row >= self.num_chunks:
+            raise IndexError(row)
+        global_start, segment, local_start, _, pdf_name, first_id = self._ranges[bisect.bisect_right(self._starts, row) - 1]
+        offset = row - global_start
+        return segment, local_start + offset, pdf_name, offset, first_id + offset
+
+    def _locate_id(self, chunk_id: int):
+        pos = bisect.bisect_right(self._id_starts, chunk_id) - 1
+        if pos >= 0:
+            global_start, segment, local_start, count, pdf_name, first_id = self._ranges[self._id_order[pos]]
+            offset = chunk_id - first_id
+            if 0 <= offset < count:
+                return segment, local_start + offset, pdf_name, offset, chunk_id
+        raise KeyError(chunk_id)
+
+    def text(self, row: int) -> str:
+        segment, local_row, _, _, _ = self._locate(row)
+        return segment.text(local_row)
+
+    def metadata(self, row: int) -> dict:
+        _, _, pdf_name, chunk_index, chunk_id = self._locate(row)
+        return {"pdf_name": pdf_name, "chunk_index": chunk_index, "chunk_id": chunk_id}
+
+    def has_id(self, chunk_id: int) -> bool:
+        try:
+            self._locate_id(chunk_id)
+            return True
+        except KeyError:
+            return False
+
+    def text_by_id(self, chunk_id: int) -> str:
+        segment, local_row, _, _, _ = self._locate_id(chunk_id)
+        return segment.text(local_row)
+
+    def metadata_by_id(self, chunk_id: int) -> dict:
+        _, _, pdf_name, chunk_index, _ = self._locate_id(chunk_id)
+        return {"pdf_name": pdf_name, "chunk_index": chunk_index, "chunk_id": chunk_id}
+
+    def token_stats_by_id(self, chunk_id: int):
+        """(số token LLM, số ký tự gối đầu, số token gối đầu) tính lúc ingest; None nếu segment chưa có."""
+        segment, local_row, _, _, _ = self._locate_id(chunk_id)
+        return segment.token_stats_row(local_row)
+
+    def embeddings_by_ids(self, chunk_ids) -> np.ndarray:
+        """Đọc vector float32 gốc của các chunk ID (chỉ chạm các hàng cần thiết trong mmap)."""
+        rows = []
+        for chunk_id in chunk_ids:
+            segment, local_row, _, _, _ = self._locate_id(int(chunk_id))
+            rows.append(segment.embeddings[local_row])
+        return np.asarray(rows, dtype=np.float32)
+
+    def has_doc(self, pdf_name: str) -> bool:
+        return pdf_name in self._doc_ranges
+
+    def doc_names(self) -> list:
+        return list(self._doc_ranges.keys())
+
+    def doc_id_range(self, pdf_name: str):
+        """Trả về (first_id, count) của một tài liệu, hoặc None nếu không có."""
+        entry = self._doc_ranges.get(pdf_name)
+        return (entry[2], entry[1]) if entry else None
+
+    def doc_embeddings(self, pdf_name: str):
+        """Trả về lát cắt mmap các embedding của một tài liệu (không copy)."""
+        entry = self._doc_ranges.get(pdf_name)
+        if entry is None:
+            return None
+        _, segment, local_start, count, _, _ = self._ranges[entry[3]]
+        return segment.embeddings[local_start:local_start + count]
+
+    def iter_embeddings(self):
+        """Duyệt (embeddings, chunk_ids) theo từng tài liệu, đúng thứ tự hàng toàn cục."""
+        for _, segment, local_start, count, _, first_id in self._ranges:
+            yield segment.embeddings[local_start:local_start + count], np.arange(first_id, first_id + count, dtype=np.int64)
+
+
+class SegmentWriter:
+    """
+    Ghi một segment theo từng lô (texts, embeddings) mà không cần giữ cả tài liệu trong RAM.
+    Dữ liệu được ghi vào thư mục tạm; finish() điền header .npy rồi đổi tên thành segment thật.
+    last_text: chunk cuối đã ghi, để tính phần gối đầu của lô kế tiếp.
+    """
+
+    def __init__(self, tmp_dir: str):
+        self.tmp_dir = tmp_dir
+        self.name = None
+        self.rows = 0
+        self.dim = None
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        with open(os.path.join(tmp_dir, WRITER_OWNER_FILE), "w", encoding="utf-8") as f:
+            f.write(f"{socket.gethostname()}:{os.getpid()}")
+        self._embeddings = open(os.path.join(tmp_dir, "embeddings.npy"), "wb")
+        self._embeddings.write(b"\0" * _NPY_HEADER_BYTES)
+        self._texts = open(os.path.join(tmp_dir, "texts.bin"), "wb")
+        self._offsets = [0]
+        self._token_stats = []
+        self.last_text = None
+
+    def add(self, texts, embeddings, token_stats=None) -> None:
+        """token_stats: (số token, ký tự gối đầu, token gối đầu) của từng chunk; None = chưa tính."""
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if len(texts) != len(embeddings):
+            raise ValueError("Số chunk và số vector embedding không khớp")
+        if len(texts) == 0:
+            return
+        if self.dim is None:
+            self.dim = int(embeddings.shape[1])
+        elif embeddings.shape[1] != self.dim:
+            raise ValueError(f"Số chiều embedding {embeddings.shape[1]} khác {self.dim}")
+        self._embeddings.write(embeddings.tobytes())
+        for text in texts:
+            data = text.encode("utf-8")
+            self._texts.write(data)
+            self._offsets.append(self._offsets[-1] + len(data))
+        self._token_stats.extend(token_stats if token_stats is not None else [_UNKNOWN_TOKEN_STATS] * len(texts))
+        self.last_text = texts[-1]
+        self.rows += len(texts)
+
+    def finish(self, final_dir: str) -> int:
+        """Hoàn tất file và đổi tên thư mục tạm thành final_dir. Trả về số hàng đã ghi."""
+        header = "{'descr': '<f4', 'fortran_order': False, 'shape': (%d, %d), }" % (self.rows, self.dim or 0)
+        header = header.ljust(_NPY_HEADER_BYTES - 10 - 1) + "\n"
+        self._embeddings.seek(0)
+        self._embeddings.write(b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1"))
+        self._embeddings.close()
+        self._texts.close()
+        np.save(os.path.join(self.tmp_dir, "offsets.npy"), np.asarray(self._offsets, dtype=np.int64))
+        np.save(os.path.join(self.tmp_dir, "tokens.npy"),
+                np.asarray(self._token_stats, dtype=np.int32).reshape(-1, len(_UNKNOWN_TOKEN_STATS)))
+        os.remove(os.path.join(self.tmp_dir, WRITER_OWNER_FILE))
+        os.replace(self.tmp_dir, final_dir)
+        return self.rows
+
+    def abort(self) -> None:
+        self._embeddings.close()
+        self._texts.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+class ChunkStore:
+    """Quản lý ghi (append/remove/compact) cho một thư mục kho chunk."""
+
+    def __init__(self, root: str):
+        self.root = root
+        self._lock = threading.RLock()
+        self._segments = {}  # name -> Segment đã mở (segment là bất biến nên dùng lại được)
+        self._pending_discard = set()  # segment đã bỏ nhưng chưa xóa được khỏi đĩa
+        self._compact_thread = None
+        os.makedirs(root, exist_ok=True)
+
+    # ------------------------------------------------------------------ manifest
+    def _manifest_path(self) -> str:
+        return os.path.join(self.root, MANIFEST_NAME)
+
+    def _read_manifest(self) -> dict:
+        path = self._manifest_path()
+        if not os.path.exists(path):
+            return {"version": 0, "next_segment": 1, "next_id": 0, "segments": []}
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if "next_id" not in manifest:
+            # Manifest cũ chưa có chunk ID: cấp ID theo thứ tự hàng hiện tại
+            next_id = 0
+            for info in manifest["segments"]:
+                for doc in info["docs"]:
+                    doc["first_id"] = next_id
+                    next_id += doc["count"]
+            manifest["next_id"] = next_id
+        return manifest
+
+    def _write_manifest(self, manifest: dict) -> None:
+        manifest["version"] = manifest.get("version", 0) + 1
+        tmp_path = self._manifest_path() + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._manifest_path())
+
+    def _open_segment(self, info: dict) -> Segment:
+        segment = self._segments.get(info["name"])
+        if segment is None:
+            segment = Segment(os.path.join(self.root, info["name"]), info["rows"])
+            self._segments[info["name"]] = segment
+        return segment
+
+    # ------------------------------------------------------------------ đọc
+    def view(self) -> ChunkStoreView:
+        """Mở ảnh chụp hiện tại của kho (chỉ đọc manifest + mmap, không đọc dữ liệu)."""
+        with self._lock:
+            manifest = self._read_manifest()
+            segments = [
+                (self._open_segment(info), list(info["docs"]))
+                for info in manifest["segments"]
+                if info["docs"]
+            ]
+            return ChunkStoreView(manifest["version"], segments)
+
+    def has_doc(self, pdf_name: str) -> bool:
+        with self._lock:
+            manifest = self._read_manifest()
+        return any(doc["pdf_name"] == pdf_name for info in manifest["segments"] for doc in info["docs"])
+
+    # ------------------------------------------------------------------ ghi
+    def _write_segment(self, name: str, parts) -> int:
+        """Ghi một segment mới từ các phần (texts, embeddings, token_stats). Trả về số hàng đã ghi."""
+        writer = SegmentWriter(os.path.join(self.root, name + ".tmp"))
+        try:
+            for texts, embeddings, token_stats in parts:
+                writer.add(texts, embeddings, token_stats)
+            return writer.finish(os.path.join(self.root, name))
+        except BaseException:
+            writer.abort()
+            raise
+
+    def begin_segment(self) -> "SegmentWriter":
+        """
+        Cấp tên segment mới và trả về SegmentWriter để ghi dần từng lô chunk.
+        Kết thúc bằng commit_segment() (hoặc writer.abort() nếu bỏ dở).
+        """
+        with self._lock:
+            manifest = self._read_manifest()
+            name = f"seg_{manifest['next_segment']:06d}"
+            manifest["next_segment"] += 1
+            self._write_manifest(manifest)
+        writer = SegmentWriter(os.path.join(self.root, name + ".tmp"))
+        writer.name = name
+        return writer
+
+    def commit_segment(self, writer: "SegmentWriter", pdf_name: str, created_at: str | None = None) -> dict | None:
+        """
+        Đóng segment đang ghi và đăng ký nó là tài liệu pdf_name (thay thế bản cũ nếu có).
+        Trả về entry của tài liệu (gồm first_id, count) và danh sách entry bị thay thế.
+        """
+        if writer.rows == 0:
+            writer.abort()
+            return None
+        rows = writer.finish(os.path.join(self.root, writer.name))
+
+        with self._lock:
+            manifest = self._read_manifest()
+            replaced = self._drop_doc(manifest, pdf_name)
+            doc = {
+                "pdf_name": pdf_name,
+                "start": 0,
+                "count": rows,
+                "first_id": manifest["next_id"],
+                "created_at": created_at or datetime.now().isoformat(),
+            }
+            manifest["next_id"] += rows
+            manifest["segments"].append({
+                "name": writer.name,
+                "rows": rows,
+                "dim": writer.dim,
+                "docs": [doc],
+            })
+            empty = self._prune_empty(manifest)
+            self._write_manifest(manifest)
+            needs_compaction = self._needs_compaction(manifest)
+        for old_name in empty:
+            self._discard_segment(old_name)
+        self._discard_pending()
+        if needs_compaction:
+            self.compact_async()
+        return {**doc, "segment": writer.name, "replaced": replaced}
+
+    def append(self, pdf_name: str, chunks: list, embeddings, created_at: str | None = None,
+               token_stats=None) -> dict | None:
+        """
+        Thêm một tài liệu dưới dạng segment mới. Nếu tài liệu đã tồn tại thì thay thế.
+        token_stats: số token / gối đầu của từng chunk (xem SegmentWriter.add).
+        Trả về entry của tài liệu (gồm first_id, count) và danh sách entry bị thay thế.
+        """
+        if not chunks:
+            return None
+        writer = self.begin_segment()
+        try:
+            writer.add(chunks, embeddings, token_stats)
+        except BaseException:
+            writer.abort()
+            raise
+        return self.commit_segment(writer, pdf_name, created_at)
+
+    def _drop_doc(self, manifest: dict, pdf_name: str) -> list:
+        removed = []
+        for info in manifest["segments"]:
+            kept = [doc for doc in info["docs"] if doc["pdf_name"] != pdf_name]
+            if len(kept) != len(info["docs"]):
+                removed.extend(doc for doc in info["docs"] if doc["pdf_name"] == pdf_name)
+                info["docs"] = kept
+        return removed
+
+    @staticmethod
+    def _prune_empty(manifest: dict) -> list:
+        empty = [info["name"] for info in manifest["segments"] if not info["docs"]]
+        manifest["segments"] = [info for info in manifest["segments"] if info["docs"]]
+        return empty
+
+    def remove(self, pdf_name: str) -> list:
+        """
+        Xóa một tài liệu khỏi manifest; dữ liệu vật lý được dọn khi compact.
+        Trả về các entry đã xóa (mỗi entry có first_id, count) để gỡ khỏi FAISS index.
+        """
+        with self._lock:
+            manifest = self._read_manifest()
+            removed = self._drop_doc(manifest, pdf_name)
+            if not removed:
+                return []
+            empty = self._prune_empty(manifest)
+            self._write_manifest(manifest)
+            needs_compaction = self._needs_compaction(manifest)
+        for name in empty:
+            self._discard_segment(name)
+        if needs_compaction:
+            self.compact_async()
+        return removed
+
+    def discard_stale_tmp(self, max_age: float | None = None) -> None:
+        """
+        Dọn thư mục segment tạm còn sót lại khi process ghi dừng giữa chừng, và thư mục segment không còn
+        trong manifest (bỏ khi compact/xóa nhưng chưa xóa được). Thư mục tạm của process ghi còn sống, hoặc
+        được ghi trong max_age giây gần đây (mặc định CHUNK_STORE_TMP_MAX_AGE), được giữ nguyên.
+        """
+        max_age = CHUNK_STORE_TMP_MAX_AGE if max_age is None else max_age
+        with self._lock:
+            manifest = self._read_manifest()
+        live = {info["name"] for info in manifest["segments"]}
+        now = time.time()
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if not os.path.isdir(path):
+                continue
+            if name.endswith(".tmp"):
+                alive = _writer_alive(path)
+                if alive or (alive is None and now - _last_modified(path) < max_age):
+                    continue
+            else:
+                match = _SEGMENT_NAME.match(name)
+                # Segment vừa đổi tên từ thư mục tạm nhưng chưa vào manifest (process khác sắp đăng ký) còn mới
+                if (match is None or name in live or int(match.group(1)) >= manifest["next_segment"]
+                        or now - _last_modified(path) < max_age):
+                    continue
+            shutil.rmtree(path, ignore_errors=True)
+
+    def _discard_segment(self, name: str) -> None:
+        with self._lock:
+            self._segments.pop(name, None)
+            self._pending_discard.add(name)
+        self._discard_pending()
+
+    def _discard_pending(self) -> None:
+        """Xóa các segment đã bỏ; segment chưa xóa được (Windows: còn được mmap) giữ lại để thử lần sau."""
+        with self._lock:
+            pending = list(self._pending_discard)
+        for name in pending:
+            path = os.path.join(self.root, name)
+            try:
+                if os.path.exists(path):
+                    shutil.rmtree(path)
+            except OSError as e:
+                print(f"⚠️ Chưa xóa được segment {name} (thử lại sau): {str(e)}")
+                continue
+            with self._lock:
+                self._pending_discard.discard(name)
+
+    # ------------------------------------------------------------------ compact
+    @staticmethod
+    def _live_rows(info: dict) -> int:
+        return sum(doc["count"] for doc in info["docs"])
+
+    def _is_candidate(self, info: dict) -> bool:
+        dead_ratio = 1 - self._live_rows(info) / max(info["rows"], 1)
+        return info["rows"] < COMPACT_TARGET_ROWS or dead_ratio > COMPACT_DEAD_RATIO
+
+    def _needs_compaction(self, manifest: dict) -> bool:
+        segments = manifest["segments"]
+        if len(segments) > MAX_SEGMENTS:
+            return True
+        return any(1 - self._live_rows(info) / max(info["rows"], 1) > COMPACT_DEAD_RATIO for info in segments)
+
+    def _pick_compaction_run(self, manifest: dict) -> list:
+        """
+        Chọn một dãy segment LIÊN TIẾP để gộp (giữ nguyên thứ tự hàng toàn cục):
+        dãy dài nhất gồm các segment nhỏ hoặc có nhiều hàng chết.
+        """
+        best, run = [], []
+        for info in manifest["segments"]:
+            if self._is_candidate(info):
+                run.append(info)
+                if len(run) > len(best):
+                    best = list(run)
+            else:
+                run = []
+        if len(best) == 1 and self._live_rows(best[0]) == best[0]["rows"]:
+            return []
+        return best
+
+    def compact(self) -> bool:
+        """Gộp các segment nhỏ/nhiều hàng chết thành một segment mới. Trả về True nếu có gộp."""
+        with self._lock:
+            manifest = self._read_manifest()
+            run = self._pick_compaction_run(manifest)
+            if not run:
+                return False
+            name = f"seg_{manifest['next_segment']:06d}"
+            manifest["next_segment"] += 1
+            self._write_manifest(manifest)
+            sources = [(self._open_segment(info), [dict(doc) for doc in info["docs"]]) for info in run]
+
+        # Ghi segment mới bên ngoài lock: chỉ đọc các segment nguồn (bất biến)
+        parts = []
+        new_docs = []
+        row = 0
+        for segment, docs in sources:
+            for doc in docs:
+                start, count = doc["start"], doc["count"]
+                texts = [segment.text(i) for i in range(start, start + count)]
+                token_stats = [segment.token_stats_row(i) or _UNKNOWN_TOKEN_STATS for i in range(start, start + count)]
+                parts.append((texts, segment.embeddings[start:start + count], token_stats))
+                new_docs.append({**doc, "start": row})
+                row += count
+        if not parts:
+            return False
+        rows = self._write_segment(name, parts)
+
+        with self._lock:
+            manifest = self._read_manifest()
+            run_names = [info["name"] for info in run]
+            positions = [i for i, info in enumerate(manifest["segments"]) if info["name"] in run_names]
+            # Tài liệu có thể đã bị xóa trong lúc compact: chỉ giữ các tài liệu vẫn còn sống
+            alive = {doc["pdf_name"] for i in positions for doc in manifest["segments"][i]["docs"]}
+            merged = {
+                "name": name,
+                "rows": rows,
+                "dim": run[0]["dim"],
+                "docs": [doc for doc in new_docs if doc["pdf_name"] in alive],
+            }
+            if positions:
+                segments = [info for info in manifest["segments"] if info["name"] not in run_names]
+                if merged["docs"]:
+                    segments.insert(positions[0], merged)
+                manifest["segments"] = segments
+            self._write_manifest(manifest)
+        for old_name in run_names:
+            self._discard_segment(old_name)
+        if not positions or not merged["docs"]:
+            self._discard_segment(name)
+        print(f"🗜️ Đã compact {len(run_names)} segment thành {name} ({rows} chunk)")
+        return True
+
+    def compact_async(self) -> None:
+        """Chạy compact trong luồng nền (bỏ qua nếu đang có một lượt compact chạy)."""
+        with self._lock:
+            if self._compact_thread is not None and self._compact_thread.is_alive():
+                return
+            self._compact_thread = threading.Thread(target=self._compact_loop, daemon=True)
+            self._compact_thread.start()
+
+    def _compact_loop(self) -> None:
+        try:
+            while self.compact():
+                pass
+        except Exception as e:
+            print(f"Lỗi khi compact kho chunk {self.root}: {str(e)}")
+
+    # ------------------------------------------------------------------ migrate
+    def import_legacy_pickle(self, pickle_path: str) -> int:
+        """Chuyển dữ liệu từ all_embeddings.pkl cũ sang kho (chạy một lần). Trả về số tài liệu."""
+        with open(pickle_path, "rb") as f:
+            all_data = pickle.load(f)
+        imported = 0
+        for entry in all_data:
+            item_chunks = entry.get("chunks", [])
+            if not item_chunks:
+                continue
+            self.append(
+                entry.get("pdf_name", "unknown"),
+                item_chunks,
+                np.asarray(entry["embeddings"], dtype=np.float32),
+                created_at=entry.get("created_at"),
+            )
+            imported += 1
+        return imported
+
+
+def _last_modified(path: str) -> float:
+    """Thời điểm ghi gần nhất của thư mục và các file trong đó."""
+    latest = os.path.getmtime(path)
+    for name in os.listdir(path):
+        try:
+            latest = max(latest, os.path.getmtime(os.path.join(path, name)))
+        except OSError:
+            pass
+    return latest
+
+
+def _writer_alive(tmp_dir: str) -> bool | None:
+    """Process đang ghi thư mục tạm còn sống không; None nếu không kiểm tra được (máy khác, Windows, không rõ)."""
+    try:
+        with open(os.path.join(tmp_dir, WRITER_OWNER_FILE), "r", encoding="utf-8") as f:
+            host, _, pid = f.read().strip().rpartition(":")
+    except OSError:
+        return None
+    # Windows: os.kill(pid, 0) kết thúc process chứ không chỉ kiểm tra
+    if os.name == "nt" or host != socket.gethostname() or not pid.isdigit():
+        return None
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_chunk_store(root: str, legacy_pickle_path: str | None = None) -> ChunkStore:
+    """
+    Trả về ChunkStore dùng chung cho một thư mục (mỗi process một instance).
+    Lần đầu mở một kho rỗng mà còn file pickle cũ thì tự động chuyển đổi.
+    """
+    root = os.path.abspath(root)
+    with _stores_lock:
+        store = _stores.get(root)
+        if store is None:
+            store = ChunkStore(root)
+            _stores[root] = store
+            store.discard_stale_tmp()
+            first_open = not os.path.exists(store._manifest_path())
+            if first_open and legacy_pickle_path and os.path.exists(legacy_pickle_path):
+                print(f"📦 Chuyển đổi {legacy_pickle_path} sang kho chunk {root}")
+                store.import_legacy_pickle(legacy_pickle_path)
+    return store
@@ -0,0 +1,182 @@
+# context_packer.py: Xếp các chunk truy xuất được vào phần ngữ cảnh của prompt theo ngân sách token
+#
+#   - không tokenize lúc truy vấn: số token LLM của từng chunk và phần gối đầu (overlap của chunker)
+#     được tính một lần lúc ingest và lưu trong kho chunk (tokens.npy, xem chunk_store.py)
+#   - hai chunk liền nhau của cùng tài liệu được ghép thành một đoạn, bỏ phần đầu chunk sau đã có ở
+#     cuối chunk trước (các câu gối đầu overlap=50 token) nên câu không bị lặp trong prompt
+#   - chọn chunk theo thứ tự liên quan cho tới khi đầy ngân sách token (rag.context_budget: cửa sổ
+#     ngữ cảnh của model trừ khung prompt, câu hỏi và phần trả lời; CONTEXT_TOKEN_BUDGET giới hạn thêm)
+# Segment cũ chưa có tokens.npy: số token ước lượng theo số ký tự (CONTEXT_CHARS_PER_TOKEN),
+# phần gối đầu tìm bằng so khớp chuỗi.
+
+import os
+import re
+import itertools
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "0"))  # 0 = chỉ giới hạn theo cửa sổ ngữ cảnh
+CONTEXT_CHARS_PER_TOKEN = float(os.getenv("CONTEXT_CHARS_PER_TOKEN", "3"))
+# Phần gối đầu ngắn hơn số từ này coi là trùng ngẫu nhiên, không cắt
+OVERLAP_MIN_WORDS = 3
+OVERLAP_MAX_WORDS = 256
+# "\n---\n" giữa các đoạn trong build_prompt
+SEPARATOR_TOKENS = 3
+# Giữ lại đoạn đầu tiên (cắt bớt) khi ngân sách còn ít nhất chừng này token
+MIN_PARTIAL_TOKENS = 32
+
+_WORD = re.compile(r"\S+")
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, round(len(text) / CONTEXT_CHARS_PER_TOKEN)) if text else 0
+
+
+def overlap_prefix(previous: str, text: str, max_words: int = OVERLAP_MAX_WORDS) -> int:
+    """
+    Số ký tự đầu của text trùng phần cuối của previous (so theo từ, bỏ qua khác biệt khoảng trắng
+    vì chunk cuối section nối câu bằng dấu cách thay vì xuống dòng). 0 nếu không có phần gối đầu.
+    """
+    if not previous or not text:
+        return 0
+    tail = previous.split()[-max_words:]
+    spans = list(itertools.islice(_WORD.finditer(text), max_words))
+    head = [match.group() for match in spans]
+    last = tail[-1]
+    for k in range(min(len(tail), len(head)), OVERLAP_MIN_WORDS - 1, -1):
+        if head[k - 1] == last and head[:k] == tail[-k:]:
+            end = spans[k - 1].end()
+            return end + len(text[end:]) - len(text[end:].lstrip())
+    return 0
+
+
+def truncate_to_tokens(text: str, tokens: int, limit: int) -> str:
+    """Cắt text còn khoảng limit token theo tỉ lệ ký tự/token của chính nó, tại ranh giới từ."""
+    if tokens <= limit:
+        return text
+    cut = int(len(text) * limit / max(tokens, 1))
+    space = max(text.rfind(" ", 0, cut + 1), text.rfind("\n", 0, cut + 1))
+    return text[:space if space > 0 else cut].rstrip()
+
+
+class PackedContext:
+    """Kết quả xếp ngữ cảnh: các đoạn cho build_prompt và chunk ID đã dùng (theo thứ tự liên quan)."""
+
+    __slots__ = ("chunks", "chunk_ids", "tokens", "tokens_full", "tokens_deduplicated", "dropped", "budget")
+
+    def __init__(self, chunks, chunk_ids, tokens, tokens_full, tokens_deduplicated, dropped, budget):
+        self.chunks = chunks
+        self.chunk_ids = chunk_ids
+        self.tokens = tokens                            # token ngữ cảnh sau khi xếp (ước lượng theo số liệu ingest)
+        self.tokens_full = tokens_full                  # tổng token nếu nối nguyên các chunk như trước
+        self.tokens_deduplicated = tokens_deduplicated  # token gối đầu đã bỏ
+        self.dropped = dropped                          # số chunk không vừa ngân sách
+        self.budget = budget
+
+
+class _Chunk:
+    __slots__ = ("chunk_id", "index", "text", "tokens", "overlap_chars", "overlap_tokens", "truncated")
+
+    def __init__(self, chunk_id, index, text, stats):
+        self.chunk_id = chunk_id
+        self.index = index
+        self.text = text
+        self.truncated = False
+        if stats is not None:
+            self.tokens, self.overlap_chars, self.overlap_tokens = stats
+        else:
+            self.tokens, self.overlap_chars, self.overlap_tokens = estimate_tokens(text), None, None
+
+
+def _load(view, chunk_id):
+    if view is None or not view.has_id(chunk_id):
+        return None
+    return _Chunk(chunk_id, view.metadata_by_id(chunk_id)["chunk_index"], view.text_by_id(chunk_id),
+                  view.token_stats_by_id(chunk_id))
+
+
+def _overlap(chunk, previous):
+    """(ký tự, token) gối đầu của chunk với chunk liền trước; segment cũ thì so khớp chuỗi tại chỗ."""
+    if chunk.overlap_chars is None:
+        chunk.overlap_chars = overlap_prefix(previous.text, chunk.text)
+        chunk.overlap_tokens = min(chunk.tokens, estimate_tokens(chunk.text[:chunk.overlap_chars]))
+    return chunk.overlap_chars, chunk.overlap_tokens
+
+
+def pack_context(view, chunk_ids, budget: int | None = None, present=()) -> PackedContext:
+    """
+    Chọn và ghép các chunk (chunk_ids theo thứ tự liên quan giảm dần) trong budget token ngữ cảnh.
+    present: chunk ID đã có trong phần prompt trước đó (lượt trước của phiên) - không đưa lại, nhưng
+    chunk liền sau chúng vẫn được bỏ phần gối đầu.
+    """
+    if budget is not None and CONTEXT_TOKEN_BUDGET > 0:
+        budget = min(budget, CONTEXT_TOKEN_BUDGET)
+    elif budget is None and CONTEXT_TOKEN_BUDGET > 0:
+        budget = CONTEXT_TOKEN_BUDGET
+    known = {}
+    for chunk_id in present:
+        chunk = _load(view, chunk_id)
+        if chunk is not None:
+            known[chunk_id] = chunk
+    candidates = []
+    for chunk_id in dict.fromkeys(chunk_ids):
+        if chunk_id in known:
+            continue
+        chunk = _load(view, chunk_id)
+        if chunk is not None:
+            candidates.append(chunk)
+            known[chunk_id] = chunk
+
+    selected = {chunk_id: known[chunk_id] for chunk_id in present if chunk_id in known}
+    present = set(selected)
+
+    def joins(chunk, previous):
+        # Hai chunk liền nhau cùng tài liệu (ID liên tiếp, chunk sau không phải chunk đầu tài liệu)
+        return previous is not None and chunk.index > 0 and not (chunk.truncated or previous.truncated)
+
+    used = deduplicated = dropped = 0
+    picked = []
+    for chunk in candidates:
+        previous = selected.get(chunk.chunk_id - 1)
+        following = selected.get(chunk.chunk_id + 1)
+        after = joins(chunk, previous)
+        before = following is not None and following.chunk_id not in present and joins(following, chunk)
+        saved = (_overlap(chunk, previous)[1] if after else 0) + (_overlap(following, chunk)[1] if before else 0)
+        # Chunk đứng riêng thêm một dấu phân cách; nối vào đoạn có sẵn thì không
+        cost = chunk.tokens - saved + (0 if after or before else SEPARATOR_TOKENS)
+        if budget is not None and used + cost > budget:
+            remaining = budget - used - SEPARATOR_TOKENS
+            if picked or remaining < MIN_PARTIAL_TOKENS:
+                dropped += 1
+                continue
+            # Chunk liên quan nhất đã vượt ngân sách: giữ phần đầu của nó
+            chunk.text = truncate_to_tokens(chunk.text, chunk.tokens, remaining)
+            chunk.tokens, chunk.truncated, cost, saved = remaining, True, remaining + SEPARATOR_TOKENS, 0
+        selected[chunk.chunk_id] = chunk
+        picked.append(chunk)
+        used += cost
+        deduplicated += saved
+
+    # Ghép các chunk liền nhau thành đoạn; đoạn xếp theo chunk liên quan nhất trong đoạn
+    rank = {chunk.chunk_id: i for i, chunk in enumerate(picked)}
+    passages = []
+    for chunk in sorted(picked, key=lambda c: c.chunk_id):
+        previous = selected.get(chunk.chunk_id - 1)
+        if joins(chunk, previous):
+            text = chunk.text[_overlap(chunk, previous)[0]:].strip()
+            if previous.chunk_id in present:
+                passages.append([rank[chunk.chunk_id], text])
+            else:
+                passages[-1][0] = min(passages[-1][0], rank[chunk.chunk_id])
+                passages[-1][1] = (passages[-1][1] + "\n" + text).strip()
+            continue
+        passages.append([rank[chunk.chunk_id], chunk.text.strip()])
+    passages.sort(key=lambda p: p[0])
+
+    return PackedContext(
+        chunks=[text for _, text in passages if text],
+        chunk_ids=[chunk.chunk_id for chunk in picked],
+        tokens=used,
+        tokens_full=sum(chunk.tokens for chunk in candidates) + SEPARATOR_TOKENS * len(candidates),
+        tokens_deduplicated=deduplicated,
+        dropped=dropped,
+        budget=budget,
+    )
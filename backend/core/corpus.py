@@ -0,0 +1,148 @@
+# corpus.py: Ảnh chụp (snapshot) bất biến, có phiên bản, của kho truy xuất: FAISS index + ChunkStoreView
+#
+#   - build_snapshot() đọc FAISS index và mở view mmap của kho chunk "bên cạnh" bản đang phục vụ
+#   - reload() đưa việc dựng snapshot cho thread nền "corpus-reloader"; dựng xong thì publish bằng
+#     một phép gán tham chiếu duy nhất (_current), nên một truy vấn không bao giờ ghép index mới với view cũ
+#   - truy vấn đang chạy giữ snapshot đã lấy lúc bắt đầu (current()) tới khi xong
+#   - nhiều yêu cầu reload trong lúc đang dựng được gộp thành một lần dựng tiếp theo
+# Snapshot không được sửa sau khi publish (trừ tham số tìm kiếm nprobe/efSearch của index).
+
+import os
+import time
+import threading
+from concurrent.futures import Future
+
+from .chunk_store import get_chunk_store
+from . import vector_index
+
+FAISS_INDEX_PATH = os.getenv("FAISS_INDEX_PATH", "D:/Vian/Demo/backend/results/all_faiss.index")
+EMBEDDINGS_PICKLE_PATH = os.getenv("EMBEDDINGS_PICKLE_PATH", "D:/Vian/Demo/backend/results/all_embeddings.pkl")
+CHUNK_STORE_DIR = os.getenv("CHUNK_STORE_DIR", os.path.join(os.path.dirname(FAISS_INDEX_PATH), "chunk_store"))
+
+
+class CorpusSnapshot:
+    """Một phiên bản của kho truy xuất: index và view luôn đi cùng nhau."""
+
+    __slots__ = ("version", "index", "view", "built_at", "build_seconds")
+
+    def __init__(self, version: int, index=None, view=None, build_seconds: float = 0.0):
+        self.version = version
+        self.index = index
+        self.view = view
+        self.built_at = time.time()
+        self.build_seconds = build_seconds
+
+    @property
+    def empty(self) -> bool:
+        return self.index is None or self.view is None or len(self.view) == 0
+
+    def stats(self) -> dict:
+        return {
+            "version": self.version,
+            "chunks": 0 if self.view is None else len(self.view),
+            "documents": 0 if self.view is None else len(self.view.doc_names()),
+            "mode": vector_index.index_mode(self.index) if self.index is not None else None,
+            "build_seconds": round(self.build_seconds, 3),
+            "age_seconds": round(time.time() - self.built_at, 1),
+        }
+
+
+_current = CorpusSnapshot(0)
+_version = 0
+_loaded = False  # đã publish ít nhất một snapshot đọc từ đĩa
+_search_params = {"nprobe": None, "ef_search": None}  # Ghi đè tham số tìm kiếm lúc chạy
+_listeners = []
+
+_reload_lock = threading.Lock()
+_pending = None  # Future của lần dựng kế tiếp (chưa bắt đầu)
+_reloader = None
+
+
+def current() -> CorpusSnapshot:
+    """Snapshot đang phục vụ; lấy một lần ở đầu truy vấn rồi dùng cho cả truy vấn."""
+    return _current
+
+
+def version() -> int:
+    return _current.version
+
+
+def is_loaded() -> bool:
+    return _loaded
+
+
+def on_publish(callback) -> None:
+    """Đăng ký hàm gọi sau mỗi lần publish snapshot mới (vd. xóa cache truy xuất)."""
+    _listeners.append(callback)
+
+
+def set_search_params(nprobe: int | None = None, ef_search: int | None = None) -> dict:
+    """Tham số tìm kiếm áp dụng cho snapshot hiện tại và mọi snapshot dựng sau."""
+    if nprobe is not None:
+        _search_params["nprobe"] = nprobe
+    if ef_search is not None:
+        _search_params["ef_search"] = ef_search
+    if _current.index is not None:
+        vector_index.configure_search(_current.index, **_search_params)
+    return dict(_search_params)
+
+
+def build_snapshot(version: int) -> CorpusSnapshot:
+    """Đọc index + mở view mới; không đụng tới snapshot đang phục vụ."""
+    started = time.perf_counter()
+    # Giữ khóa của thread ghi: view và file index cùng một thời điểm, load_index dựng lại/ghi file an toàn
+    with vector_index.index_lock:
+        view = get_chunk_store(CHUNK_STORE_DIR, legacy_pickle_path=EMBEDDINGS_PICKLE_PATH).view()
+        index = vector_index.load_index(FAISS_INDEX_PATH, view) if len(view) > 0 else None
+    if index is None:
+        view = None
+    else:
+        vector_index.configure_search(index, **_search_params)
+    return CorpusSnapshot(version, index, view, time.perf_counter() - started)
+
+
+def _publish(snapshot: CorpusSnapshot) -> None:
+    global _current, _loaded
+    _current = snapshot  # phép gán duy nhất: truy vấn mới thấy trọn vẹn bản mới
+    _loaded = True
+    for callback in _listeners:
+        try:
+            callback(snapshot)
+        except Exception as e:
+            print(f"Lỗi sau khi publish snapshot v{snapshot.version}: {str(e)}")
+    print(f"📚 Snapshot kho v{snapshot.version}: {snapshot.stats()['chunks']} chunk, dựng trong {snapshot.build_seconds:.2f}s")
+
+
+def _reload_loop() -> None:
+    global _pending, _reloader, _version
+    while True:
+        with _reload_lock:
+            future, _pending = _pending, None
+            if future is None:
+                _reloader = None
+                return
+            _version += 1
+            next_version = _version
+        try:
+            snapshot = build_snapshot(next_version)
+            _publish(snapshot)
+            future.set_result(snapshot)
+        except Exception as e:
+            print(f"Lỗi khi dựng snapshot kho: {str(e)}")
+            future.set_exception(e)
+
+
+def reload(wait: bool = True):
+    """
+    Yêu cầu dựng snapshot mới trên thread nền. Truy vấn vẫn chạy trên snapshot cũ trong lúc dựng.
+    wait=True: chờ tới khi snapshot (gồm mọi thay đổi trước lời gọi này) được publish và trả về nó.
+    """
+    global _pending, _reloader
+    with _reload_lock:
+        if _pending is None:
+            _pending = Future()
+        future = _pending
+        if _reloader is None:
+            _reloader = threading.Thread(target=_reload_loop, name="corpus-reloader", daemon=True)
+            _reloader.start()
+    return future.result() if wait else future
@@ -0,0 +1,127 @@
+# embed_engine.py: Embed chunk theo lô gom theo độ dài token (thay cho model.encode mặc định)
+#
+# Chunk dài từ vài token tới 512 token; lô cố định 32 chunk bị padding theo chunk dài nhất nên
+# phần lớn phép tính trên CPU là vô ích. Engine:
+#   - sắp chunk theo số token (lấy từ chunker nếu có, không thì tokenize nhanh theo lô)
+#   - gom lô sao cho (số chunk x độ dài dài nhất) <= EMBED_TOKEN_BUDGET, tối đa EMBED_MAX_BATCH chunk
+#   - chạy embed_batch() của backend embedding (torch/onnx, xem embedding_backend.py) cho từng lô
+#     rồi trả kết quả về đúng thứ tự ban đầu
+#   - EMBED_THREADS đặt số thread intra-op; EMBED_PROCESSES > 1 dùng pool nhiều process (chỉ backend torch)
+# Mỗi lần encode in thống kê chunks/s và tỉ lệ padding để chỉnh ngân sách token cho từng máy.
+
+import os
+import time
+import atexit
+import threading
+
+import numpy as np
+import torch
+
+EMBED_TOKEN_BUDGET = int(os.getenv("EMBED_TOKEN_BUDGET", "16384"))
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "128"))
+# 0 = để torch tự chọn (mặc định bằng số core vật lý)
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", "0"))
+EMBED_PROCESSES = int(os.getenv("EMBED_PROCESSES", "1"))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def configure_threads(threads=None) -> None:
+    """Đặt số thread intra-op của torch theo EMBED_THREADS (0 = giữ mặc định của torch)."""
+    threads = EMBED_THREADS if threads is None else threads
+    if threads > 0 and torch.get_num_threads() != threads:
+        torch.set_num_threads(threads)
+
+
+def count_tokens(tokenizer, chunks, max_length):
+    """Số token (kể cả token đặc biệt, cắt ở max_length) của từng chunk, tokenize nhanh theo lô."""
+    encoded = tokenizer(
+        list(chunks),
+        truncation=True,
+        max_length=max_length,
+        return_attention_mask=False,
+        return_token_type_ids=False,
+    )
+    return [len(ids) for ids in encoded["input_ids"]]
+
+
+def plan_batches(lengths, token_budget=None, max_batch=None):
+    """
+    Chia chỉ số chunk thành các lô: sắp giảm dần theo độ dài, thêm chunk vào lô khi
+    (số chunk + 1) x độ dài dài nhất của lô vẫn <= token_budget.
+    """
+    token_budget = token_budget or EMBED_TOKEN_BUDGET
+    max_batch = max_batch or EMBED_MAX_BATCH
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches = []
+    batch = []
+    longest = 0
+    for i in order:
+        if batch and (len(batch) + 1 > max_batch or (len(batch) + 1) * longest > token_budget):
+            batches.append(batch)
+            batch = []
+        if not batch:
+            longest = max(lengths[i], 1)
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _get_pool(model, processes):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = model.start_multi_process_pool(["cpu"] * processes)
+            atexit.register(model.stop_multi_process_pool, _pool)
+        return _pool
+
+
+def encode_chunks(backend, chunks, token_counts=None, token_budget=None, max_batch=None, processes=None, stats=None):
+    """
+    Embed danh sách chunk, trả về ma trận float32 [len(chunks), dim] đúng thứ tự đầu vào.
+    token_counts: số token của từng chunk do chunker tính sẵn (bỏ qua bước tokenize đếm độ dài).
+    stats: dict (nếu truyền) nhận thống kê số lô, tỉ lệ padding, chunks/s.
+    """
+    processes = EMBED_PROCESSES if processes is None else processes
+    started = time.perf_counter()
+    chunks = list(chunks)
+    if not chunks:
+        return np.zeros((0, backend.dimension), dtype=np.float32)
+    max_length = backend.max_seq_length
+    if token_counts is None:
+        lengths = count_tokens(backend.tokenizer, chunks, max_length)
+    else:
+        # Số token từ chunker chưa gồm token đặc biệt <s>, </s>
+        lengths = [min(int(n) + 2, max_length) for n in token_counts]
+    batches = plan_batches(lengths, token_budget, max_batch)
+
+    output = np.empty((len(chunks), backend.dimension), dtype=np.float32)
+    if processes > 1 and backend.name == "torch":
+        model = backend.model
+        order = [i for batch in batches for i in batch]
+        batch_size = max(1, len(order) // len(batches))
+        output[order] = model.encode_multi_process([chunks[i] for i in order], _get_pool(model, processes), batch_size=batch_size)
+    else:
+        if backend.name == "torch":
+            configure_threads()
+        for batch in batches:
+            output[batch] = backend.embed_batch([chunks[i] for i in batch])
+
+    if stats is None:
+        return output
+    seconds = time.perf_counter() - started
+    padded = sum(len(batch) * lengths[batch[0]] for batch in batches)
+    stats.update({
+        "chunks": len(chunks),
+        "batches": len(batches),
+        "tokens": int(sum(lengths)),
+        "padding_ratio": round(1 - sum(lengths) / padded, 3) if padded else 0.0,
+        "seconds": round(seconds, 3),
+        "chunks_per_second": round(len(chunks) / seconds, 2) if seconds else None,
+        "backend": backend.name,
+        "threads": torch.get_num_threads(),
+        "processes": processes if backend.name == "torch" else 1,
+    })
+    return output
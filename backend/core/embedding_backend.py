@@ -0,0 +1,227 @@
+# embedding_backend.py: Backend suy luận cho model embedding (e5) với một giao diện chung
+#
+#   - "torch": SentenceTransformer chạy PyTorch eager (như trước)
+#   - "onnx":  export model sang ONNX một lần (lưu trong EMBEDDING_ONNX_DIR) rồi chạy bằng ONNX Runtime,
+#              tùy chọn lượng tử hóa động int8 (EMBEDDING_ONNX_QUANTIZE=int8) cho CPU
+# Chọn bằng EMBEDDING_BACKEND. Cả hai có cùng các thuộc tính/phương thức mà code dùng:
+#   tokenizer, max_seq_length, dimension, encode(texts, batch_size), embed_batch(texts), memory_bytes()
+# Pooling/Normalize được đọc từ cấu hình SentenceTransformer của model nên vector của hai backend tương đương.
+
+import os
+import json
+import time
+
+import numpy as np
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch").lower()
+EMBEDDING_ONNX_DIR = os.getenv("EMBEDDING_ONNX_DIR", os.path.join(BASE_DIR, "models", "onnx"))
+# "" = float32, "int8" = lượng tử hóa động trọng số MatMul sang int8
+EMBEDDING_ONNX_QUANTIZE = os.getenv("EMBEDDING_ONNX_QUANTIZE", "").lower()
+EMBEDDING_ONNX_OPSET = int(os.getenv("EMBEDDING_ONNX_OPSET", "17"))
+# Số thread intra-op của ONNX Runtime (0 = mặc định của ORT)
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", "0"))
+
+
+class TorchEmbeddingBackend:
+    """SentenceTransformer chạy bằng PyTorch."""
+
+    name = "torch"
+
+    def __init__(self, model_path: str, device: str | None = None):
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_path, device=device)
+        self.model.eval()
+        self.tokenizer = self.model.tokenizer
+        self.max_seq_length = self.model.max_seq_length
+        self.dimension = self.model.get_sentence_embedding_dimension()
+
+    def memory_bytes(self) -> int:
+        return sum(t.numel() * t.element_size() for t in list(self.model.parameters()) + list(self.model.buffers()))
+
+    def embed_batch(self, texts) -> np.ndarray:
+        """Embed một lô đã gom sẵn (không chia nhỏ, không sắp xếp lại)."""
+        import torch
+
+        features = self.model.tokenize(list(texts))
+        features = {k: v.to(self.model.device) if hasattr(v, "to") else v for k, v in features.items()}
+        with torch.inference_mode():
+            return self.model(features)["sentence_embedding"].float().cpu().numpy()
+
+    def encode(self, texts, batch_size: int = 32, show_progress_bar: bool = False) -> np.ndarray:
+        return np.asarray(
+            self.model.encode(list(texts), batch_size=batch_size, show_progress_bar=show_progress_bar),
+            dtype=np.float32,
+        )
+
+
+def _pooling_config(model_path: str) -> tuple[str, bool]:
+    """Đọc kiểu pooling (mean/cls) và có Normalize hay không từ modules.json của SentenceTransformer."""
+    pooling, normalize = "mean", False
+    modules_path = os.path.join(model_path, "modules.json")
+    if not os.path.exists(modules_path):
+        return pooling, normalize
+    with open(modules_path, "r", encoding="utf-8") as f:
+        modules = json.load(f)
+    for module in modules:
+        kind = module.get("type", "")
+        if kind.endswith("Pooling"):
+            with open(os.path.join(model_path, module["path"], "config.json"), "r", encoding="utf-8") as f:
+                config = json.load(f)
+            if config.get("pooling_mode_cls_token"):
+                pooling = "cls"
+        elif kind.endswith("Normalize"):
+            normalize = True
+    return pooling, normalize
+
+
+def onnx_model_path(model_path: str, quantize: str | None = None) -> str:
+    quantize = EMBEDDING_ONNX_QUANTIZE if quantize is None else quantize
+    name = os.path.basename(os.path.normpath(model_path))
+    return os.path.join(EMBEDDING_ONNX_DIR, name, "model_int8.onnx" if quantize == "int8" else "model.onnx")
+
+
+def _HiddenStateModule(transformer):
+    """Bọc transformer để export chỉ nhận input_ids/attention_mask và chỉ trả last_hidden_state."""
+    import torch
+
+    class HiddenState(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.transformer = transformer
+
+        def forward(self, input_ids, attention_mask):
+            return self.transformer(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
+    return HiddenState()
+
+
+def export_onnx(model_path: str, quantize: str | None = None) -> str:
+    """
+    Export transformer của model sang ONNX (trục batch/độ dài động), lượng tử hóa int8 nếu cần.
+    Trả về đường dẫn file .onnx; bỏ qua nếu file đã tồn tại.
+    """
+    import torch
+    from transformers import AutoModel
+
+    quantize = EMBEDDING_ONNX_QUANTIZE if quantize is None else quantize
+    target = onnx_model_path(model_path, quantize)
+    if os.path.exists(target):
+        return target
+    fp32_path = onnx_model_path(model_path, "")
+    os.makedirs(os.path.dirname(fp32_path), exist_ok=True)
+    if not os.path.exists(fp32_path):
+        started = time.perf_counter()
+        transformer = _HiddenStateModule(AutoModel.from_pretrained(model_path))
+        transformer.eval()
+        # Mẫu có padding để đồ thị giữ nhánh xử lý attention_mask
+        dummy = (torch.ones((2, 8), dtype=torch.long), torch.tensor([[1] * 8, [1] * 5 + [0] * 3], dtype=torch.long))
+        tmp_path = fp32_path + ".tmp"
+        with torch.no_grad():
+            torch.onnx.export(
+                transformer,
+                dummy,
+                tmp_path,
+                input_names=["input_ids", "attention_mask"],
+                output_names=["last_hidden_state"],
+                dynamic_axes={
+                    "input_ids": {0: "batch", 1: "sequence"},
+                    "attention_mask": {0: "batch", 1: "sequence"},
+                    "last_hidden_state": {0: "batch", 1: "sequence"},
+                },
+                opset_version=EMBEDDING_ONNX_OPSET,
+                dynamo=False,
+            )
+        os.replace(tmp_path, fp32_path)
+        print(f"📦 Đã export {model_path} sang ONNX ({time.perf_counter() - started:.1f}s): {fp32_path}")
+    if quantize == "int8":
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        tmp_path = target + ".tmp"
+        quantize_dynamic(fp32_path, tmp_path, weight_type=QuantType.QInt8)
+        os.replace(tmp_path, target)
+        print(f"📦 Đã lượng tử hóa int8: {target}")
+    return target
+
+
+class OnnxEmbeddingBackend:
+    """Transformer chạy bằng ONNX Runtime, pooling/normalize bằng numpy."""
+
+    name = "onnx"
+
+    def __init__(self, model_path: str, quantize: str | None = None, threads: int | None = None):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        self.quantize = EMBEDDING_ONNX_QUANTIZE if quantize is None else quantize
+        self.path = export_onnx(model_path, self.quantize)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        self.pooling, self.normalize = _pooling_config(model_path)
+        self.max_seq_length = self._read_max_seq_length(model_path)
+
+        options = ort.SessionOptions()
+        threads = EMBED_THREADS if threads is None else threads
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(self.path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.dimension = int(self.embed_batch(["warmup"]).shape[1])
+
+    def memory_bytes(self) -> int:
+        return os.path.getsize(self.path)
+
+    def _read_max_seq_length(self, model_path: str) -> int:
+        config_path = os.path.join(model_path, "sentence_bert_config.json")
+        if os.path.exists(config_path):
+            with open(config_path, "r", encoding="utf-8") as f:
+                max_len = json.load(f).get("max_seq_length")
+            if max_len:
+                return int(max_len)
+        return int(min(self.tokenizer.model_max_length, 512))
+
+    def embed_batch(self, texts) -> np.ndarray:
+        encoded = self.tokenizer(
+            list(texts),
+            padding=True,
+            truncation=True,
+            max_length=self.max_seq_length,
+            return_tensors="np",
+        )
+        feeds = {k: v.astype(np.int64) for k, v in encoded.items() if k in self.input_names}
+        hidden = self.session.run(None, feeds)[0]
+        if self.pooling == "cls":
+            vectors = hidden[:, 0]
+        else:
+            mask = encoded["attention_mask"][..., None].astype(np.float32)
+            vectors = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if self.normalize:
+            vectors = vectors / np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+        return vectors.astype(np.float32)
+
+    def encode(self, texts, batch_size: int = 32, show_progress_bar: bool = False) -> np.ndarray:
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+        # Sắp theo độ dài như SentenceTransformer.encode để giảm padding, rồi trả lại thứ tự gốc
+        order = np.argsort([-len(t) for t in texts], kind="stable")
+        output = np.empty((len(texts), self.dimension), dtype=np.float32)
+        for start in range(0, len(texts), batch_size):
+            batch = order[start:start + batch_size]
+            output[batch] = self.embed_batch([texts[i] for i in batch])
+        return output
+
+
+def load_embedding_backend(model_path: str, backend: str | None = None, **kwargs):
+    """Tạo backend embedding theo tên (mặc định EMBEDDING_BACKEND)."""
+    backend = (backend or EMBEDDING_BACKEND).lower()
+    started = time.perf_counter()
+    if backend == "torch":
+        instance = TorchEmbeddingBackend(model_path, **kwargs)
+    elif backend == "onnx":
+        instance = OnnxEmbeddingBackend(model_path, **kwargs)
+    else:
+        raise ValueError(f"EMBEDDING_BACKEND không hợp lệ: {backend} (torch | onnx)")
+    print(f"🔤 Đã nạp model embedding ({instance.name}) trong {time.perf_counter() - started:.1f}s")
+    return instance
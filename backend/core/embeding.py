@@ -1,21 +1,20 @@
 # embedding.py: Script để embed PDF vào vector store cho RAG
 
 import os
-import torch
-import fitz  # PyMuPDF
-import pytesseract
-from PIL import Image, ImageEnhance, ImageFilter
-import io
 from datetime import datetime
 import numpy as np
-from sentence_transformers import SentenceTransformer
-import pickle
 import re
-from underthesea import sent_tokenize
-from transformers import AutoTokenizer
-import faiss
 from dotenv import load_dotenv
 import unicodedata
+import threading
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from .chunk_store import get_chunk_store
+from . import vector_index
+from .context_packer import overlap_prefix
+from .model_registry import get_embedding_model, get_embedding_tokenizer, get_llm_tokenizer
 
 load_dotenv()
 
@@ -25,12 +24,15 @@ DEFAULT_DATA_DIR = os.path.join(BASE_DIR, "results")
 
 EMBEDDING_MODEL_PATH = os.getenv("EMBEDDING_MODEL_PATH", "D:/Vian/Step2_Embeding_and_VectorDB/models/multilingual_e5_large")
 FAISS_INDEX_PATH = os.getenv("FAISS_INDEX_PATH", os.path.join(DEFAULT_DATA_DIR, "all_faiss.index"))
+# Chỉ còn dùng để chuyển đổi dữ liệu cũ sang kho chunk
 EMBEDDINGS_PICKLE_PATH = os.getenv("EMBEDDINGS_PICKLE_PATH", os.path.join(DEFAULT_DATA_DIR, "all_embeddings.pkl"))
+CHUNK_STORE_DIR = os.getenv("CHUNK_STORE_DIR", os.path.join(os.path.dirname(FAISS_INDEX_PATH), "chunk_store"))
 OUTPUT_DIR = os.getenv("OUTPUT_DIR", DEFAULT_DATA_DIR)
-
-# Load models
-model = SentenceTransformer(EMBEDDING_MODEL_PATH)
-tokenizer = AutoTokenizer.from_pretrained(EMBEDDING_MODEL_PATH)
+# Chunker: số process tách câu song song (1 = tuần tự) và độ dài văn bản tối thiểu (ký tự) để dùng process
+CHUNKER_WORKERS = int(os.getenv("CHUNKER_WORKERS", "1"))
+CHUNKER_PARALLEL_MIN_CHARS = int(os.getenv("CHUNKER_PARALLEL_MIN_CHARS", "200000"))
+# Số câu mỗi lần gọi tokenizer theo lô
+TOKENIZE_BATCH_SIZE = int(os.getenv("TOKENIZE_BATCH_SIZE", "2048"))
 
 
 def normalize_filename(filename: str) -> str:
@@ -58,43 +60,52 @@ def normalize_filename(filename: str) -> str:
     # Ghép lại với đuôi file
     return ascii_name + ext
 
+# Index toàn cục phía ghi: đọc từ đĩa một lần rồi cập nhật tăng dần trong bộ nhớ
+_global_index = None
+_global_index_loaded = False
+_global_index_lock = vector_index.index_lock  # cùng khóa với thread reload khi nó dựng lại file index
+
+
+def chunk_store():
+    return get_chunk_store(CHUNK_STORE_DIR, legacy_pickle_path=EMBEDDINGS_PICKLE_PATH)
+
+
+def _writer_index():
+    global _global_index, _global_index_loaded
+    if not _global_index_loaded:
+        _global_index = vector_index.load_index(FAISS_INDEX_PATH, chunk_store().view())
+        _global_index_loaded = True
+    return _global_index
+
 def is_pdf_embedded(pdf_path):
-    if not os.path.exists(EMBEDDINGS_PICKLE_PATH):
-        return False
     pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
-    with open(EMBEDDINGS_PICKLE_PATH, 'rb') as f:
-        all_data = pickle.load(f)
-    existing_pdf_names = {entry['pdf_name'] for entry in all_data}
-    return pdf_name in existing_pdf_names
-
-def preprocess_image(img):
-    if img.mode != 'L':
-        img = img.convert('L')
-    enhancer = ImageEnhance.Contrast(img)
-    img = enhancer.enhance(1.5)
-    return img.filter(ImageFilter.SHARPEN)
-
-def ocr_pdf_to_text(pdf_path, output_dir):
+    return chunk_store().has_doc(pdf_name)
+
+def ocr_pdf_to_text(pdf_path, output_dir, workers=None, page_timeout=None):
+    """
+    Trích text toàn bộ PDF: trang có lớp text tốt lấy trực tiếp, trang scan/lỗi font thì
+    OCR song song trên OCR_WORKERS process; ghép lại theo thứ tự trang và lưu vào
+    {pdf_name}_ocr.txt. Cách trích từng trang được ghi vào {pdf_name}_pages.json.
+    """
+    from .ocr import extract_pages  # import lười: fitz/pytesseract chỉ cần khi ingest
+
     print(f"📖 Đang OCR file: {pdf_path}")
-    doc = fitz.open(pdf_path)
-    full_text = ""
-    ocr_config = r'--oem 3 --psm 6 -l vie+eng'
-    for page_num in range(len(doc)):
-        page = doc.load_page(page_num)
-        pix = page.get_pixmap(matrix=fitz.Matrix(2.5, 2.5))
-        img = Image.open(io.BytesIO(pix.tobytes("png")))
-        img = preprocess_image(img)
-        page_text = pytesseract.image_to_string(img, config=ocr_config)
-        full_text += page_text.strip()
-    doc.close()
+    texts, pages_info = extract_pages(pdf_path, workers=workers, page_timeout=page_timeout)
+    full_text = "".join(texts)
     pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
     output_path = os.path.join(output_dir, pdf_name, f"{pdf_name}_ocr.txt")
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
     with open(output_path, "w", encoding="utf-8") as f:
         f.write(full_text)
+    with open(os.path.join(output_dir, pdf_name, f"{pdf_name}_pages.json"), "w", encoding="utf-8") as f:
+        json.dump(pages_info, f, ensure_ascii=False, indent=2)
     return full_text
 
-def clean_text(text, pdf_path, output_dir):
+def clean_text_fragment(text):
+    """
+    Các bước làm sạch của clean_text (chưa strip). Không bước nào xóa hay nối qua hai ký tự
+    chữ/số liền nhau, nên làm sạch từng đoạn cắt giữa hai ký tự \\w cho kết quả như làm sạch cả văn bản.
+    """
     text = re.sub(r'[^\w\s.,;:()\[\]?!\"\'\-–—…°%‰≥≤→←≠=+/*<>\n\r]', '', text)
     text = re.sub(r'-\n', '', text)
     text = re.sub(r'\n(?=\w)', ' ', text)
@@ -102,7 +113,10 @@ def clean_text(text, pdf_path, output_dir):
     text = re.sub(r'\n\s*\n', '\n\n', text)
     text = re.sub(r'[ \t]+', ' ', text)
     text = re.sub(r' *\n *', '\n', text)
-    clean_text_val = text.strip()
+    return text
+
+def clean_text(text, pdf_path, output_dir):
+    clean_text_val = clean_text_fragment(text).strip()
     pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
     output_path = os.path.join(output_dir, pdf_name, f"{pdf_name}_clean.txt")
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
@@ -110,83 +124,231 @@ def clean_text(text, pdf_path, output_dir):
         f.write(clean_text_val)
     return clean_text_val
 
+SECTION_PATTERN = re.compile(r'\n(?=(?:[IVXLCDM]+\.)|(?:\d+\.)|(?:[a-z]\)))')
+
 def split_sections(text):
-    return [s.strip() for s in re.split(r'\n(?=(?:[IVXLCDM]+\.)|(?:\d+\.)|(?:[a-z]\)))', text) if s.strip()]
+    return [s.strip() for s in SECTION_PATTERN.split(text) if s.strip()]
+
+_sentence_pool = None
+_sentence_pool_lock = threading.Lock()
+
+def sent_tokenize(text):
+    """underthesea.sent_tokenize, import lười để import module này không kéo theo underthesea."""
+    from underthesea import sent_tokenize as _sent_tokenize
 
-def split_text_to_chunks_vi_tokenized_with_section(text, chunk_size=512, overlap=50):
+    return _sent_tokenize(text)
+
+def token_lengths(sentences, tokenizer=None):
+    """
+    Số token của từng câu (giống len(tokenizer.tokenize(câu))), tính bằng tokenizer nhanh theo lô
+    thay vì gọi tokenize() cho từng câu. Mặc định dùng tokenizer của e5 (chunker).
+    """
+    tokenizer = tokenizer or get_embedding_tokenizer()
+    if not getattr(tokenizer, "is_fast", False):
+        return [len(tokenizer.tokenize(s)) for s in sentences]
+    lengths = []
+    for start in range(0, len(sentences), TOKENIZE_BATCH_SIZE):
+        encoded = tokenizer(
+            sentences[start:start + TOKENIZE_BATCH_SIZE],
+            add_special_tokens=False,
+            return_attention_mask=False,
+            return_token_type_ids=False,
+            verbose=False,
+        )
+        lengths.extend(len(ids) for ids in encoded["input_ids"])
+    return lengths
+
+def segment_sections(sections, workers=None):
+    """
+    Tách câu (underthesea.sent_tokenize) cho từng section. Văn bản đủ dài và workers > 1 thì
+    chạy trên một process pool dùng chung (tạo lần đầu khi cần).
+    """
+    global _sentence_pool
+    workers = CHUNKER_WORKERS if workers is None else workers
+    if workers <= 1 or len(sections) < 2 or sum(len(s) for s in sections) < CHUNKER_PARALLEL_MIN_CHARS:
+        return [sent_tokenize(section) for section in sections]
+    with _sentence_pool_lock:
+        if _sentence_pool is None:
+            # spawn: process con không kế thừa bộ nhớ/thread của server và không nạp model embedding
+            _sentence_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    return list(_sentence_pool.map(sent_tokenize, sections, chunksize=max(1, len(sections) // (workers * 4))))
+
+_token_stats_failed = False
+
+def chunk_token_stats(chunks, previous=None):
+    """
+    Số liệu cho bộ xếp ngữ cảnh (context_packer.py), tính một lần lúc ingest bằng tokenizer của LLM:
+    (số token, số ký tự gối đầu, số token gối đầu) của từng chunk; phần gối đầu là đoạn đầu chunk trùng
+    cuối chunk liền trước (previous: chunk cuối của lô trước cùng tài liệu).
+    Trả về None nếu không nạp được tokenizer LLM (kho ghi -1, lúc truy vấn ước lượng theo số ký tự).
+    """
+    global _token_stats_failed
+    if _token_stats_failed:
+        return None
+    try:
+        tokenizer = get_llm_tokenizer()
+    except Exception as e:
+        _token_stats_failed = True
+        print(f"⚠️ Không nạp được tokenizer LLM, bỏ qua số token của chunk: {str(e)}")
+        return None
+    overlaps = []
+    for chunk in chunks:
+        overlaps.append(overlap_prefix(previous, chunk))
+        previous = chunk
+    tails = [(i, chunk[chars:]) for i, (chunk, chars) in enumerate(zip(chunks, overlaps)) if chars]
+    counts = token_lengths(list(chunks) + [tail for _, tail in tails], tokenizer)
+    tail_counts = dict(zip((i for i, _ in tails), counts[len(chunks):]))
+    return [
+        (tokens, chars, max(0, tokens - tail_counts[i]) if chars else 0)
+        for i, (tokens, chars) in enumerate(zip(counts[:len(chunks)], overlaps))
+    ]
+
+class SectionChunker:
+    """
+    Gom các câu của một section thành chunk (tối đa chunk_size token, gối đầu overlap token),
+    nhận từng câu một để pipeline có thể chunk trong lúc văn bản còn đang được OCR.
+    Số token của từng câu được giữ lại nên khi dựng phần gối đầu không phải tokenize lại.
+    """
+
+    def __init__(self, chunk_size=512, overlap=50):
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        self.current_chunk = []
+        self.current_lengths = []
+        self.current_tokens = 0
+        # Số token (tổng theo câu) của từng chunk đã trả ra, để engine embed gom lô không phải tokenize lại
+        self.chunk_tokens = []
+
+    def add(self, sentence, num_tokens=None):
+        """Thêm một câu (kèm số token nếu đã tính); trả về danh sách chunk vừa hoàn chỉnh."""
+        if num_tokens is None:
+            num_tokens = len(get_embedding_tokenizer().tokenize(sentence))
+        if self.current_tokens + num_tokens > self.chunk_size:
+            chunk_text = '\n'.join(self.current_chunk).strip()
+            # Lấy các câu cuối (tổng <= overlap token) làm phần gối đầu cho chunk sau
+            keep = 0
+            total = 0
+            for toks in reversed(self.current_lengths):
+                if total + toks > self.overlap:
+                    break
+                keep += 1
+                total += toks
+            start = len(self.current_chunk) - keep
+            self.chunk_tokens.append(self.current_tokens)
+            self.current_chunk = self.current_chunk[start:] + [sentence]
+            self.current_lengths = self.current_lengths[start:] + [num_tokens]
+            self.current_tokens = total + num_tokens
+            return [chunk_text]
+        self.current_chunk.append(sentence)
+        self.current_lengths.append(num_tokens)
+        self.current_tokens += num_tokens
+        return []
+
+    def add_many(self, sentences):
+        """Thêm nhiều câu, tokenize theo lô; trả về các chunk hoàn chỉnh."""
+        chunks = []
+        for sentence, num_tokens in zip(sentences, token_lengths(sentences)):
+            chunks.extend(self.add(sentence, num_tokens))
+        return chunks
+
+    def finish(self):
+        """Kết thúc section; trả về chunk cuối (nếu còn)."""
+        if self.current_chunk:
+            self.chunk_tokens.append(self.current_tokens)
+            return [' '.join(self.current_chunk).strip()]
+        return []
+
+def split_text_to_chunks_vi_tokenized_with_section(text, chunk_size=512, overlap=50, workers=None):
     sections = split_sections(text)
+    sentences_per_section = segment_sections(sections, workers)
+    # Tokenize mọi câu của văn bản theo lô một lần
+    lengths = iter(token_lengths([s for sentences in sentences_per_section for s in sentences]))
     all_chunks = []
-    for section in sections:
-        sentences = sent_tokenize(section)
-        current_chunk = []
-        current_tokens = 0
+    for sentences in sentences_per_section:
+        chunker = SectionChunker(chunk_size, overlap)
         for sentence in sentences:
-            num_tokens = len(tokenizer.tokenize(sentence))
-            if current_tokens + num_tokens > chunk_size:
-                chunk_text = '\n'.join(current_chunk).strip()
-                all_chunks.append(chunk_text)
-                overlap_chunk = []
-                total = 0
-                for s in reversed(current_chunk):
-                    toks = len(tokenizer.tokenize(s))
-                    if total + toks > overlap:
-                        break
-                    overlap_chunk.insert(0, s)
-                    total += toks
-                current_chunk = overlap_chunk + [sentence]
-                current_tokens = total + num_tokens
-            else:
-                current_chunk.append(sentence)
-                current_tokens += num_tokens
-        if current_chunk:
-            all_chunks.append(' '.join(current_chunk).strip())
+            all_chunks.extend(chunker.add(sentence, next(lengths)))
+        all_chunks.extend(chunker.finish())
     return all_chunks
 
-def create_embeddings(chunks):
-    return model.encode(chunks, show_progress_bar=True)
+def create_embeddings(chunks, show_progress_bar=True, token_counts=None):
+    """
+    Embed các chunk bằng engine gom lô theo độ dài token (xem core/embed_engine.py).
+    token_counts: số token từng chunk do SectionChunker tính sẵn (nếu có).
+    """
+    from .embed_engine import encode_chunks  # import lười: torch chỉ cần khi embed
+
+    stats = {}
+    embeddings = encode_chunks(get_embedding_model(), chunks, token_counts=token_counts, stats=stats)
+    if show_progress_bar and stats:
+        print(
+            f"🧮 Embed {stats['chunks']} chunk / {stats['batches']} lô trong {stats['seconds']}s "
+            f"({stats['chunks_per_second']} chunk/s, padding {stats['padding_ratio']:.0%})"
+        )
+    return embeddings
+
+def _commit_document(doc, embeddings=None):
+    """
+    Đưa tài liệu vừa ghi vào kho chunk lên FAISS index toàn cục và lưu index.
+    embeddings=None: đọc vector của tài liệu từ mmap của kho (không giữ bản sao trong RAM).
+    Gọi khi đang giữ _global_index_lock.
+    """
+    global _global_index
+    index = _writer_index()
+    view = chunk_store().view()
+    if embeddings is None:
+        embeddings = view.doc_embeddings(doc["pdf_name"])
+    if doc["replaced"] and not vector_index.supports_remove(index):
+        # Index không hỗ trợ xóa (HNSW): dựng lại từ kho, đã gồm tài liệu mới
+        _global_index = vector_index.build_from_view(view)
+    else:
+        # Nhúng lại tài liệu đã có: gỡ dải ID cũ trước khi thêm dải ID mới
+        for old_doc in doc["replaced"]:
+            index = vector_index.remove_document(index, old_doc["first_id"], old_doc["count"], view)
+        _global_index = vector_index.add_document(index, embeddings, doc["first_id"], view)
+    vector_index.save_index(_global_index, FAISS_INDEX_PATH)
 
 def save_embeddings(chunks, embeddings, pdf_path, output_dir):
     pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
     os.makedirs(os.path.join(output_dir, pdf_name), exist_ok=True)
-    data = {
-        'pdf_name': pdf_name,
-        'chunks': chunks,
-        'embeddings': embeddings,
-        'created_at': datetime.now().isoformat()
-    }
-    pickle_path = os.path.join(output_dir, pdf_name, f"{pdf_name}_embeddings.pkl")
-    with open(pickle_path, 'wb') as f:
-        pickle.dump(data, f)
-    # ... (tiếp tục phần lưu chunks.txt, embedding_info.txt như trước)
-    # Lưu FAISS
-    index_path = os.path.join(output_dir, pdf_name, f"{pdf_name}_faiss.index")
-    dim = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dim)
-    index.add(embeddings.astype(np.float32))
-    faiss.write_index(index, index_path)
-    # Cập nhật all_faiss và all_pickle
-    all_faiss = faiss.IndexFlatL2(dim) if not os.path.exists(FAISS_INDEX_PATH) else faiss.read_index(FAISS_INDEX_PATH)
-    all_faiss.add(embeddings.astype(np.float32))
-    faiss.write_index(all_faiss, FAISS_INDEX_PATH)
-    all_data = [] if not os.path.exists(EMBEDDINGS_PICKLE_PATH) else pickle.load(open(EMBEDDINGS_PICKLE_PATH, 'rb'))
-    all_data.append(data)
-    with open(EMBEDDINGS_PICKLE_PATH, 'wb') as f:
-        pickle.dump(all_data, f)
-    return pickle_path, index_path
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    token_stats = chunk_token_stats(chunks)
+    with _global_index_lock:
+        _writer_index()
+        # Ghi thêm một segment vào kho chunk (không đọc/ghi lại toàn bộ dữ liệu cũ)
+        doc = chunk_store().append(pdf_name, chunks, embeddings, created_at=datetime.now().isoformat(),
+                                   token_stats=token_stats)
+        if doc is None:
+            return None, FAISS_INDEX_PATH
+        _commit_document(doc, embeddings)
+    return os.path.join(CHUNK_STORE_DIR, doc["segment"]), FAISS_INDEX_PATH
+
+def commit_segment(writer, pdf_path):
+    """
+    Đăng ký segment đã ghi dần bằng chunk_store().begin_segment() cho tài liệu pdf_path
+    và cập nhật FAISS index. Trả về entry tài liệu hoặc None nếu segment rỗng.
+    """
+    pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
+    with _global_index_lock:
+        _writer_index()
+        doc = chunk_store().commit_segment(writer, pdf_name, created_at=datetime.now().isoformat())
+        if doc is None:
+            return None
+        _commit_document(doc)
+    return doc
 
 
 def is_embedded_by_pdf_name(pdf_name: str, output_dir: str = OUTPUT_DIR) -> bool:
     """Kiểm tra đã có embedding cho một tài liệu theo tên PDF (không đuôi)."""
-    per_doc_pkl = os.path.join(output_dir, pdf_name, f"{pdf_name}_embeddings.pkl")
-    per_doc_index = os.path.join(output_dir, pdf_name, f"{pdf_name}_faiss.index")
-    return os.path.exists(per_doc_pkl) and os.path.exists(per_doc_index)
+    return chunk_store().has_doc(pdf_name)
 
 
 def remove_embeddings_by_pdf_name(pdf_name: str, output_dir: str = OUTPUT_DIR) -> bool:
     """
-    Xóa embeddings và FAISS index của một tài liệu cụ thể.
-    Cập nhật lại all_faiss.index và all_embeddings.pkl.
+    Xóa embeddings của một tài liệu cụ thể.
+    Chỉ gỡ các vector của tài liệu đó khỏi all_faiss.index và kho chunk.
     """
+    global _global_index
     try:
         # Xóa thư mục riêng của tài liệu
         doc_dir = os.path.join(output_dir, pdf_name)
@@ -194,34 +356,15 @@ def remove_embeddings_by_pdf_name(pdf_name: str, output_dir: str = OUTPUT_DIR) -
             import shutil
             shutil.rmtree(doc_dir)
         
-        # Cập nhật all_embeddings.pkl - loại bỏ entry của tài liệu này
-        if os.path.exists(EMBEDDINGS_PICKLE_PATH):
-            with open(EMBEDDINGS_PICKLE_PATH, 'rb') as f:
-                all_data = pickle.load(f)
-            
-            # Lọc ra các entry không phải của tài liệu này
-            filtered_data = [entry for entry in all_data if entry.get('pdf_name') != pdf_name]
-            
-            # Lưu lại file đã được lọc
-            with open(EMBEDDINGS_PICKLE_PATH, 'wb') as f:
-                pickle.dump(filtered_data, f)
-        
-        # Tái tạo all_faiss.index từ dữ liệu còn lại
-        if os.path.exists(EMBEDDINGS_PICKLE_PATH) and os.path.exists(EMBEDDINGS_PICKLE_PATH):
-            with open(EMBEDDINGS_PICKLE_PATH, 'rb') as f:
-                all_data = pickle.load(f)
-            
-            if all_data:
-                # Tạo FAISS index mới từ dữ liệu còn lại
-                all_embeddings = np.vstack([entry['embeddings'] for entry in all_data])
-                dim = all_embeddings.shape[1]
-                new_index = faiss.IndexFlatL2(dim)
-                new_index.add(all_embeddings.astype(np.float32))
-                faiss.write_index(new_index, FAISS_INDEX_PATH)
-            else:
-                # Nếu không còn dữ liệu nào, xóa file index
-                if os.path.exists(FAISS_INDEX_PATH):
-                    os.remove(FAISS_INDEX_PATH)
+        # Loại tài liệu khỏi kho chunk và gỡ đúng dải chunk ID của nó khỏi index
+        with _global_index_lock:
+            index = _writer_index()
+            removed = chunk_store().remove(pdf_name)
+            view = chunk_store().view()
+            for doc in removed:
+                index = vector_index.remove_document(index, doc["first_id"], doc["count"], view)
+            _global_index = index
+            vector_index.save_index(index, FAISS_INDEX_PATH)
         
         return True
         
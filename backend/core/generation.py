@@ -0,0 +1,585 @@
+# generation.py: Bộ lập lịch sinh văn bản gom lô liên tục (continuous batching) cho LLM
+#
+# Thay vì mỗi request tự gọi model.generate() (tranh nhau GPU hoặc xếp hàng tuần tự), mọi request
+# chat gửi prompt vào một hàng đợi chung; một thread "generation-scheduler" duy nhất:
+#   - prefill các prompt mới (gom thành một lô, padding trái) rồi nhập vào lô đang giải mã
+#   - mỗi bước giải mã chạy một forward cho toàn bộ lô (mỗi chuỗi một token), KV cache dùng chung
+#     theo dạng padding trái + attention_mask + position_ids riêng từng chuỗi
+#   - chuỗi nào gặp EOS / đủ max_new_tokens / stopping criteria thì rời lô ngay, chỗ trống được
+#     nhường cho request đang chờ ở bước kế tiếp (không chờ cả lô xong)
+#   - token sinh ra được đẩy về iterator/streamer của từng request (AsyncTokenStream cho coroutine asyncio)
+#   - request bị hủy (cancel() hoặc CancelToken trong stopping_criteria) rời lô ngay bước giải mã kế tiếp
+# Lấy mẫu (temperature, repetition_penalty, no_repeat_ngram_size; top_k/top_p/min_p theo generation_config
+# của model) áp dụng riêng cho từng chuỗi nên kết quả tương đương model.generate() với cùng GENERATION_KWARGS.
+#
+# GEN_MAX_BATCH: số chuỗi giải mã cùng lúc; GEN_MAX_BATCH_TOKENS: trần (số chuỗi x độ dài KV đã padding)
+# để giới hạn bộ nhớ KV cache.
+#
+# Prefix cache: request gửi kèm prefix_length (vd. khối system cố định của build_prompt) thì KV của
+# prefix_length token đầu được tính một lần cho mỗi lần nạp model, khóa theo hash các token đó (đổi template
+# -> khóa mới, entry cũ bị đẩy ra theo LRU, tối đa GEN_PREFIX_CACHE_SIZE entry). Prefill chỉ chạy phần
+# sau prefix; trong lô, phần padding nằm giữa prefix và phần riêng của từng chuỗi (attention_mask = 0).
+# Request cũng có thể mang sẵn KV của riêng nó (prefix_cache, vd. lượt trước của một phiên hội thoại) và
+# yêu cầu giữ lại KV khi xong (keep_cache) để lượt sau chỉ prefill phần token mới.
+
+import os
+import time
+import queue
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict, deque
+
+GEN_MAX_BATCH = int(os.getenv("GEN_MAX_BATCH", "8"))
+GEN_MAX_BATCH_TOKENS = int(os.getenv("GEN_MAX_BATCH_TOKENS", "16384"))
+GEN_PREFIX_CACHE_SIZE = int(os.getenv("GEN_PREFIX_CACHE_SIZE", "4"))
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+_END = object()
+
+
+class GenerationRequest:
+    """Một prompt đang chờ/đang sinh; duyệt (iterate) để nhận từng token ID khi được sinh ra."""
+
+    def __init__(self, input_ids, max_new_tokens=256, temperature=1.0, do_sample=False, repetition_penalty=1.0,
+                 no_repeat_ngram_size=0, stopping_criteria=None, streamer=None, prefix_length=0,
+                 prefix_cache=None, keep_cache=False):
+        self.input_ids = list(input_ids)
+        # Số token đầu dùng chung giữa các request (KV lấy từ prefix cache của bộ lập lịch)
+        self.prefix_length = prefix_length
+        # KVPrefix riêng của request (input_ids bắt đầu bằng prefix_cache.ids); ưu tiên hơn prefix_length
+        self.prefix_cache = prefix_cache
+        # keep_cache: khi sinh xong, cache = KVPrefix của prompt + token đã sinh (trừ token cuối chưa qua model)
+        self.keep_cache = keep_cache
+        self.cache = None
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.do_sample = do_sample
+        self.repetition_penalty = repetition_penalty
+        self.no_repeat_ngram_size = no_repeat_ngram_size
+        self.stopping_criteria = stopping_criteria or []
+        self.streamer = streamer
+        self.tokens = []
+        self.tokens_saved = 0  # max_new_tokens chưa dùng khi một stopping criterion dừng sớm
+        self.finish_reason = None  # "eos" | "length" | "stop" | "cancelled" | "error"
+        self.error = None
+        self.submitted_at = time.perf_counter()
+        self.first_token_at = None
+        self.finished_at = None
+        self._queue = queue.Queue()
+        self._done = threading.Event()
+        self._cancelled = threading.Event()
+        self._callbacks = []
+
+    def cancel(self) -> None:
+        """Yêu cầu dừng sinh; chuỗi rời lô ở bước giải mã kế tiếp."""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        # CancelToken (stopping.py) trong stopping_criteria cũng tính là hủy
+        return self._cancelled.is_set() or any(getattr(c, "cancelled", False) for c in self.stopping_criteria)
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def _emit(self, token_id: int) -> None:
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.tokens.append(token_id)
+        self._queue.put(token_id)
+        if self.streamer is not None:
+            import torch
+
+            self.streamer.put(torch.tensor([token_id]))
+
+    def _finish(self, reason: str, error: Exception | None = None) -> None:
+        if self._done.is_set():
+            return
+        self.finish_reason = reason
+        self.error = error
+        self.finished_at = time.perf_counter()
+        self._done.set()
+        self._queue.put(_END)
+        if self.streamer is not None:
+            self.streamer.end()
+        for callback in self._callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                print(f"Lỗi callback sau khi sinh xong: {str(e)}")
+
+    def add_done_callback(self, callback) -> None:
+        """Gọi callback(request) khi request kết thúc (ngay lập tức nếu đã xong); chạy trên thread lập lịch."""
+        if self._done.is_set():
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is _END:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield item
+
+    def result(self, timeout: float | None = None) -> list:
+        """Chờ sinh xong, trả về danh sách token ID đã sinh (không gồm prompt)."""
+        if not self._done.wait(timeout):
+            raise TimeoutError("Generation timed out")
+        if self.error is not None:
+            raise self.error
+        return list(self.tokens)
+
+
+class AsyncTokenStream:
+    """
+    Streamer (put/end như streamer của transformers) chuyển token ID từ thread lập lịch sang event loop.
+    Tạo trong coroutine đang chạy; duyệt bằng `async for` để nhận token mà không chiếm thread nào khi chờ.
+    """
+
+    def __init__(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+
+    def put(self, value) -> None:
+        for token_id in value.reshape(-1).tolist():
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, token_id)
+
+    def end(self) -> None:
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, _END)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> int:
+        item = await self._queue.get()
+        if item is _END:
+            raise StopAsyncIteration
+        return item
+
+
+def _cache_layers(past) -> list:
+    """Danh sách (key, value) [batch, heads, len, dim] của từng layer từ cache của transformers."""
+    if isinstance(past, (tuple, list)):
+        return [(k, v) for k, v in past]
+    if hasattr(past, "layers"):
+        return [(layer.keys, layer.values) for layer in past.layers]
+    return list(zip(past.key_cache, past.value_cache))
+
+
+def _make_cache(layers):
+    from transformers import DynamicCache
+
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(tuple(layers))
+    return DynamicCache(ddp_cache_data=layers)
+
+
+def _left_pad(layers, mask, length):
+    """Padding trái KV cache và attention_mask tới độ dài length."""
+    import torch
+
+    extra = length - mask.shape[1]
+    if extra <= 0:
+        return layers, mask
+    padded = []
+    for k, v in layers:
+        pad_k = k.new_zeros(k.shape[0], k.shape[1], extra, k.shape[3])
+        pad_v = v.new_zeros(v.shape[0], v.shape[1], extra, v.shape[3])
+        padded.append((torch.cat([pad_k, k], dim=2), torch.cat([pad_v, v], dim=2)))
+    return padded, torch.cat([mask.new_zeros(mask.shape[0], extra), mask], dim=1)
+
+
+class _Sequence:
+    """Trạng thái một chuỗi trong lô: request, toàn bộ token (prompt + đã sinh), bộ xử lý logits."""
+
+    def __init__(self, request, processors, device):
+        import torch
+
+        self.request = request
+        self.ids = torch.tensor([request.input_ids], dtype=torch.long, device=device)
+        self.processors = processors
+        self.generated = 0
+
+
+class KVPrefix:
+    """KV (một chuỗi, batch = 1) của một dãy token ids; prefill của request bắt đầu bằng ids tiếp nối từ đây."""
+
+    __slots__ = ("ids", "layers")
+
+    def __init__(self, ids, layers):
+        self.ids = tuple(ids)
+        self.layers = layers
+
+    @property
+    def nbytes(self) -> int:
+        return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in self.layers)
+
+    def to(self, device) -> "KVPrefix":
+        return KVPrefix(self.ids, [(k.to(device), v.to(device)) for k, v in self.layers])
+
+
+class GenerationScheduler:
+    def __init__(self, model, tokenizer, max_batch: int | None = None, max_batch_tokens: int | None = None,
+                 prefix_cache_size: int | None = None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch = max_batch or GEN_MAX_BATCH
+        self.max_batch_tokens = max_batch_tokens or GEN_MAX_BATCH_TOKENS
+        self.prefix_cache_size = GEN_PREFIX_CACHE_SIZE if prefix_cache_size is None else prefix_cache_size
+        self._prefixes = OrderedDict()  # hash token ID prefix -> KVPrefix (chỉ thread lập lịch truy cập)
+        eos = getattr(model.generation_config, "eos_token_id", None)
+        eos = list(eos) if isinstance(eos, (list, tuple)) else [eos]
+        self.eos_ids = {i for i in eos + [tokenizer.eos_token_id] if i is not None}
+        self.pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        # top_k/top_p/min_p khi lấy mẫu: như model.generate(), lấy từ generation_config của model
+        # (không đặt thì dùng mặc định của transformers: top_k=50)
+        config = model.generation_config
+        top_k = getattr(config, "top_k", None)
+        self.top_k = 50 if top_k is None else top_k
+        self.top_p = getattr(config, "top_p", None)
+        self.min_p = getattr(config, "min_p", None)
+        self._waiting = deque()
+        self._wakeup = threading.Event()
+        self._rows = []
+        self._admitting = []  # request đã rời hàng đợi nhưng chưa prefill xong (chưa nằm trong _rows)
+        self._layers = None
+        self._mask = None
+        self._lock = threading.Lock()
+        self._closed = False
+        self._counters = {"requests": 0, "tokens": 0, "steps": 0, "prefills": 0, "batch_rows": 0, "busy_seconds": 0.0,
+                          "prefix_hits": 0, "prefix_misses": 0, "prefix_tokens_reused": 0,
+                          "early_stops": 0, "tokens_saved": 0}
+        self._thread = threading.Thread(target=self._loop, name="generation-scheduler", daemon=True)
+        self._thread.start()
+
+    # ------------------------------------------------------------------ API
+    def submit(self, input_ids, **kwargs) -> GenerationRequest:
+        request = GenerationRequest(input_ids, **kwargs)
+        with self._lock:
+            self._counters["requests"] += 1
+            self._waiting.append(request)
+        self._wakeup.set()
+        return request
+
+    def close(self) -> None:
+        """Dừng thread lập lịch (request đang chờ/đang sinh kết thúc với "cancelled") và chờ nó thoát."""
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+            # Request đã rời hàng đợi nhưng còn đang prefill tính là đang sinh
+            active = len(self._rows) + len(self._admitting)
+            waiting, prefixes = len(self._waiting), len(self._prefixes)
+        steps = counters["steps"]
+        return {
+            "active": active,
+            "waiting": waiting,
+            "max_batch": self.max_batch,
+            "requests": counters["requests"],
+            "tokens": counters["tokens"],
+            "prefills": counters["prefills"],
+            "prefix_cache": {
+                "entries": prefixes,
+                "hits": counters["prefix_hits"],
+                "misses": counters["prefix_misses"],
+                "tokens_reused": counters["prefix_tokens_reused"],
+            },
+            "decode_steps": steps,
+            "early_stops": counters["early_stops"],
+            "tokens_saved": counters["tokens_saved"],
+            "mean_batch_size": round(counters["batch_rows"] / steps, 2) if steps else None,
+            "tokens_per_second": round(counters["tokens"] / counters["busy_seconds"], 2) if counters["busy_seconds"] else None,
+        }
+
+    # ------------------------------------------------------------------ vòng lặp
+    def _loop(self) -> None:
+        while not self._closed:
+            if not self._rows and not self._waiting:
+                # Lô rỗng: ngủ tới khi có request
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            started = time.perf_counter()
+            try:
+                self._admit()
+                if self._rows:
+                    self._step()
+            except Exception as e:
+                print(f"❌ Lỗi bộ lập lịch sinh: {str(e)}")
+                # Cả request đang prefill dở (vd. OOM khi prefill) để người gọi không chờ mãi
+                for request in [row.request for row in self._rows] + self._admitting:
+                    request._finish("error", e)
+                with self._lock:
+                    self._rows, self._admitting = [], []
+                self._layers, self._mask = None, None
+            with self._lock:
+                self._counters["busy_seconds"] += time.perf_counter() - started
+        with self._lock:
+            pending, self._waiting = list(self._waiting), deque()
+            rows, self._rows = self._rows, []
+        for request in pending + [row.request for row in rows]:
+            request._finish("cancelled")
+        self._layers, self._mask = None, None
+
+    def _take_waiting(self) -> list:
+        """Lấy request đang chờ (FIFO) khi lô còn chỗ (số chuỗi và ngân sách token KV)."""
+        admitted = []
+        length = self._mask.shape[1] if self._mask is not None else 0
+        with self._lock:
+            while self._waiting and len(self._rows) + len(admitted) < self.max_batch:
+                request = self._waiting[0]
+                if request.cancelled:
+                    self._waiting.popleft()._finish("cancelled")
+                    continue
+                new_length = max(length, len(request.input_ids))
+                rows = len(self._rows) + len(admitted) + 1
+                if rows > 1 and rows * (new_length + request.max_new_tokens) > self.max_batch_tokens:
+                    # Không đủ ngân sách KV: giữ ở đầu hàng đợi, thử lại khi có chuỗi rời lô
+                    break
+                admitted.append(self._waiting.popleft())
+                length = new_length
+            # Cùng lúc rời hàng đợi: stats() không bỏ sót request nào giữa hai trạng thái
+            self._admitting = admitted
+        return admitted
+
+    def _processors(self, request):
+        from transformers import (
+            LogitsProcessorList,
+            MinPLogitsWarper,
+            NoRepeatNGramLogitsProcessor,
+            RepetitionPenaltyLogitsProcessor,
+            TemperatureLogitsWarper,
+            TopKLogitsWarper,
+            TopPLogitsWarper,
+        )
+
+        # Cùng thứ tự với model.generate(): phạt lặp trước, rồi các warper khi lấy mẫu
+        processors = LogitsProcessorList()
+        if request.repetition_penalty and request.repetition_penalty != 1.0:
+            processors.append(RepetitionPenaltyLogitsProcessor(request.repetition_penalty))
+        if request.no_repeat_ngram_size:
+            processors.append(NoRepeatNGramLogitsProcessor(request.no_repeat_ngram_size))
+        if request.do_sample:
+            if request.temperature and request.temperature != 1.0:
+                processors.append(TemperatureLogitsWarper(request.temperature))
+            if self.top_k:
+                processors.append(TopKLogitsWarper(self.top_k))
+            if self.top_p is not None and self.top_p < 1.0:
+                processors.append(TopPLogitsWarper(self.top_p))
+            if self.min_p is not None:
+                processors.append(MinPLogitsWarper(self.min_p))
+        return processors
+
+    def clear_prefix_cache(self) -> None:
+        """Bỏ mọi KV prefix đã tính (áp dụng từ lần prefill kế tiếp)."""
+        with self._lock:
+            self._prefixes = OrderedDict()
+
+    def _prefix_for(self, request):
+        """KV của prefix request khai báo (tính một lần rồi dùng lại); None nếu không dùng prefix cache."""
+        import torch
+
+        own = request.prefix_cache
+        if own is not None and len(own.ids) < len(request.input_ids) and tuple(request.input_ids[:len(own.ids)]) == own.ids:
+            with self._lock:
+                self._counters["prefix_tokens_reused"] += len(own.ids)
+            return own
+        length = request.prefix_length
+        if not self.prefix_cache_size or not length or length >= len(request.input_ids):
+            return None
+        ids = tuple(request.input_ids[:length])
+        key = hashlib.sha1(repr(ids).encode("utf-8")).hexdigest()
+        with self._lock:
+            prefix = self._prefixes.get(key)
+            if prefix is not None and prefix.ids == ids:
+                self._prefixes.move_to_end(key)
+                self._counters["prefix_hits"] += 1
+                self._counters["prefix_tokens_reused"] += length
+                return prefix
+            self._counters["prefix_misses"] += 1
+        with torch.inference_mode():
+            out = self.model(input_ids=torch.tensor([ids], dtype=torch.long, device=self.model.device), use_cache=True)
+        prefix = KVPrefix(ids, _cache_layers(out.past_key_values))
+        with self._lock:
+            self._prefixes[key] = prefix
+            while len(self._prefixes) > self.prefix_cache_size:
+                self._prefixes.popitem(last=False)
+        return prefix
+
+    def _admit(self) -> None:
+        """Prefill các request mới (gom theo prefix dùng chung) rồi nhập KV của chúng vào lô đang giải mã."""
+        requests = self._take_waiting()
+        groups = {}
+        for request in requests:
+            prefix = self._prefix_for(request)
+            groups.setdefault(id(prefix), (prefix, []))[1].append(request)
+        # Mỗi nhóm prefill xong thì rời _admitting và vào lô (_prefill)
+        for prefix, group in groups.values():
+            self._prefill(group, prefix)
+
+    def _prefill(self, requests, prefix) -> None:
+        """Một lô prefill (padding trái phần sau prefix), tiếp nối KV của prefix nếu có."""
+        import torch
+
+        device = self.model.device
+        start = len(prefix.ids) if prefix is not None else 0
+        suffixes = [r.input_ids[start:] for r in requests]
+        length = max(len(s) for s in suffixes)
+        input_ids = torch.full((len(requests), length), self.pad_id, dtype=torch.long, device=device)
+        mask = torch.zeros((len(requests), start + length), dtype=torch.long, device=device)
+        mask[:, :start] = 1
+        for i, suffix in enumerate(suffixes):
+            input_ids[i, length - len(suffix):] = torch.tensor(suffix, device=device)
+            mask[i, start + length - len(suffix):] = 1
+        position_ids = (mask.cumsum(dim=1) - 1).clamp(min=0)[:, start:]
+        past = None
+        if prefix is not None:
+            batch = len(requests)
+            past = _make_cache([
+                (k.to(device).expand(batch, -1, -1, -1).contiguous(), v.to(device).expand(batch, -1, -1, -1).contiguous())
+                for k, v in prefix.layers
+            ])
+        with torch.inference_mode():
+            out = self.model(input_ids=input_ids, attention_mask=mask, position_ids=position_ids,
+                             past_key_values=past, use_cache=True)
+        layers = _cache_layers(out.past_key_values)
+        rows = [_Sequence(r, self._processors(r), device) for r in requests]
+        with self._lock:
+            self._counters["prefills"] += 1
+
+        if self._layers is None:
+            self._layers, self._mask = layers, mask
+        else:
+            target = max(self._mask.shape[1], mask.shape[1])
+            old_layers, old_mask = _left_pad(self._layers, self._mask, target)
+            layers, mask = _left_pad(layers, mask, target)
+            self._layers = [(torch.cat([ok, nk]), torch.cat([ov, nv])) for (ok, ov), (nk, nv) in zip(old_layers, layers)]
+            self._mask = torch.cat([old_mask, mask])
+        first = len(self._rows)
+        with self._lock:
+            self._rows = self._rows + rows
+            self._admitting = [r for r in self._admitting if r not in requests]
+        # Token đầu tiên của mỗi chuỗi lấy từ logits của prefill
+        self._sample_and_emit(out.logits[:, -1, :], offset=first)
+
+    def _step(self) -> None:
+        """Một bước giải mã cho toàn bộ lô."""
+        import torch
+
+        last = torch.stack([row.ids[0, -1] for row in self._rows]).unsqueeze(1)
+        mask = torch.cat([self._mask, self._mask.new_ones(len(self._rows), 1)], dim=1)
+        position_ids = self._mask.sum(dim=1, keepdim=True)
+        with torch.inference_mode():
+            out = self.model(
+                input_ids=last,
+                attention_mask=mask,
+                position_ids=position_ids,
+                past_key_values=_make_cache(self._layers),
+                use_cache=True,
+            )
+        self._layers = _cache_layers(out.past_key_values)
+        self._mask = mask
+        with self._lock:
+            self._counters["steps"] += 1
+            self._counters["batch_rows"] += len(self._rows)
+        self._sample_and_emit(out.logits[:, -1, :], offset=0)
+
+    def _sample_and_emit(self, logits, offset: int) -> None:
+        """Lấy mẫu token kế tiếp cho các chuỗi từ vị trí offset, đẩy token ra và bỏ chuỗi đã xong khỏi lô."""
+        import torch
+
+        finished = []  # (vị trí trong lô, finish_reason)
+        emitted = 0
+        for i in range(logits.shape[0]):
+            index = offset + i
+            row = self._rows[index]
+            request = row.request
+            if request.cancelled:
+                finished.append((index, "cancelled"))
+                continue
+            scores = row.processors(row.ids, logits[i:i + 1].float())
+            if request.do_sample:
+                token = torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1)
+            else:
+                token = scores.argmax(dim=-1, keepdim=True)
+            row.ids = torch.cat([row.ids, token.to(row.ids.device)], dim=1)
+            row.generated += 1
+            token_id = int(token)
+            if token_id in self.eos_ids:
+                finished.append((index, "eos"))
+                continue
+            request._emit(token_id)
+            emitted += 1
+            stopped = next((c for c in request.stopping_criteria if bool(torch.as_tensor(c(row.ids, scores)).any())), None)
+            if stopped is not None:
+                finished.append((index, getattr(stopped, "finish_reason", "stop")))
+            elif row.generated >= request.max_new_tokens:
+                finished.append((index, "length"))
+        with self._lock:
+            self._counters["tokens"] += emitted
+        if finished:
+            for index, reason in finished:
+                request = self._rows[index].request
+                # KV lấy trước khi báo xong để callback/người chờ thấy ngay request.cache
+                if request.keep_cache and reason not in ("cancelled", "error"):
+                    request.cache = self._row_cache(index)
+                if reason not in ("eos", "length", "cancelled"):
+                    # Dừng bởi stopping criterion (vd. phát hiện lặp): ghi lại số token không phải sinh
+                    request.tokens_saved = request.max_new_tokens - self._rows[index].generated
+                    with self._lock:
+                        self._counters["early_stops"] += 1
+                        self._counters["tokens_saved"] += request.tokens_saved
+                request._finish(reason)
+            self._drop([index for index, _ in finished])
+
+    def _row_cache(self, index: int) -> KVPrefix:
+        """KV của một chuỗi trong lô (bỏ padding): prompt + token đã sinh, trừ token cuối chưa được đưa qua model."""
+        used = self._mask[index].bool()
+        layers = [(k[index:index + 1][:, :, used].clone(), v[index:index + 1][:, :, used].clone()) for k, v in self._layers]
+        return KVPrefix(self._rows[index].ids[0, :-1].tolist(), layers)
+
+    def _drop(self, indices) -> None:
+        """Bỏ các chuỗi đã xong khỏi lô và cắt phần padding trái mà mọi chuỗi còn lại đều không dùng."""
+        import torch
+
+        drop = set(indices)
+        keep = [i for i in range(len(self._rows)) if i not in drop]
+        with self._lock:
+            self._rows = [self._rows[i] for i in keep]
+        if not keep:
+            self._layers, self._mask = None, None
+            return
+        index = torch.tensor(keep, device=self._mask.device)
+        mask = self._mask.index_select(0, index)
+        used = mask.any(dim=0).nonzero()
+        start = int(used[0]) if len(used) else 0
+        self._mask = mask[:, start:]
+        self._layers = [
+            (k.index_select(0, index)[:, :, start:], v.index_select(0, index)[:, :, start:])
+            for k, v in self._layers
+        ]
+
+
+def scheduler_stats() -> dict | None:
+    """Thống kê bộ lập lịch (None nếu chưa có request sinh nào)."""
+    return _scheduler.stats() if _scheduler is not None else None
+
+
+def get_scheduler() -> GenerationScheduler:
+    """Bộ lập lịch dùng chung cả process (tạo lần đầu, dùng LLM của model_registry)."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            from .model_registry import get_llm, get_llm_tokenizer
+
+            _scheduler = GenerationScheduler(get_llm(), get_llm_tokenizer())
+        return _scheduler
@@ -0,0 +1,390 @@
+# jobs.py: Hàng đợi job ingest chạy nền thay cho OCR/embed ngay trong request HTTP
+#
+#   - enqueue_job() ghi job vào bảng ingest_jobs rồi trả về ngay; INGEST_WORKERS thread xử lý lần lượt
+#   - mỗi worker chạy pipeline.build_segment() (OCR -> chunk -> embed) song song với worker khác
+#   - chỉ một thread ghi (writer) đăng ký segment vào kho chunk + FAISS index và reload RAG,
+#     gộp nhiều job xong cùng lúc thành một lần reload; xóa tài liệu (remove_document) cũng đi qua thread
+#     này nên không xen vào giữa lúc đăng ký segment và lần reload của lô
+#   - job đang chạy ghi tên process (owner = "host:pid") và heartbeat (updated_at) mỗi JOB_HEARTBEAT_INTERVAL
+#     giây. Khi khởi động, job queued được đưa lại vào hàng đợi; job running chỉ được nhận lại (chạy lại từ đầu)
+#     khi process chạy nó đã chết hoặc mất heartbeat quá JOB_STALE_SECONDS - nên nhiều worker uvicorn/process
+#     dùng chung DB không chạy lại job của nhau. Việc kiểm tra này cũng chạy định kỳ trong thread heartbeat.
+
+import os
+import json
+import queue
+import socket
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+
+from ..db.database import SessionLocal
+from ..db.models import Document, IngestJob
+from .embeding import OUTPUT_DIR, commit_segment, is_embedded_by_pdf_name, remove_embeddings_by_pdf_name
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "1"))
+# Số job tối đa đang chờ; vượt quá thì từ chối nhận thêm (HTTP 503)
+INGEST_MAX_PENDING = int(os.getenv("INGEST_MAX_PENDING", "100"))
+# Khoảng thời gian tối thiểu (giây) giữa hai lần ghi tiến độ job xuống DB
+JOB_PROGRESS_INTERVAL = float(os.getenv("JOB_PROGRESS_INTERVAL", "1.0"))
+JOB_HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT_INTERVAL", "30"))
+# Job running không có heartbeat lâu hơn chừng này giây (process ở máy khác) coi như đã bỏ dở
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "120"))
+
+ACTIVE_STATUSES = ("queued", "running")
+
+_job_queue = queue.Queue()
+_commit_queue = queue.Queue()
+_lock = threading.Lock()
+_threads = []
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+def job_to_dict(job: IngestJob) -> dict:
+    """Trạng thái job cho API: bước hiện tại, tiến độ (0..1) và thông lượng."""
+    progress = 0.0
+    if job.status == "done":
+        progress = 1.0
+    elif job.pages_total:
+        progress = 0.9 * job.pages_done / job.pages_total + (0.05 if job.stage == "commit" else 0.0)
+    elapsed = None
+    if job.started_at is not None:
+        elapsed = ((job.finished_at or job.updated_at or job.started_at) - job.started_at).total_seconds()
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "pdf_name": job.pdf_name,
+        "doc_id": job.doc_id,
+        "status": job.status,
+        "stage": job.stage,
+        "progress": round(progress, 3),
+        "pages_done": job.pages_done,
+        "pages_total": job.pages_total,
+        "chunks_done": job.chunks_done,
+        "elapsed_seconds": round(elapsed, 1) if elapsed is not None else None,
+        "pages_per_second": round(job.pages_done / elapsed, 3) if elapsed else None,
+        "chunks_per_second": round(job.chunks_done / elapsed, 3) if elapsed else None,
+        "attempts": job.attempts,
+        "error": job.error,
+        "stats": json.loads(job.stats) if job.stats else None,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+def get_job(job_id: str) -> dict | None:
+    db = SessionLocal()
+    try:
+        job = db.get(IngestJob, job_id)
+        return job_to_dict(job) if job else None
+    finally:
+        db.close()
+
+
+def find_active_job(db, pdf_name: str) -> IngestJob | None:
+    return (
+        db.query(IngestJob)
+        .filter(IngestJob.pdf_name == pdf_name, IngestJob.status.in_(ACTIVE_STATUSES))
+        .order_by(IngestJob.created_at)
+        .first()
+    )
+
+
+def enqueue_job(kind: str, pdf_name: str, pdf_path: str, doc_id: int | None = None) -> dict:
+    """
+    Tạo job ingest và đưa vào hàng đợi. Nếu tài liệu đã có job đang chờ/chạy thì trả về job đó.
+    Ném JobQueueFull khi hàng đợi đã đầy.
+    """
+    with _lock:
+        db = SessionLocal()
+        try:
+            active = find_active_job(db, pdf_name)
+            if active is not None:
+                return job_to_dict(active)
+            if _job_queue.qsize() >= INGEST_MAX_PENDING:
+                raise JobQueueFull(f"Đang có {_job_queue.qsize()} job chờ xử lý")
+            job = IngestJob(id=uuid.uuid4().hex, kind=kind, pdf_name=pdf_name, pdf_path=pdf_path,
+                            doc_id=doc_id, status="queued", stage="queued")
+            db.add(job)
+            db.commit()
+            db.refresh(job)
+            _job_queue.put(job.id)
+            return job_to_dict(job)
+        finally:
+            db.close()
+
+
+def _update_job(job_id: str, **fields) -> None:
+    db = SessionLocal()
+    try:
+        job = db.get(IngestJob, job_id)
+        if job is None:
+            return
+        for key, value in fields.items():
+            setattr(job, key, value)
+        job.updated_at = datetime.utcnow()
+        db.commit()
+    finally:
+        db.close()
+
+
+def _progress_writer(job_id: str):
+    """Tạo callback tiến độ cho pipeline, ghi xuống DB tối đa mỗi JOB_PROGRESS_INTERVAL giây."""
+    last = {"at": 0.0, "stage": None}
+    lock = threading.Lock()
+
+    def report(stats: dict) -> None:
+        now = datetime.utcnow().timestamp()
+        with lock:
+            if stats["stage"] == last["stage"] and now - last["at"] < JOB_PROGRESS_INTERVAL:
+                return
+            last["at"], last["stage"] = now, stats["stage"]
+        _update_job(job_id, stage=stats["stage"], pages_done=stats["pages"],
+                    pages_total=stats["pages_total"], chunks_done=stats["chunks"])
+
+    return report
+
+
+def _remove_upload_files(job: IngestJob) -> None:
+    """
+    Upload lỗi: xóa file PDF đã lưu và thư mục kết quả dở dang (results/<pdf>) để lần upload lại bắt đầu
+    từ đầu và quét thư mục không thấy tài liệu chưa nhúng. Giữ nguyên nếu tài liệu cùng tên đã có trong kho.
+    """
+    if is_embedded_by_pdf_name(job.pdf_name, OUTPUT_DIR):
+        return
+    try:
+        if os.path.exists(job.pdf_path):
+            os.remove(job.pdf_path)
+        doc_dir = os.path.join(OUTPUT_DIR, job.pdf_name)
+        if os.path.isdir(doc_dir):
+            shutil.rmtree(doc_dir)
+    except OSError as e:
+        print(f"⚠️ Không xóa được file của upload lỗi {job.pdf_name}: {str(e)}")
+
+
+def _fail_job(job: IngestJob, error: str) -> None:
+    print(f"❌ Job ingest {job.id} ({job.pdf_name}) lỗi: {error}")
+    _update_job(job.id, status="failed", error=error, finished_at=datetime.utcnow())
+    if job.kind == "upload":
+        _remove_upload_files(job)
+    if job.kind == "upload" and job.doc_id is not None:
+        # Tài liệu upload chỉ được giữ trong DB khi đã nhúng xong (cho phép upload lại)
+        db = SessionLocal()
+        try:
+            doc = db.get(Document, job.doc_id)
+            if doc is not None:
+                db.delete(doc)
+                db.commit()
+        finally:
+            db.close()
+
+
+def _claim_job(job_id: str) -> IngestJob | None:
+    """Chuyển job từ queued sang running (nguyên tử, nên một job không bị hai worker chạy)."""
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        claimed = (
+            db.query(IngestJob)
+            .filter(IngestJob.id == job_id, IngestJob.status == "queued")
+            .update({
+                IngestJob.status: "running",
+                IngestJob.stage: "ocr",
+                IngestJob.attempts: IngestJob.attempts + 1,
+                IngestJob.owner: _owner(),
+                IngestJob.error: None,
+                IngestJob.started_at: now,
+                IngestJob.updated_at: now,
+            }, synchronize_session=False)
+        )
+        db.commit()
+        if not claimed:
+            return None
+        job = db.get(IngestJob, job_id)
+        db.expunge(job)
+        return job
+    finally:
+        db.close()
+
+
+def _run_job(job_id: str) -> None:
+    job = _claim_job(job_id)
+    if job is None:
+        return
+
+    if not os.path.exists(job.pdf_path):
+        _fail_job(job, f"Không tìm thấy file {job.pdf_path}")
+        return
+    from .pipeline import build_segment  # import lười: OCR/underthesea chỉ cần khi có job
+
+    try:
+        writer, stats = build_segment(job.pdf_path, OUTPUT_DIR, progress=_progress_writer(job_id))
+        # Đăng ký segment qua thread ghi duy nhất rồi chờ kết quả
+        done = Future()
+        _commit_queue.put(("commit", (writer, job.pdf_path), done))
+        done.result()
+    except Exception as e:
+        _fail_job(job, str(e) or e.__class__.__name__)
+        return
+    stats["stage"] = "done"
+    _update_job(job_id, status="done", stage="done", pages_done=stats["pages"], pages_total=stats["pages_total"],
+                chunks_done=stats["chunks"], stats=json.dumps(stats), finished_at=datetime.utcnow())
+    print(f"✅ Job ingest {job_id} ({job.pdf_name}) hoàn tất")
+
+
+def _worker_loop() -> None:
+    while True:
+        job_id = _job_queue.get()
+        try:
+            _run_job(job_id)
+        except Exception as e:
+            print(f"Lỗi khi chạy job ingest {job_id}: {str(e)}")
+
+
+def _writer_loop() -> None:
+    from .rag import reload_embeddings  # import lười: tránh vòng import rag -> jobs
+
+    while True:
+        batch = [_commit_queue.get()]
+        while True:
+            try:
+                batch.append(_commit_queue.get_nowait())
+            except queue.Empty:
+                break
+        changed = False
+        for kind, payload, done in batch:
+            try:
+                if kind == "delete":
+                    result = remove_embeddings_by_pdf_name(payload, OUTPUT_DIR)
+                else:
+                    result = commit_segment(*payload)
+                changed = True
+                done.set_result(result)
+            except Exception as e:
+                done.set_exception(e)
+        if changed:
+            # Một lần reload cho cả lô tài liệu vừa đăng ký/xóa
+            try:
+                reload_embeddings()
+            except Exception as e:
+                print(f"Lỗi khi reload embeddings sau ingest: {str(e)}")
+
+
+def remove_document(pdf_name: str) -> bool:
+    """Gỡ embeddings của tài liệu qua thread ghi (rồi reload RAG); chờ xong mới trả về."""
+    if not _threads:
+        # Worker chưa khởi động (vd. khởi động lỗi trước bước ingest_workers): không có ai ghi đồng thời
+        from .rag import reload_embeddings
+
+        removed = remove_embeddings_by_pdf_name(pdf_name, OUTPUT_DIR)
+        reload_embeddings()
+        return removed
+    done = Future()
+    _commit_queue.put(("delete", pdf_name, done))
+    return done.result()
+
+
+def _owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _owner_alive(owner: str | None) -> bool | None:
+    """Process owner còn sống không; None nếu không kiểm tra được (máy khác, Windows, job chưa có owner)."""
+    host, _, pid = (owner or "").rpartition(":")
+    # Windows: os.kill(pid, 0) kết thúc process chứ không chỉ kiểm tra
+    if os.name == "nt" or host != socket.gethostname() or not pid.isdigit():
+        return None
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _recover_jobs(startup: bool = False) -> int:
+    """
+    Đưa lại vào hàng đợi job running bị bỏ dở (owner đã chết hoặc mất heartbeat quá JOB_STALE_SECONDS).
+    startup: cả job queued (hàng đợi trong bộ nhớ của process trước đã mất); nếu job đó thuộc hàng đợi của một
+    process khác còn sống thì _claim_job vẫn bảo đảm chỉ một worker chạy nó. Trả về số job đưa lại.
+    """
+    db = SessionLocal()
+    try:
+        stale_before = datetime.utcnow() - timedelta(seconds=JOB_STALE_SECONDS)
+        jobs = (
+            db.query(IngestJob)
+            .filter(IngestJob.status.in_(ACTIVE_STATUSES))
+            .order_by(IngestJob.created_at)
+            .all()
+        )
+        recovered = []
+        for job in jobs:
+            if job.status == "queued":
+                if startup:
+                    recovered.append(job.id)
+                continue
+            if job.owner == _owner():
+                continue
+            alive = _owner_alive(job.owner)
+            if alive or (alive is None and job.updated_at is not None and job.updated_at > stale_before):
+                continue
+            # Chỉ reset khi job không đổi từ lúc đọc (không bị process khác nhận lại hay vừa heartbeat)
+            reset = (
+                db.query(IngestJob)
+                .filter(IngestJob.id == job.id, IngestJob.status == "running", IngestJob.owner == job.owner,
+                        IngestJob.updated_at == job.updated_at)
+                .update({IngestJob.status: "queued", IngestJob.stage: "queued", IngestJob.owner: None},
+                        synchronize_session=False)
+            )
+            if reset:
+                recovered.append(job.id)
+        db.commit()
+    finally:
+        db.close()
+    for job_id in recovered:
+        _job_queue.put(job_id)
+    return len(recovered)
+
+
+def _heartbeat_loop() -> None:
+    while True:
+        time.sleep(JOB_HEARTBEAT_INTERVAL)
+        try:
+            db = SessionLocal()
+            try:
+                (
+                    db.query(IngestJob)
+                    .filter(IngestJob.status == "running", IngestJob.owner == _owner())
+                    .update({IngestJob.updated_at: datetime.utcnow()}, synchronize_session=False)
+                )
+                db.commit()
+            finally:
+                db.close()
+            recovered = _recover_jobs()
+            if recovered:
+                print(f"🔁 Nhận lại {recovered} job ingest bị bỏ dở")
+        except Exception as e:
+            print(f"Lỗi heartbeat job ingest: {str(e)}")
+
+
+def start_workers() -> None:
+    """Khởi động worker, thread ghi và thread heartbeat (một lần mỗi process), đưa lại các job dở dang vào hàng đợi."""
+    with _lock:
+        if _threads:
+            return
+        recovered = _recover_jobs(startup=True)
+        if recovered:
+            print(f"🔁 Tiếp tục {recovered} job ingest chưa xong")
+        _threads.append(threading.Thread(target=_writer_loop, name="ingest-writer", daemon=True))
+        _threads.append(threading.Thread(target=_heartbeat_loop, name="ingest-heartbeat", daemon=True))
+        for i in range(max(1, INGEST_WORKERS)):
+            _threads.append(threading.Thread(target=_worker_loop, name=f"ingest-worker-{i}", daemon=True))
+        for thread in _threads:
+            thread.start()
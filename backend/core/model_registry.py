@@ -0,0 +1,160 @@
+# model_registry.py: Nơi duy nhất nạp model trong process (mỗi model nạp một lần, khi cần lần đầu)
+#
+#   - get_embedding_model(): backend embedding e5 (torch/onnx, xem embedding_backend.py)
+#   - get_embedding_tokenizer(): tokenizer của e5 cho chunker (không cần nạp cả model)
+#   - get_llm_tokenizer(), get_llm(): tokenizer và LLM 4-bit
+# embeding.py (ingest) và rag.py (truy vấn) cùng dùng các accessor này nên mỗi worker chỉ giữ một bản e5.
+# Mỗi model có khóa riêng: nhiều thread gọi cùng lúc thì chỉ một thread nạp, các thread khác chờ.
+# model_stats() trả về thời gian nạp và bộ nhớ của từng model đã nạp.
+
+import os
+import time
+import threading
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+EMBEDDING_MODEL_PATH = os.getenv("EMBEDDING_MODEL_PATH", "D:/Vian/Step2_Embeding_and_VectorDB/models/multilingual_e5_large")
+LLM_MODEL_PATH = os.getenv("LLM_MODEL_PATH", "D:/Vian/Step3_RAG_and_LLM/models/vinallama-2.7b-chat")
+
+_entries = {}  # tên -> {"value", "load_seconds", "memory_bytes", "rss_delta_bytes", "loaded_at"}
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+def _rss_bytes() -> int | None:
+    """RSS hiện tại của process (Linux, đọc /proc); None nếu không có."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _memory_bytes(value) -> int | None:
+    """Bộ nhớ trọng số của model (None với tokenizer: xem rss_delta_bytes)."""
+    if hasattr(value, "memory_bytes"):
+        return value.memory_bytes()
+    if hasattr(value, "get_memory_footprint"):
+        return int(value.get_memory_footprint())
+    return None
+
+
+def _load_once(name: str, loader):
+    entry = _entries.get(name)
+    if entry is not None:
+        return entry["value"]
+    with _locks_guard:
+        lock = _locks.setdefault(name, threading.Lock())
+    with lock:
+        entry = _entries.get(name)
+        if entry is None:
+            rss_before = _rss_bytes()
+            started = time.perf_counter()
+            value = loader()
+            seconds = time.perf_counter() - started
+            rss_after = _rss_bytes()
+            entry = {
+                "value": value,
+                "load_seconds": round(seconds, 2),
+                "memory_bytes": _memory_bytes(value),
+                "rss_delta_bytes": rss_after - rss_before if rss_before is not None and rss_after is not None else None,
+                "loaded_at": time.time(),
+            }
+            _entries[name] = entry
+            print(f"📥 Đã nạp {name} trong {seconds:.1f}s")
+    return entry["value"]
+
+
+def _load_embedding_model():
+    from .embedding_backend import load_embedding_backend
+
+    return load_embedding_backend(EMBEDDING_MODEL_PATH)
+
+
+def _load_embedding_tokenizer():
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(EMBEDDING_MODEL_PATH)
+
+
+def _load_llm_tokenizer():
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(LLM_MODEL_PATH)
+    tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+
+def _load_llm():
+    import torch
+    from transformers import AutoModelForCausalLM, BitsAndBytesConfig
+
+    bnb_config = BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_use_double_quant=True,
+        bnb_4bit_quant_type="nf4",
+        bnb_4bit_compute_dtype=torch.float16,
+    )
+    model = AutoModelForCausalLM.from_pretrained(
+        LLM_MODEL_PATH,
+        quantization_config=bnb_config,
+        device_map={"": 0},
+    )
+    model.eval()
+    return model
+
+
+def get_embedding_model():
+    return _load_once("embedding_model", _load_embedding_model)
+
+
+def get_embedding_tokenizer():
+    return _load_once("embedding_tokenizer", _load_embedding_tokenizer)
+
+
+def get_llm_tokenizer():
+    return _load_once("llm_tokenizer", _load_llm_tokenizer)
+
+
+def get_llm():
+    return _load_once("llm", _load_llm)
+
+
+def is_loaded(name: str) -> bool:
+    return name in _entries
+
+
+def set_model(name: str, value) -> None:
+    """Đặt sẵn một model đã nạp ở nơi khác (benchmark dùng tokenizer/model tùy chọn)."""
+    with _locks_guard:
+        lock = _locks.setdefault(name, threading.Lock())
+    with lock:
+        _entries[name] = {
+            "value": value,
+            "load_seconds": 0.0,
+            "memory_bytes": _memory_bytes(value),
+            "rss_delta_bytes": None,
+            "loaded_at": time.time(),
+        }
+
+
+def model_stats() -> dict:
+    """Thời gian nạp và bộ nhớ (trọng số, mức tăng RSS khi nạp) của các model đã nạp."""
+    stats = {}
+    for name in ("embedding_model", "embedding_tokenizer", "llm_tokenizer", "llm"):
+        entry = _entries.get(name)
+        if entry is None:
+            stats[name] = {"loaded": False}
+            continue
+        stats[name] = {
+            "loaded": True,
+            "type": type(entry["value"]).__name__,
+            "load_seconds": entry["load_seconds"],
+            "memory_mb": round(entry["memory_bytes"] / 2**20, 1) if entry["memory_bytes"] is not None else None,
+            "rss_delta_mb": round(entry["rss_delta_bytes"] / 2**20, 1) if entry["rss_delta_bytes"] is not None else None,
+        }
+    rss = _rss_bytes()
+    stats["process_rss_mb"] = round(rss / 2**20, 1) if rss is not None else None
+    return stats
@@ -0,0 +1,261 @@
+# ocr.py: Trích text từng trang PDF: dùng lớp text sẵn có nếu đủ tốt, còn lại OCR song song
+#
+# Module này chỉ import PyMuPDF/pytesseract/PIL để process con khởi động nhanh
+# (không kéo theo torch/sentence-transformers như core.embeding).
+
+import os
+import io
+import multiprocessing
+import re
+import time
+import statistics
+import unicodedata
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeoutError
+
+import fitz  # PyMuPDF
+import pytesseract
+from PIL import Image, ImageEnhance, ImageFilter
+
+OCR_CONFIG = r'--oem 3 --psm 6 -l vie+eng'
+# Số process OCR song song (1 = chạy tuần tự trong process hiện tại)
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", str(os.cpu_count() or 1)))
+# Thời gian tối đa (giây) cho Tesseract trên một trang; quá hạn thì trang đó để trống
+OCR_PAGE_TIMEOUT = float(os.getenv("OCR_PAGE_TIMEOUT", "120"))
+# Dùng lớp text gốc của PDF (born-digital) thay cho OCR khi chất lượng đạt ngưỡng
+USE_TEXT_LAYER = os.getenv("PDF_USE_TEXT_LAYER", "1") != "0"
+TEXT_LAYER_MIN_CHARS = int(os.getenv("PDF_TEXT_LAYER_MIN_CHARS", "50"))
+TEXT_LAYER_MIN_VALID_RATIO = float(os.getenv("PDF_TEXT_LAYER_MIN_VALID_RATIO", "0.9"))
+
+_VI_LETTERS = (
+    "aàáạảãâầấậẩẫăằắặẳẵeèéẹẻẽêềếệểễiìíịỉĩoòóọỏõôồốộổỗơờớợởỡ"
+    "uùúụủũưừứựửữyỳýỵỷỹđbcdfghjklmnpqrstvwxz"
+)
+_VALID_CHARS = set(_VI_LETTERS + _VI_LETTERS.upper() + "0123456789" + " \t\n\r.,;:()[]{}?!\"'-–—…°%‰≥≤→←≠=+/*<>§&@#_“”‘’•")
+
+# Chọn độ phóng khi render trang để OCR (thay cho cố định 2.5x):
+#   - trang scan: theo độ phân giải gốc của ảnh nhúng, không quá OCR_DEFAULT_ZOOM
+#     (render to hơn ảnh gốc không thêm thông tin, chỉ tốn thời gian Tesseract)
+#   - trang có span text (font lỗi): sao cho chữ cao khoảng OCR_TARGET_GLYPH_PX pixel
+#   - còn lại: OCR_DEFAULT_ZOOM; luôn kẹp trong [OCR_MIN_ZOOM, OCR_MAX_ZOOM] và OCR_MAX_PIXELS
+OCR_DEFAULT_ZOOM = float(os.getenv("OCR_DEFAULT_ZOOM", "2.5"))
+OCR_MIN_ZOOM = float(os.getenv("OCR_MIN_ZOOM", "1.5"))
+OCR_MAX_ZOOM = float(os.getenv("OCR_MAX_ZOOM", "4.0"))
+OCR_TARGET_GLYPH_PX = float(os.getenv("OCR_TARGET_GLYPH_PX", "32"))
+OCR_MAX_PIXELS = int(os.getenv("OCR_MAX_PIXELS", str(12_000_000)))
+
+# Mỗi process con giữ PDF đang xử lý mở sẵn để không phải mở lại cho từng trang
+_open_docs = {}
+
+
+def preprocess_image(img):
+    if img.mode != 'L':
+        img = img.convert('L')
+    enhancer = ImageEnhance.Contrast(img)
+    img = enhancer.enhance(1.5)
+    return img.filter(ImageFilter.SHARPEN)
+
+
+def choose_zoom(page):
+    """Chọn độ phóng render cho một trang theo ảnh scan nhúng, cỡ chữ ước lượng và kích thước trang."""
+    zoom = OCR_DEFAULT_ZOOM
+    rect = page.rect
+    images = page.get_image_info()
+    if images:
+        # Ảnh lớn nhất trên trang; zoom = số pixel ảnh / số point mà ảnh chiếm trên trang
+        largest = max(images, key=lambda info: info["width"] * info["height"])
+        bbox_width = fitz.Rect(largest["bbox"]).width
+        if bbox_width > 0 and bbox_width >= rect.width * 0.5:
+            zoom = min(largest["width"] / bbox_width, OCR_DEFAULT_ZOOM)
+    else:
+        sizes = [
+            span["size"]
+            for block in page.get_text("dict").get("blocks", [])
+            for line in block.get("lines", [])
+            for span in line.get("spans", [])
+            if span.get("size", 0) > 0 and span.get("text", "").strip()
+        ]
+        if sizes:
+            zoom = OCR_TARGET_GLYPH_PX / statistics.median(sizes)
+    zoom = min(max(zoom, OCR_MIN_ZOOM), OCR_MAX_ZOOM)
+    # Trang khổ lớn (A3, bản vẽ) không được vượt quá ngân sách pixel
+    if rect.width * rect.height * zoom * zoom > OCR_MAX_PIXELS:
+        zoom = (OCR_MAX_PIXELS / (rect.width * rect.height)) ** 0.5
+    return zoom
+
+
+def render_page_gray(page, zoom):
+    """
+    Render thẳng ra ảnh xám và dựng ảnh PIL từ buffer pixmap (không qua PNG encode/decode).
+    """
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+    img = Image.frombuffer("L", (pix.width, pix.height), pix.samples_mv, "raw", "L", pix.stride, 1)
+    processed = preprocess_image(img)
+    # preprocess_image tạo ảnh mới; bỏ ảnh trỏ vào buffer pixmap trước khi pixmap được giải phóng
+    del img
+    return processed
+
+
+def render_page_legacy(page):
+    """Đường render cũ (RGB 2.5x -> PNG -> PIL -> xám), giữ lại để so sánh trong benchmark."""
+    pix = page.get_pixmap(matrix=fitz.Matrix(2.5, 2.5))
+    img = Image.open(io.BytesIO(pix.tobytes("png")))
+    return preprocess_image(img)
+
+
+def ocr_page(doc, page_num, page_timeout=None):
+    """
+    Render một trang và OCR bằng Tesseract.
+    Trả về (text đã strip, thống kê {zoom, render_ms, ocr_ms}) để đo thời gian từng bước.
+    """
+    page = doc.load_page(page_num)
+    t0 = time.perf_counter()
+    zoom = choose_zoom(page)
+    img = render_page_gray(page, zoom)
+    t1 = time.perf_counter()
+    try:
+        page_text = pytesseract.image_to_string(img, config=OCR_CONFIG, timeout=page_timeout or 0)
+    except RuntimeError as e:
+        # pytesseract báo RuntimeError khi hết thời gian cho phép
+        print(f"⏱️ OCR trang {page_num + 1} quá {page_timeout}s, bỏ qua: {str(e)}")
+        page_text = ""
+    t2 = time.perf_counter()
+    stats = {
+        "zoom": round(zoom, 2),
+        "render_ms": round((t1 - t0) * 1000, 1),
+        "ocr_ms": round((t2 - t1) * 1000, 1),
+    }
+    return page_text.strip(), stats
+
+
+def text_layer_quality(text):
+    """
+    Đánh giá lớp text gốc của một trang: (số ký tự không trắng, tỉ lệ ký tự hợp lệ).
+    Font mã hóa cũ (TCVN3/VNI) hoặc font thiếu bảng ToUnicode cho ra ký tự lạ
+    ("Ò", "µ", "\ufffd", "(cid:..)") nên tỉ lệ ký tự hợp lệ thấp.
+    """
+    text = unicodedata.normalize("NFC", text)
+    chars = [c for c in text if not c.isspace()]
+    if not chars:
+        return 0, 0.0
+    valid = sum(1 for c in chars if c in _VALID_CHARS)
+    if "(cid:" in text:
+        valid = 0
+    return len(chars), valid / len(chars)
+
+
+def native_page_text(page):
+    """Trả về text gốc của trang nếu đạt ngưỡng chất lượng, ngược lại None (cần OCR)."""
+    text = unicodedata.normalize("NFC", page.get_text("text"))
+    text = re.sub(r'[ \t]+\n', '\n', text).strip()
+    char_count, valid_ratio = text_layer_quality(text)
+    if char_count >= TEXT_LAYER_MIN_CHARS and valid_ratio >= TEXT_LAYER_MIN_VALID_RATIO:
+        return text, char_count, valid_ratio
+    return None, char_count, valid_ratio
+
+
+def _worker_init():
+    # Mỗi process đã chiếm một core: không để Tesseract tự mở thêm thread OpenMP
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+
+def _ocr_page_worker(pdf_path, page_num, page_timeout):
+    doc = _open_docs.get(pdf_path)
+    if doc is None:
+        for old_doc in _open_docs.values():
+            old_doc.close()
+        _open_docs.clear()
+        doc = fitz.open(pdf_path)
+        _open_docs[pdf_path] = doc
+    return ocr_page(doc, page_num, page_timeout)
+
+
+def iter_pages(pdf_path, workers=None, page_timeout=None, use_text_layer=None, window=None):
+    """
+    Sinh (text, info) cho từng trang theo đúng thứ tự trang, ngay khi trang đó xong.
+    Trang có lớp text gốc đạt chất lượng được lấy trực tiếp (micro giây); các trang
+    scan hoặc text lỗi font được OCR song song khi workers > 1. Chỉ tối đa `window`
+    trang đang chờ cùng lúc nên bộ nhớ không phụ thuộc số trang của PDF.
+    info ghi lại cách trích của trang và, với trang OCR, độ phóng cùng thời gian render/OCR.
+    """
+    workers = workers or OCR_WORKERS
+    page_timeout = page_timeout if page_timeout is not None else OCR_PAGE_TIMEOUT
+    use_text_layer = USE_TEXT_LAYER if use_text_layer is None else use_text_layer
+    window = window or max(2, workers * 2)
+
+    pool = None
+    pending = deque()  # (info, text hoặc future), giữ thứ tự trang
+
+    def resolve(info, result):
+        if isinstance(result, str):
+            return result, info
+        try:
+            # Tesseract đã tự giới hạn thời gian; đây chỉ là chốt chặn cho bước render
+            text, stats = result.result(timeout=page_timeout * 2 if page_timeout else None)
+        except FuturesTimeoutError:
+            print(f"⏱️ Trang {info['page']} của {pdf_path} không xong kịp, bỏ qua")
+            text, stats = "", {"timeout": True}
+        info.update(stats)
+        return text, info
+
+    try:
+        with fitz.open(pdf_path) as doc:
+            for page_num in range(len(doc)):
+                text, char_count, valid_ratio = (None, 0, 0.0)
+                if use_text_layer:
+                    text, char_count, valid_ratio = native_page_text(doc.load_page(page_num))
+                info = {
+                    "page": page_num + 1,
+                    "method": "text" if text is not None else "ocr",
+                    "text_layer_chars": char_count,
+                    "text_layer_valid_ratio": round(valid_ratio, 3),
+                }
+                if text is None and workers <= 1:
+                    text, stats = ocr_page(doc, page_num, page_timeout)
+                    info.update(stats)
+                elif text is None:
+                    if pool is None:
+                        # spawn: không fork process server (đang có thread lập lịch/ingest, model và CUDA đã nạp)
+                        pool = ProcessPoolExecutor(max_workers=workers, initializer=_worker_init,
+                                                   mp_context=multiprocessing.get_context("spawn"))
+                    text = pool.submit(_ocr_page_worker, pdf_path, page_num, page_timeout)
+                pending.append((info, text))
+                # Trả các trang đầu hàng đã xong; chỉ chờ khi cửa sổ đã đầy
+                while pending and (len(pending) >= window or isinstance(pending[0][1], str) or pending[0][1].done()):
+                    yield resolve(*pending.popleft())
+        while pending:
+            yield resolve(*pending.popleft())
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+def summarize_pages(pdf_path, pages_info):
+    """In số trang dùng lớp text / OCR và tổng thời gian render, Tesseract."""
+    ocr_count = sum(1 for info in pages_info if info["method"] == "ocr")
+    render_ms = sum(info.get("render_ms", 0) for info in pages_info)
+    ocr_ms = sum(info.get("ocr_ms", 0) for info in pages_info)
+    print(
+        f"📄 {pdf_path}: {len(pages_info) - ocr_count} trang dùng lớp text, {ocr_count} trang OCR "
+        f"(render {render_ms / 1000:.1f}s, tesseract {ocr_ms / 1000:.1f}s tổng CPU)"
+    )
+
+
+def extract_pages(pdf_path, workers=None, page_timeout=None, use_text_layer=None):
+    """
+    Trích text toàn bộ trang của một PDF theo đúng thứ tự trang.
+    Trả về (texts, pages_info) với pages_info ghi lại cách trích của từng trang.
+    """
+    texts = []
+    pages_info = []
+    for text, info in iter_pages(pdf_path, workers=workers, page_timeout=page_timeout, use_text_layer=use_text_layer):
+        texts.append(text)
+        pages_info.append(info)
+    summarize_pages(pdf_path, pages_info)
+    return texts, pages_info
+
+
+def ocr_pages(pdf_path, workers=None, page_timeout=None):
+    """OCR toàn bộ trang (bỏ qua lớp text gốc), trả về danh sách text theo thứ tự trang."""
+    texts, _ = extract_pages(pdf_path, workers=workers, page_timeout=page_timeout, use_text_layer=False)
+    return texts
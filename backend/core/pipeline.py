@@ -0,0 +1,280 @@
+# pipeline.py: Ingest PDF theo dạng luồng: OCR -> làm sạch -> chunk -> embed chạy chồng lên nhau
+#
+#   [thread OCR]    iter_pages(): trang xong đến đâu đẩy sang hàng đợi đến đó (OCR trên process con)
+#   [thread chunk]  làm sạch từng đoạn, tách section, gom câu thành chunk
+#   [thread gọi]    embed từng nhóm EMBED_BATCH_SIZE chunk và ghi dần vào một segment của kho chunk
+#
+# Các hàng đợi giữa các bước có kích thước cố định (PIPELINE_QUEUE_SIZE) nên bộ nhớ không phụ thuộc
+# số trang PDF; thời gian ingest xấp xỉ bước chậm nhất thay vì tổng các bước.
+# Kết quả chunk giống hệt chạy tuần tự ocr_pdf_to_text -> clean_text -> split_text_to_chunks_...
+
+import os
+import re
+import json
+import time
+import queue
+import threading
+
+import fitz  # PyMuPDF
+from underthesea import sent_tokenize
+
+from .ocr import iter_pages, summarize_pages
+from .embeding import (
+    OUTPUT_DIR,
+    SECTION_PATTERN,
+    SectionChunker,
+    chunk_store,
+    chunk_token_stats,
+    clean_text_fragment,
+    commit_segment,
+    create_embeddings,
+)
+
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "8"))
+# Số chunk mỗi lần gọi engine embed; engine tự chia tiếp theo độ dài token nên nên để lớn
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "256"))
+# Section dài hơn ngưỡng này (ký tự) được chunk dần theo câu thay vì giữ cả section trong RAM: SectionChunker
+# giữ chunk dở và phần gối đầu qua các lần chunk dần, câu cuối (có thể chưa trọn) chờ phần văn bản sau, nên
+# chunk vẫn giống hệt chunk cả section (kiểm tra: bench_chunker --stream-section-chars)
+PIPELINE_MAX_SECTION_CHARS = int(os.getenv("PIPELINE_MAX_SECTION_CHARS", "200000"))
+
+# Vị trí cắt an toàn cho bước làm sạch: ngay sau ký tự \w cuối cùng đứng trước một ký tự \w
+_SAFE_CUT = re.compile(r".*\w(?=\w)", re.S)
+_DONE = object()
+
+
+class _StageError:
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def threaded(iterable, maxsize=None):
+    """
+    Chạy iterable trên một thread riêng, trả về generator đọc kết quả qua hàng đợi giới hạn.
+    Lỗi ở thread nguồn được ném lại phía đọc; phía đọc dừng sớm thì thread nguồn cũng dừng.
+    """
+    items = queue.Queue(maxsize or PIPELINE_QUEUE_SIZE)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(_DONE)
+        except BaseException as e:
+            put(_StageError(e))
+        finally:
+            close = getattr(iterable, "close", None)
+            if close is not None and stop.is_set():
+                close()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _StageError):
+                raise item.exc
+            yield item
+    finally:
+        stop.set()
+
+
+def clean_stream(pieces):
+    """
+    Làm sạch văn bản đến theo từng đoạn (từng trang). Chỉ cắt giữa hai ký tự \\w nên
+    ghép các đoạn đã làm sạch bằng đúng clean_text(cả văn bản), kể cả strip hai đầu.
+    """
+    buffer = ""
+    pending = None
+    started = False
+    for piece in pieces:
+        buffer += piece
+        match = _SAFE_CUT.match(buffer)
+        if not match:
+            continue
+        cleaned = clean_text_fragment(buffer[:match.end()])
+        buffer = buffer[match.end():]
+        if not started:
+            cleaned = cleaned.lstrip()
+            started = bool(cleaned)
+        if pending:
+            yield pending
+        pending = cleaned
+    tail = clean_text_fragment(buffer)
+    if not started:
+        tail = tail.lstrip()
+    last = ((pending or "") + tail).rstrip()
+    if last:
+        yield last
+
+
+def _with_tokens(chunker, chunks):
+    """Ghép các chunk vừa trả ra với số token tương ứng mà chunker đã đếm."""
+    return zip(chunks, chunker.chunk_tokens[len(chunker.chunk_tokens) - len(chunks):])
+
+
+def _chunk_section(chunker, section):
+    return _with_tokens(chunker, chunker.add_many(sent_tokenize(section)))
+
+
+def chunk_stream(fragments, chunk_size=512, overlap=50):
+    """
+    Tách section và chunk văn bản đã làm sạch đến theo từng đoạn. Một section chỉ được chunk
+    khi đã thấy ranh giới section kế tiếp, nên kết quả trùng với split_text_to_chunks_vi_tokenized_with_section.
+    Sinh các cặp (chunk, số token).
+    """
+    buffer = ""
+    chunker = SectionChunker(chunk_size, overlap)
+    flush_at = PIPELINE_MAX_SECTION_CHARS
+    for fragment in fragments:
+        # Ranh giới mới chỉ có thể bắt đầu từ dấu xuống dòng cuối của phần đã quét
+        scan_from = max(buffer.rfind("\n"), 0)
+        buffer += fragment
+        start = 0
+        for match in SECTION_PATTERN.finditer(buffer, scan_from):
+            section = buffer[start:match.start()].strip()
+            if section:
+                yield from _chunk_section(chunker, section)
+            # Section đã chunk dần (flush bên dưới) có thể kết thúc ngay đầu buffer
+            if section or chunker.current_chunk:
+                yield from _with_tokens(chunker, chunker.finish())
+                chunker = SectionChunker(chunk_size, overlap)
+            start = match.end()
+        buffer = buffer[start:]
+        if start:
+            flush_at = PIPELINE_MAX_SECTION_CHARS
+        if len(buffer) > flush_at:
+            # Section quá dài: chunk trước các câu đã trọn, giữ lại câu cuối (có thể chưa hết)
+            sentences = sent_tokenize(buffer.strip())
+            cut = buffer.rfind(sentences[-1]) if len(sentences) > 1 else -1
+            # Giữ cả khoảng trắng trước câu cuối: "\n" đứng trước tiêu đề mục là một phần của ranh giới section
+            while cut > 0 and buffer[cut - 1].isspace():
+                cut -= 1
+            if cut > 0:
+                yield from _with_tokens(chunker, chunker.add_many(sentences[:-1]))
+                buffer = buffer[cut:]
+            else:
+                flush_at = len(buffer) * 2
+    section = buffer.strip()
+    if section:
+        yield from _chunk_section(chunker, section)
+    yield from _with_tokens(chunker, chunker.finish())
+
+
+def build_segment(pdf_path, output_dir=OUTPUT_DIR, workers=None, batch_size=None, progress=None):
+    """
+    OCR, làm sạch, chunk và embed một PDF theo dạng luồng vào một segment chưa đăng ký.
+    Ghi {pdf}_ocr.txt, {pdf}_clean.txt dần theo trang và {pdf}_pages.json khi xong.
+    progress(stats) (nếu có) được gọi sau mỗi trang và mỗi lô embed, stats["stage"] là bước chậm nhất còn chạy.
+    Trả về (SegmentWriter, stats); người gọi đăng ký segment bằng embeding.commit_segment().
+    Ném ValueError nếu không trích được chữ nào.
+    """
+    batch_size = batch_size or EMBED_BATCH_SIZE
+    pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
+    doc_dir = os.path.join(output_dir, pdf_name)
+    os.makedirs(doc_dir, exist_ok=True)
+    with fitz.open(pdf_path) as doc:
+        pages_total = len(doc)
+    stats = {"pdf_name": pdf_name, "stage": "ocr", "pages": 0, "pages_total": pages_total, "ocr_pages": 0,
+             "text_chars": 0, "chunks": 0, "ocr_seconds": 0.0, "chunk_seconds": 0.0, "embed_seconds": 0.0}
+    pages_info = []
+    started_at = time.perf_counter()
+    report = progress or (lambda stats: None)
+
+    def pages():
+        # Bước OCR: ghi _ocr.txt ngay khi có trang mới thay vì ghép cả văn bản trong RAM
+        with open(os.path.join(doc_dir, f"{pdf_name}_ocr.txt"), "w", encoding="utf-8") as ocr_file:
+            t0 = time.perf_counter()
+            for text, info in iter_pages(pdf_path, workers=workers):
+                stats["ocr_seconds"] += time.perf_counter() - t0
+                pages_info.append(info)
+                stats["pages"] += 1
+                stats["ocr_pages"] += info["method"] == "ocr"
+                stats["text_chars"] += len(text)
+                if stats["pages"] == pages_total:
+                    stats["stage"] = "embed"
+                ocr_file.write(text)
+                report(stats)
+                yield text
+                t0 = time.perf_counter()
+
+    def chunks():
+        with open(os.path.join(doc_dir, f"{pdf_name}_clean.txt"), "w", encoding="utf-8") as clean_file:
+            def cleaned():
+                for fragment in clean_stream(threaded(pages())):
+                    clean_file.write(fragment)
+                    yield fragment
+            # Đo CPU của riêng thread này để không tính thời gian chờ trang OCR
+            t0 = time.thread_time()
+            for chunk in chunk_stream(cleaned()):
+                stats["chunk_seconds"] += time.thread_time() - t0
+                yield chunk
+                t0 = time.thread_time()
+
+    writer = chunk_store().begin_segment()
+    stream = threaded(chunks())
+    try:
+        batch = []
+        for chunk in stream:
+            batch.append(chunk)
+            if len(batch) >= batch_size:
+                _embed_batch(writer, batch, stats)
+                report(stats)
+                batch = []
+        if batch:
+            _embed_batch(writer, batch, stats)
+    except BaseException:
+        stream.close()
+        writer.abort()
+        raise
+
+    with open(os.path.join(doc_dir, f"{pdf_name}_pages.json"), "w", encoding="utf-8") as f:
+        json.dump(pages_info, f, ensure_ascii=False, indent=2)
+    summarize_pages(pdf_path, pages_info)
+    if stats["text_chars"] == 0:
+        writer.abort()
+        raise ValueError(f"Không trích được văn bản từ {pdf_path}")
+
+    stats["stage"] = "commit"
+    stats["total_seconds"] = round(time.perf_counter() - started_at, 2)
+    for key in ("ocr_seconds", "chunk_seconds", "embed_seconds"):
+        stats[key] = round(stats[key], 2)
+    print(
+        f"⏱️ Ingest {pdf_name}: {stats['pages']} trang, {stats['chunks']} chunk trong {stats['total_seconds']}s "
+        f"(OCR {stats['ocr_seconds']}s, chunk {stats['chunk_seconds']}s, embed {stats['embed_seconds']}s)"
+    )
+    report(stats)
+    return writer, stats
+
+
+def ingest_pdf(pdf_path, output_dir=OUTPUT_DIR, workers=None, batch_size=None, progress=None):
+    """
+    OCR, làm sạch, chunk, embed và lưu một PDF theo dạng luồng, rồi cập nhật FAISS index.
+    Trả về thống kê (số trang, số chunk, thời gian từng bước). Ném ValueError nếu không trích được chữ nào.
+    """
+    writer, stats = build_segment(pdf_path, output_dir, workers=workers, batch_size=batch_size, progress=progress)
+    commit_segment(writer, pdf_path)
+    stats["stage"] = "done"
+    return stats
+
+
+def _embed_batch(writer, batch, stats):
+    t0 = time.perf_counter()
+    chunks = [chunk for chunk, _ in batch]
+    embeddings = create_embeddings(chunks, show_progress_bar=False, token_counts=[tokens for _, tokens in batch])
+    writer.add(chunks, embeddings, chunk_token_stats(chunks, writer.last_text))
+    stats["embed_seconds"] += time.perf_counter() - t0
+    stats["chunks"] = writer.rows
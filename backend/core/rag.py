@@ -1,111 +1,107 @@
 import os
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig, TextIteratorStreamer
-from sentence_transformers import SentenceTransformer
-import faiss
-import pickle
 import numpy as np
 from dotenv import load_dotenv
 import re  # Cho sanitize
-from threading import Thread
+import hashlib
+import asyncio
+import threading
+import contextlib
+
+from . import vector_index
+from . import corpus
+from .cache import cache_from_env, AnswerCache
+from .model_registry import get_embedding_model, get_llm, get_llm_tokenizer
+from .generation import get_scheduler
+from .context_packer import pack_context
+from .sessions import session_store, SessionState
 
 load_dotenv()
 
 # Paths từ .env
 EMBEDDING_MODEL_PATH = os.getenv("EMBEDDING_MODEL_PATH", "D:/Vian/Step2_Embeding_and_VectorDB/models/multilingual_e5_large")
 LLM_MODEL_PATH = os.getenv("LLM_MODEL_PATH", "D:/Vian/Step3_RAG_and_LLM/models/vinallama-2.7b-chat")
-FAISS_INDEX_PATH = os.getenv("FAISS_INDEX_PATH", "D:/Vian/Demo/backend/results/all_faiss.index")
-EMBEDDINGS_PICKLE_PATH = os.getenv("EMBEDDINGS_PICKLE_PATH", "D:/Vian/Demo/backend/results/all_embeddings.pkl")
 
 # Biến toàn cục để khởi tạo lười
 embedding_model = None
 tokenizer = None
 model = None
-faiss_index = None
-chunks = []
-chunk_metadata = []  # Lưu metadata cho mỗi chunk (pdf_name, index)
+# FAISS index + kho chunk nằm trong snapshot bất biến của corpus.py (corpus.current())
 _initialized = False
 
+# Cache câu hỏi đã sanitize -> embedding (không phụ thuộc kho tài liệu)
+query_embedding_cache = cache_from_env("QUERY_EMBEDDING_CACHE", 4096, 3600)
+# Cache (embedding, phạm vi, top_k, phiên bản snapshot) -> chunk IDs; xóa khi kho thay đổi
+retrieval_cache = cache_from_env("RETRIEVAL_CACHE", 4096, 3600)
+# Cache câu trả lời: (câu hỏi chuẩn hóa, phạm vi, tập chunk ID, phiên bản prompt/model) -> answer
+# ANSWER_CACHE_SIMILARITY > 0 bật tra câu hỏi gần trùng theo cosine embedding
+answer_cache = AnswerCache(
+    int(os.getenv("ANSWER_CACHE_MAX_BYTES", str(32 * 1024 * 1024))),
+    float(os.getenv("ANSWER_CACHE_SIMILARITY", "0")),
+)
+_prompt_version = None
+_prefix_token_ids = None  # token ID của các khối system cố định (prefix_length)
+
+NO_INFO_ANSWER = "Tôi không có thông tin về vấn đề này trong các tài liệu hiện có."
+
 
 def ensure_initialized() -> None:
-    global embedding_model, tokenizer, model, faiss_index, chunks, chunk_metadata, _initialized
+    global embedding_model, tokenizer, model, _initialized
     if _initialized:
         return
 
-    # Load embedding model
-    if embedding_model is None:
-        embedding_model = SentenceTransformer(EMBEDDING_MODEL_PATH)
-
-    # Load tokenizer và LLM 4-bit
-    if tokenizer is None or model is None:
-        tokenizer = AutoTokenizer.from_pretrained(LLM_MODEL_PATH)
-        tokenizer.pad_token = tokenizer.eos_token
-        bnb_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_use_double_quant=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=torch.float16,
-        )
-        model = AutoModelForCausalLM.from_pretrained(
-            LLM_MODEL_PATH,
-            quantization_config=bnb_config,
-            device_map={"": 0},
-        )
-        model.eval()
-
-    # Load FAISS index và chunks nếu tồn tại; nếu không, dùng cấu hình rỗng an toàn
-    if os.path.exists(FAISS_INDEX_PATH) and os.path.exists(EMBEDDINGS_PICKLE_PATH):
-        faiss_index = faiss.read_index(FAISS_INDEX_PATH)
-        with open(EMBEDDINGS_PICKLE_PATH, "rb") as f:
-            data = pickle.load(f)
-        chunks = []
-        chunk_metadata = []
-        for item in data:
-            pdf_name = item.get("pdf_name", "unknown")
-            item_chunks = item.get("chunks", [])
-            chunks.extend(item_chunks)
-            # Lưu metadata cho mỗi chunk
-            for i in range(len(item_chunks)):
-                chunk_metadata.append({
-                    "pdf_name": pdf_name,
-                    "chunk_index": i
-                })
-    else:
-        faiss_index = None
-        chunks = []
-        chunk_metadata = []
+    # Model dùng chung cả process (cùng bản e5 với phần ingest trong embeding.py)
+    embedding_model = get_embedding_model()
+    tokenizer = get_llm_tokenizer()
+    model = get_llm()
+
+    # Load FAISS index và kho chunk nếu tồn tại (trừ khi warm-up đã nạp); nếu không, dùng cấu hình rỗng an toàn
+    if not corpus.is_loaded():
+        reload_embeddings()
 
     _initialized = True
 
 
-def reload_embeddings() -> None:
+def reload_embeddings(wait: bool = True):
     """
     Reload embeddings và FAISS index từ file system.
     Được gọi khi có thay đổi trong tài liệu (thêm/xóa file).
+    Snapshot mới được dựng trên thread nền rồi thay snapshot cũ bằng một phép gán; truy vấn đang chạy
+    không bị chặn và dùng tiếp snapshot cũ. wait=True: trả về khi snapshot mới đã được publish.
     """
-    global faiss_index, chunks, chunk_metadata
-    
-    # Load FAISS index và chunks nếu tồn tại
-    if os.path.exists(FAISS_INDEX_PATH) and os.path.exists(EMBEDDINGS_PICKLE_PATH):
-        faiss_index = faiss.read_index(FAISS_INDEX_PATH)
-        with open(EMBEDDINGS_PICKLE_PATH, "rb") as f:
-            data = pickle.load(f)
-        chunks = []
-        chunk_metadata = []
-        for item in data:
-            pdf_name = item.get("pdf_name", "unknown")
-            item_chunks = item.get("chunks", [])
-            chunks.extend(item_chunks)
-            # Lưu metadata cho mỗi chunk
-            for i in range(len(item_chunks)):
-                chunk_metadata.append({
-                    "pdf_name": pdf_name,
-                    "chunk_index": i
-                })
-    else:
-        faiss_index = None
-        chunks = []
-        chunk_metadata = []
+    return corpus.reload(wait=wait)
+
+def _on_snapshot_published(snapshot) -> None:
+    retrieval_cache.clear()
+    answer_cache.clear()
+
+corpus.on_publish(_on_snapshot_published)
+
+def get_cache_stats() -> dict:
+    """Bộ đếm hit/miss của các cache truy vấn."""
+    return {
+        "index_version": corpus.version(),
+        "corpus": corpus.current().stats(),
+        "query_embedding": query_embedding_cache.stats(),
+        "retrieval": retrieval_cache.stats(),
+        "answer": answer_cache.stats(),
+        "sessions": session_store.stats(),
+        "context": get_context_stats(),
+    }
+
+def set_search_params(nprobe: int | None = None, ef_search: int | None = None) -> dict:
+    """
+    Điều chỉnh nprobe (IVF-PQ) / efSearch (HNSW) lúc chạy, không cần dựng lại index.
+    Giá trị được giữ lại cho các lần reload sau.
+    """
+    params = corpus.set_search_params(nprobe=nprobe, ef_search=ef_search)
+    # Tham số tìm kiếm đổi thì kết quả có thể đổi
+    retrieval_cache.clear()
+    index = corpus.current().index
+    return {
+        "mode": vector_index.index_mode(index) if index is not None else None,
+        "nprobe": params["nprobe"] or vector_index.NPROBE,
+        "ef_search": params["ef_search"] or vector_index.EF_SEARCH,
+    }
 
 def sanitize_input(text: str) -> str:
     text = re.sub(r'[^\w\s.,;:()\[\]?!\"\'\-–—…°%‰≥≤→←≠=+/*<>\n\r]', '', text)
@@ -206,27 +202,92 @@ def is_response_hallucinated(response: str, context_chunks: list) -> bool:
     
     return False
 
-def get_relevant_chunks(query, top_k=3, max_tokens_per_chunk=512, pdf_name=None):
-    query = sanitize_input(query)
-    if faiss_index is None or len(chunks) == 0:
+def _normalize_scope(pdf_name):
+    """Chuẩn hóa phạm vi tìm kiếm: None (toàn bộ kho), một tên tài liệu hoặc danh sách tên."""
+    if pdf_name is None:
+        return None
+    if isinstance(pdf_name, str):
+        return [pdf_name]
+    # Giữ thứ tự, bỏ trùng
+    return list(dict.fromkeys(pdf_name))
+
+def encode_query(query: str) -> np.ndarray:
+    """Embedding [1, dim] float32 của câu hỏi đã sanitize, có cache."""
+    query_vector = query_embedding_cache.get(query)
+    if query_vector is None:
+        query_vector = embedding_model.encode([query])
+        query_vector.flags.writeable = False
+        query_embedding_cache.put(query, query_vector)
+    return query_vector
+
+def retrieve_chunk_ids(query, top_k=3, pdf_name=None, snapshot=None) -> list:
+    """
+    Trả về danh sách chunk ID liên quan nhất (query đã sanitize).
+    Câu hỏi lặp lại bỏ qua cả encoder lẫn FAISS nhờ cache embedding và cache kết quả.
+    snapshot: snapshot kho mà cả truy vấn dùng (mặc định: snapshot hiện tại).
+    """
+    snapshot = snapshot or corpus.current()
+    if snapshot.empty:
         return []
-    query_vector = embedding_model.encode([query])
-    D, I = faiss_index.search(np.array(query_vector).astype("float32"), top_k)
-    context_chunks = []
-    for i in I[0]:
-        if i < len(chunks):
-            chunk = chunks[i]
-            # Nếu có pdf_name, chỉ lấy chunks từ tài liệu đó
-            if pdf_name is not None and i < len(chunk_metadata):
-                chunk_pdf_name = chunk_metadata[i].get("pdf_name", "")
-                if chunk_pdf_name != pdf_name:
-                    continue  # Bỏ qua chunk không thuộc PDF được chỉ định
-            tokens = tokenizer.tokenize(chunk)
-            if len(tokens) > max_tokens_per_chunk:
-                tokens = tokens[:max_tokens_per_chunk]
-                chunk = tokenizer.convert_tokens_to_string(tokens)
-            context_chunks.append(chunk.strip())
-    return context_chunks
+    view = snapshot.view
+    scope = _normalize_scope(pdf_name)
+    query_vector = encode_query(query)
+    key = (query_vector.tobytes(), tuple(scope) if scope else None, top_k, snapshot.version)
+    chunk_ids = retrieval_cache.get(key)
+    if chunk_ids is not None:
+        return list(chunk_ids)
+    if scope is None:
+        D, I = vector_index.search(snapshot.index, view, query_vector, top_k)
+        ids = I[0]
+    else:
+        _, ids = vector_index.search_documents(view, query_vector[0], scope, top_k)
+    # ids chứa chunk ID (không phải vị trí hàng); -1 nghĩa là không đủ kết quả
+    chunk_ids = tuple(int(i) for i in ids if i >= 0 and view.has_id(int(i)))
+    retrieval_cache.put(key, chunk_ids)
+    return list(chunk_ids)
+
+def chunk_texts(chunk_ids, budget=None, snapshot=None, present=()):
+    """
+    Xếp nội dung các chunk theo ID vào ngữ cảnh (context_packer.pack_context): ghép chunk liền nhau,
+    bỏ phần gối đầu trùng lặp, dừng khi đầy budget token. Không tokenize lúc truy vấn.
+    """
+    return pack_context((snapshot or corpus.current()).view, chunk_ids, budget, present)
+
+def get_relevant_chunks(query, top_k=3, pdf_name=None, budget=None):
+    """
+    Lấy top_k chunk liên quan nhất (đã xếp và bỏ phần trùng lặp, xem chunk_texts).
+    pdf_name có thể là một tên tài liệu hoặc danh sách tên: khi đó chỉ tìm trên vector
+    của các tài liệu này (tìm chính xác), thay vì tìm toàn kho rồi lọc bớt kết quả.
+    """
+    query = sanitize_input(query)
+    snapshot = corpus.current()
+    return chunk_texts(retrieve_chunk_ids(query, top_k, pdf_name, snapshot), budget, snapshot).chunks
+
+def normalize_query(query: str) -> str:
+    """Chuẩn hóa câu hỏi làm khóa cache: chữ thường, gộp khoảng trắng, bỏ dấu câu ở cuối."""
+    query = re.sub(r'\s+', ' ', sanitize_input(query).lower())
+    return query.strip(' .?!…')
+
+def prompt_version() -> str:
+    """
+    Dấu vân tay của template prompt + model + tham số sinh. Đổi template/model thì
+    khóa cache câu trả lời đổi theo, các câu trả lời cũ không còn được dùng.
+    """
+    global _prompt_version
+    if _prompt_version is None:
+        fingerprint = "\n".join([
+            build_prompt(["{context}" * 20], "{question}"),
+            build_prompt([], "{question}"),
+            LLM_MODEL_PATH,
+            repr(GENERATION_KWARGS),
+        ])
+        _prompt_version = hashlib.sha1(fingerprint.encode("utf-8")).hexdigest()[:16]
+    return _prompt_version
+
+def _answer_context_key(chunk_ids, pdf_name, max_new_tokens):
+    # max_new_tokens: câu trả lời stream (giới hạn ngắn hơn) không được dùng lại cho /api/chat và ngược lại
+    scope = _normalize_scope(pdf_name)
+    return (tuple(sorted(scope)) if scope else None, tuple(sorted(chunk_ids)), prompt_version(), max_new_tokens)
 
 def build_prompt(context_chunks, question):
     context = "\n---\n".join(context_chunks)
@@ -272,36 +333,105 @@ def build_prompt(context_chunks, question):
     <|im_start|>assistant
     """.strip()
 
-def generate_answer(prompt):
-    encoding = tokenizer(prompt, return_tensors="pt").to(model.device)
-    outputs = model.generate(
-        input_ids=encoding.input_ids,
-        attention_mask=encoding.attention_mask,
-        max_new_tokens=512,
-        temperature=0.7,
-        do_sample=True,
-        repetition_penalty=1.2,  # Giảm lặp lại
-        no_repeat_ngram_size=3,  # Tránh lặp lại cụm từ 3 từ
-        early_stopping=True,     # Dừng sớm khi gặp end token
-        pad_token_id=tokenizer.eos_token_id
-    )
-    return tokenizer.decode(outputs[0], skip_special_tokens=True)
-
-def rag_answer(query, top_k=3, pdf_name=None):
-    ensure_initialized()
-    context_chunks = get_relevant_chunks(query, top_k, pdf_name=pdf_name)
-    
-    # Kiểm tra nếu không có context hoặc context không liên quan
-    if not context_chunks or len(context_chunks) == 0:
-        return "Tôi không có thông tin về vấn đề này trong các tài liệu hiện có."
-    
-    # Kiểm tra độ liên quan của context với câu hỏi
-    if not is_context_relevant(query, context_chunks):
-        return "Tôi không có thông tin về vấn đề này trong các tài liệu hiện có."
-    
-    prompt = build_prompt(context_chunks, query)
-    answer = generate_answer(prompt)
-    
+def build_followup_turn(context_chunks, question):
+    """
+    Phần prompt của một lượt hỏi tiếp theo trong phiên, nối sau hội thoại trước (đã có trong KV):
+    đóng lượt trả lời trước rồi mở lượt user mới, chỉ kèm các chunk chưa dùng ở lượt trước.
+    """
+    context = "\n---\n".join(context_chunks)
+    reference = f"Thông tin tham khảo bổ sung:\n{context}\n\n" if context_chunks else ""
+    return f"<|im_end|>\n<|im_start|>user\n{reference}Câu hỏi: {question}\n<|im_end|>\n<|im_start|>assistant"
+
+# Tham số sinh dùng chung cho cả đường trả lời thường và stream
+GENERATION_KWARGS = dict(
+    temperature=0.7,
+    do_sample=True,
+    repetition_penalty=1.2,  # Giảm lặp lại
+    no_repeat_ngram_size=3,  # Tránh lặp lại cụm từ 3 từ
+    early_stopping=True,     # Dừng sớm khi gặp end token
+)
+
+# Dừng sinh ngay khi câu bắt đầu lặp hoặc model viết sang lượt/mục mới (stopping.RepetitionDetector)
+REPETITION_STOP = os.getenv("REPETITION_STOP", "1") != "0"
+# Số token tối đa của câu trả lời: /api/chat và luồng stream
+ANSWER_MAX_NEW_TOKENS = 512
+STREAM_MAX_NEW_TOKENS = 256
+# Thời gian tối đa chờ một câu trả lời (giây), gồm cả thời gian chờ trong hàng đợi của bộ lập lịch
+GENERATION_TIMEOUT = float(os.getenv("GENERATION_TIMEOUT", "300"))
+
+# Tham số lấy mẫu mà bộ lập lịch sinh (generation.py) áp dụng cho từng chuỗi; early_stopping chỉ có nghĩa với beam search
+SAMPLING_KWARGS = {
+    key: value for key, value in GENERATION_KWARGS.items()
+    if key in ("temperature", "do_sample", "repetition_penalty", "no_repeat_ngram_size")
+}
+
+def system_prompt_prefixes() -> list:
+    """Phần cố định ở đầu prompt của từng template build_prompt (khối system, trước ngữ cảnh)."""
+    marker = "{context}"
+    return [
+        build_prompt([marker * 20], "{question}").split(marker)[0],  # template đầy đủ
+        build_prompt([marker], "{question}").split(marker)[0],       # template khi ngữ cảnh quá ngắn
+    ]
+
+
+def prefix_length(input_ids) -> int:
+    """
+    Số token đầu của prompt trùng với token của một khối system cố định (để bộ lập lịch dùng lại KV).
+    Bỏ token cuối của prefix vì tokenizer có thể gộp nó với phần ngữ cảnh phía sau.
+    """
+    global _prefix_token_ids
+    if _prefix_token_ids is None:
+        _prefix_token_ids = [tokenizer(text).input_ids[:-1] for text in system_prompt_prefixes()]
+    for ids in _prefix_token_ids:
+        if ids and input_ids[:len(ids)] == ids:
+            return len(ids)
+    return 0
+
+
+def submit_generation(prompt, max_new_tokens, streamer=None, stopping_criteria=None, followup=None, on_done=None):
+    """
+    Đưa prompt vào bộ lập lịch sinh dùng chung (gom lô liên tục với các request khác).
+    followup: KV lượt trước của phiên (generation.KVPrefix); prompt khi đó chỉ là phần lượt mới và prefill
+    tiếp nối từ KV đó. on_done(request): gọi khi sinh xong, request.cache giữ KV để lưu cho lượt sau.
+    """
+    if followup is not None:
+        input_ids = list(followup.ids) + tokenizer(prompt, add_special_tokens=False).input_ids
+        prefix = {"prefix_cache": followup}
+    else:
+        input_ids = tokenizer(prompt).input_ids
+        prefix = {"prefix_length": prefix_length(input_ids)}
+    if REPETITION_STOP:
+        from .stopping import RepetitionDetector
+
+        # Cùng tiêu chí với remove_repetitive_content nhưng áp dụng trong lúc sinh: không tốn token cho câu sẽ bị xóa
+        stopping_criteria = list(stopping_criteria or []) + [RepetitionDetector(tokenizer, len(input_ids))]
+    request = get_scheduler().submit(input_ids, max_new_tokens=max_new_tokens, streamer=streamer,
+                                     stopping_criteria=stopping_criteria, keep_cache=on_done is not None,
+                                     **prefix, **SAMPLING_KWARGS)
+    if REPETITION_STOP:
+        request.add_done_callback(_record_early_stop)
+    if on_done is not None:
+        request.add_done_callback(on_done)
+    return request
+
+
+def _record_early_stop(request) -> None:
+    if request.tokens_saved:
+        print(f"✂️ Dừng sinh sớm ({request.finish_reason}) sau {len(request.tokens)} token, "
+              f"tiết kiệm {request.tokens_saved}/{request.max_new_tokens} token")
+
+def generate_answer(prompt, followup=None, on_done=None, max_new_tokens=ANSWER_MAX_NEW_TOKENS):
+    request = submit_generation(prompt, max_new_tokens=max_new_tokens, followup=followup, on_done=on_done)
+    try:
+        tokens = request.result(timeout=GENERATION_TIMEOUT)
+    except TimeoutError:
+        request.cancel()  # không để chuỗi tiếp tục chiếm chỗ trong lô khi người gọi đã bỏ cuộc
+        raise
+    # Lượt tiếp theo: input_ids gồm cả hội thoại trước, chỉ giải mã phần mới sinh
+    return tokenizer.decode(tokens if followup is not None else request.input_ids + tokens, skip_special_tokens=True)
+
+def postprocess_answer(answer, query, context_chunks):
+    """Tách phần trả lời của assistant, bỏ token đặc biệt, câu lặp và câu trả lời bịa đặt."""
     # Xử lý response tốt hơn để tránh lặp lại
     if "<|im_start|>assistant" in answer:
         # Lấy phần response sau assistant token
@@ -318,54 +448,227 @@ def rag_answer(query, top_k=3, pdf_name=None):
     
     # Kiểm tra lại nếu response có vẻ như bịa đặt
     if is_response_hallucinated(response, context_chunks):
-        return "Tôi không có thông tin về vấn đề này trong các tài liệu hiện có."
+        return NO_INFO_ANSWER
     
     return response
 
+def rag_answer(query, top_k=3, pdf_name=None, session_id=None):
+    prepared = prepare_answer(query, top_k, pdf_name, session_id)
+    if "prompt" not in prepared:
+        return prepared["answer"]
+    answer = generate_answer(prepared["prompt"], **prepared["generation"])
+    return prepared["complete"](answer)
+
+
+def replay_answer(answer):
+    """Phát lại câu trả lời đã cache theo từng từ, giống luồng stream thật."""
+    for piece in re.findall(r'\S+\s*', answer):
+        yield piece
+
+
+def _context_window() -> int:
+    return getattr(getattr(model, "config", None), "max_position_embeddings", None) or 4096
+
+
+def context_budget(question, max_new_tokens=ANSWER_MAX_NEW_TOKENS, followup=None) -> int:
+    """
+    Số token còn cho phần ngữ cảnh: cửa sổ ngữ cảnh của model trừ khung prompt (gồm câu hỏi) và phần
+    trả lời; lượt nối tiếp trừ thêm hội thoại trước đã có trong KV. CONTEXT_TOKEN_BUDGET giới hạn thêm.
+    """
+    marker = "{context}" * 20
+    if followup is None:
+        frame = len(tokenizer(build_prompt([marker], question).replace(marker, "")).input_ids)
+    else:
+        frame = len(followup.ids) + len(tokenizer(build_followup_turn([marker], question).replace(marker, ""),
+                                                  add_special_tokens=False).input_ids)
+    return _context_window() - frame - max_new_tokens
+
+
+_context_stats = {"prompts": 0, "chunks": 0, "chunks_dropped": 0, "tokens_full": 0, "tokens_packed": 0,
+                  "tokens_deduplicated": 0}
+_context_stats_lock = threading.Lock()
+
+
+def _record_context(packed) -> None:
+    with _context_stats_lock:
+        _context_stats["prompts"] += 1
+        _context_stats["chunks"] += len(packed.chunk_ids)
+        _context_stats["chunks_dropped"] += packed.dropped
+        _context_stats["tokens_full"] += packed.tokens_full
+        _context_stats["tokens_packed"] += packed.tokens
+        _context_stats["tokens_deduplicated"] += packed.tokens_deduplicated
+
+
+def get_context_stats() -> dict:
+    """Token ngữ cảnh đưa vào prompt so với nối nguyên các chunk (ước lượng theo số liệu lúc ingest)."""
+    with _context_stats_lock:
+        stats = dict(_context_stats)
+    stats["tokens_saved"] = stats["tokens_full"] - stats["tokens_packed"]
+    return stats
+
+
+def _session_for(session_id, scope, snapshot):
+    """State lượt trước của phiên nếu còn dùng được (cùng phạm vi tài liệu và cùng snapshot kho)."""
+    if not session_id:
+        return None
+    state = session_store.get(session_id)
+    if state is None or state.scope != scope or state.corpus_version != snapshot.version:
+        return None
+    return state
+
 
-def generate_answer_stream(prompt):
-    """Trả về iterator text stream theo thời gian thực."""
+def prepare_answer(query, top_k=3, pdf_name=None, session_id=None, max_new_tokens=ANSWER_MAX_NEW_TOKENS) -> dict:
+    """
+    Phần đồng bộ trước khi sinh: truy xuất, kiểm tra ngữ cảnh, tra cache câu trả lời, nối tiếp phiên hội thoại.
+    Trả về {"answer": text, "cached": bool} nếu không cần sinh, hoặc {"prompt", "generation", "complete"}:
+    generation là tham số cho bước sinh (followup/on_done/max_new_tokens), complete(text, streamed=False) hậu xử lý
+    câu trả lời, lưu vào cache và trả về câu trả lời cuối.
+    Có session_id: lượt sau dùng lại chunk và KV của lượt trước, chỉ prefill phần lượt mới.
+    """
     ensure_initialized()
-    streamer = TextIteratorStreamer(tokenizer, skip_special_tokens=True, skip_prompt=True)
-    encoding = tokenizer(prompt, return_tensors="pt").to(model.device)
-
-    generate_kwargs = dict(
-        input_ids=encoding.input_ids,
-        attention_mask=encoding.attention_mask,
-        max_new_tokens=256,
-        temperature=0.7,
-        do_sample=True,
-        repetition_penalty=1.2,  # Giảm lặp lại
-        no_repeat_ngram_size=3,  # Tránh lặp lại cụm từ 3 từ
-        early_stopping=True,     # Dừng sớm khi gặp end token
-        pad_token_id=tokenizer.eos_token_id,
-        streamer=streamer,
-    )
-
-    thread = Thread(target=model.generate, kwargs=generate_kwargs)
-    thread.start()
-
-    for new_text in streamer:
-        yield new_text
-
-
-def rag_answer_stream(query, top_k=3, pdf_name=None):
-    context_chunks = get_relevant_chunks(query, top_k, pdf_name=pdf_name)
+    clean_query = sanitize_input(query)
+    snapshot = corpus.current()  # cả truy vấn dùng một snapshot kho
+    scope = _normalize_scope(pdf_name)
+    session = _session_for(session_id, scope, snapshot)
+    chunk_ids = retrieve_chunk_ids(clean_query, top_k, pdf_name, snapshot)
+    # Lượt tiếp theo: giữ chunk của các lượt trước, chỉ bổ sung chunk mới
+    new_ids = [i for i in chunk_ids if session is None or i not in session.chunk_ids]
+    all_ids = (session.chunk_ids if session is not None else []) + new_ids
+    packed = chunk_texts(all_ids, context_budget(query, max_new_tokens), snapshot)
+    context_chunks = packed.chunks
     
     # Kiểm tra nếu không có context hoặc context không liên quan
-    if not context_chunks or len(context_chunks) == 0:
-        def no_info_generator():
-            yield "Tôi không có thông tin về vấn đề này trong các tài liệu hiện có."
-        return no_info_generator()
-    
-    # Kiểm tra độ liên quan của context với câu hỏi
-    if not is_context_relevant(query, context_chunks):
-        def no_info_generator():
-            yield "Tôi không có thông tin về vấn đề này trong các tài liệu hiện có."
-        return no_info_generator()
-    
-    prompt = build_prompt(context_chunks, query)
-    return generate_answer_stream(prompt)
+    if not context_chunks or not is_context_relevant(query, context_chunks):
+        return {"answer": NO_INFO_ANSWER, "cached": False}
+
+    # Chunk ID thực sự có trong prompt (chunk không vừa ngân sách được xét lại ở lượt sau)
+    used_ids = packed.chunk_ids
+
+    def save_session(request=None):
+        kv = request.cache if request is not None else None
+        turns = session.turns + 1 if session is not None else 1
+        session_store.put(SessionState(session_id, scope, snapshot.version, used_ids, kv, turns))
+
+    followup = session.kv if session is not None else None
+    if followup is not None:
+        budget = context_budget(query, max_new_tokens, followup)
+        turn = chunk_texts(new_ids, budget, snapshot, present=session.chunk_ids) if budget > 0 else None
+        if turn is None or turn.dropped:
+            followup = None  # hội thoại dài quá cửa sổ ngữ cảnh: bắt đầu lại bằng prompt đầy đủ
+        else:
+            prompt = build_followup_turn(turn.chunks, query)
+            used_ids = session.chunk_ids + turn.chunk_ids
+            _record_context(turn)
+
+    if followup is None:
+        # Câu hỏi (hoặc câu gần trùng) đã trả lời với cùng ngữ cảnh: dùng lại, bỏ qua bước sinh
+        cache_query = normalize_query(query)
+        context_key = _answer_context_key(all_ids, pdf_name, max_new_tokens)
+        query_vector = encode_query(clean_query)[0]
+        cached = answer_cache.get(cache_query, context_key, query_vector)
+        if cached is not None:
+            if session_id:
+                save_session()  # lượt này không có KV: lượt sau dựng lại prompt đầy đủ với các chunk đã dùng
+            return {"answer": cached, "cached": True}
+        prompt = build_prompt(context_chunks, query)
+        _record_context(packed)
+
+    def complete(text, streamed=False):
+        response = postprocess_answer(text, query, context_chunks)
+        # Câu trả lời của lượt nối tiếp phụ thuộc hội thoại trước nên không đưa vào cache câu trả lời.
+        # streamed: client đã nhận nguyên văn text, chỉ cache khi hậu xử lý không đổi gì (lần hit sau phát lại
+        # đúng câu trả lời người hỏi đầu tiên đã thấy)
+        if followup is None and (not streamed or response == text.strip()):
+            answer_cache.put(cache_query, context_key, response, query_vector)
+        return response
+
+    generation = {"followup": followup, "on_done": save_session if session_id else None,
+                  "max_new_tokens": max_new_tokens}
+    return {"prompt": prompt, "generation": generation, "complete": complete}
+
+
+def _prepared_pieces(prepared):
+    return replay_answer(prepared["answer"]) if prepared["cached"] else iter([prepared["answer"]])
+
+
+# Thống kê luồng stream async: token đã sinh so với token thực sự tới client
+_stream_stats = {"streams": 0, "completed": 0, "cancelled": 0, "tokens_generated": 0, "tokens_delivered": 0}
+_stream_stats_lock = threading.Lock()
+
+
+def _record_stream(request, delivered: int) -> None:
+    generated = len(request.tokens)
+    with _stream_stats_lock:
+        _stream_stats["streams"] += 1
+        _stream_stats["completed" if request.finish_reason != "cancelled" else "cancelled"] += 1
+        _stream_stats["tokens_generated"] += generated
+        _stream_stats["tokens_delivered"] += delivered
+    print(f"📤 Stream kết thúc ({request.finish_reason}): sinh {generated} token, gửi tới client {delivered} token")
+
+
+def get_stream_stats() -> dict:
+    with _stream_stats_lock:
+        stats = dict(_stream_stats)
+    stats["tokens_wasted"] = stats["tokens_generated"] - stats["tokens_delivered"]
+    return stats
+
+
+async def generate_answer_astream(prompt, cancel_token=None, followup=None, on_done=None,
+                                  max_new_tokens=STREAM_MAX_NEW_TOKENS):
+    """
+    Stream text bằng asyncio: token từ bộ lập lịch được giải mã tăng dần và yield từng đoạn mới.
+    cancel_token.cancel() (hoặc đóng generator, vd. client ngắt kết nối) dừng sinh trong một bước giải mã.
+    Số token đã sinh / đã gửi được ghi vào get_stream_stats() khi request kết thúc.
+    """
+    from .generation import AsyncTokenStream
+    from .stopping import CancelToken
+
+    cancel_token = cancel_token or CancelToken()
+    stream = AsyncTokenStream()
+    request = await asyncio.to_thread(submit_generation, prompt, max_new_tokens, stream, [cancel_token], followup, on_done)
+    token_ids = []
+    sent = ""
+    delivered = 0
+    try:
+        async for token_id in stream:
+            token_ids.append(token_id)
+            text = tokenizer.decode(token_ids, skip_special_tokens=True)
+            # Chờ thêm token khi đang giữa một ký tự nhiều byte hoặc phần đã gửi bị giải mã lại khác đi
+            if text.endswith("\ufffd") or not text.startswith(sent) or len(text) == len(sent):
+                continue
+            count = len(token_ids)
+            new_text, sent = text[len(sent):], text
+            yield new_text
+            delivered = count  # chỉ tính khi người nhận đã lấy xong đoạn text trước đó
+        # Phần còn giữ lại ở cuối (token không ra chữ hoặc ký tự dở dang) cũng tính là đã gửi
+        text = tokenizer.decode(token_ids, skip_special_tokens=True).rstrip("\ufffd")
+        if len(text) > len(sent) and text.startswith(sent):
+            yield text[len(sent):]
+        delivered = len(token_ids)
+        if request.error is not None:
+            raise request.error
+    finally:
+        if not request.done:
+            cancel_token.cancel()
+        request.add_done_callback(lambda r: _record_stream(r, delivered))
+
+
+async def rag_answer_astream(query, top_k=3, pdf_name=None, cancel_token=None, session_id=None):
+    """Stream câu trả lời RAG: truy xuất chạy trong thread, sinh qua generate_answer_astream."""
+    prepared = await asyncio.to_thread(prepare_answer, query, top_k, pdf_name, session_id, STREAM_MAX_NEW_TOKENS)
+    if "prompt" not in prepared:
+        for piece in _prepared_pieces(prepared):
+            yield piece
+        return
+    parts = []
+    # aclosing: client ngắt kết nối giữa chừng thì generator con được đóng ngay (hủy sinh), không chờ GC
+    async with contextlib.aclosing(generate_answer_astream(prepared["prompt"], cancel_token,
+                                                           **prepared["generation"])) as stream:
+        async for new_text in stream:
+            parts.append(new_text)
+            yield new_text
+    if cancel_token is None or not cancel_token.cancelled:
+        prepared["complete"]("".join(parts), streamed=True)
 
 # Test độc lập (comment nếu tích hợp)
 if __name__ == "__main__":
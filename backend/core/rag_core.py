@@ -9,6 +9,7 @@ from .embeding import (
     create_embeddings,
     save_embeddings,
 )
+from .pipeline import ingest_pdf
 from .rag import ensure_initialized
 
 
@@ -0,0 +1,114 @@
+# sessions.py: Trạng thái hội thoại nhiều lượt theo session_id (KV cache của lượt trước + chunk đã truy xuất)
+#
+#   - lượt sau nối tiếp KV của lượt trước (prompt + câu trả lời) nên chỉ prefill phần token mới
+#   - chunk ID đã truy xuất được giữ để lượt sau dùng lại, chỉ đưa chunk mới vào prompt
+#   - tổng bộ nhớ (chủ yếu KV) giới hạn bởi SESSION_CACHE_MAX_BYTES, vượt thì bỏ phiên ít dùng gần đây nhất;
+#     phiên không hoạt động quá SESSION_TTL giây thì hết hạn
+#   - SESSION_KV_OFFLOAD=1: giữ KV trên RAM (CPU) thay vì bộ nhớ GPU, chép lại khi dùng
+# State gắn với phạm vi tài liệu và phiên bản snapshot kho; đổi một trong hai thì lượt sau bắt đầu lại từ đầu.
+
+import os
+import time
+import threading
+from collections import OrderedDict
+
+SESSION_CACHE_MAX_BYTES = int(os.getenv("SESSION_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+SESSION_TTL = float(os.getenv("SESSION_TTL", "1800"))
+SESSION_KV_OFFLOAD = os.getenv("SESSION_KV_OFFLOAD", "0") == "1"
+
+
+class SessionState:
+    """Kết quả lượt gần nhất của một phiên: phạm vi, phiên bản kho, chunk ID đã dùng, KV (KVPrefix hoặc None)."""
+
+    __slots__ = ("session_id", "scope", "corpus_version", "chunk_ids", "kv", "turns", "updated_at")
+
+    def __init__(self, session_id: str, scope, corpus_version: int, chunk_ids, kv=None, turns: int = 1):
+        self.session_id = session_id
+        self.scope = scope
+        self.corpus_version = corpus_version
+        self.chunk_ids = list(chunk_ids)
+        self.kv = kv
+        self.turns = turns
+        self.updated_at = time.monotonic()
+
+    @property
+    def nbytes(self) -> int:
+        return (self.kv.nbytes if self.kv is not None else 0) + 8 * len(self.chunk_ids) + 256
+
+
+class SessionStore:
+    """LRU giới hạn theo byte + TTL, an toàn đa luồng."""
+
+    def __init__(self, max_bytes: int, ttl: float | None = None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._data = OrderedDict()  # session_id -> SessionState
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, session_id: str):
+        with self._lock:
+            state = self._data.get(session_id)
+            if state is not None and self.ttl and time.monotonic() - state.updated_at > self.ttl:
+                self._remove(session_id)
+                self.expirations += 1
+                state = None
+            if state is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(session_id)
+            self.hits += 1
+            return state
+
+    def put(self, state: SessionState) -> None:
+        if self.max_bytes <= 0:
+            return
+        if state.kv is not None and SESSION_KV_OFFLOAD:
+            state.kv = state.kv.to("cpu")
+        if state.nbytes > self.max_bytes:
+            state.kv = None  # một phiên quá lớn: chỉ giữ chunk ID
+        with self._lock:
+            self._remove(state.session_id)
+            self._data[state.session_id] = state
+            self._bytes += state.nbytes
+            while self._bytes > self.max_bytes and len(self._data) > 1:
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def drop(self, session_id: str) -> None:
+        with self._lock:
+            self._remove(session_id)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def _remove(self, session_id: str) -> None:
+        state = self._data.pop(session_id, None)
+        if state is not None:
+            self._bytes -= state.nbytes
+
+    def stats(self) -> dict:
+        with self._lock:
+            with_kv = sum(1 for state in self._data.values() if state.kv is not None)
+            kv_tokens = sum(len(state.kv.ids) for state in self._data.values() if state.kv is not None)
+            return {
+                "sessions": len(self._data),
+                "sessions_with_kv": with_kv,
+                "kv_tokens": kv_tokens,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+session_store = SessionStore(SESSION_CACHE_MAX_BYTES, SESSION_TTL)
@@ -0,0 +1,126 @@
+# startup.py: Khởi động không chặn: nạp model trong thread nền, warm-up, trạng thái cho /healthz và /readyz
+#
+# uvicorn mở cổng ngay; thread "model-warmup" lần lượt:
+#   1. embedding_model: nạp e5 + tokenizer chunker, encode thử một câu
+#   2. ingest_workers: khởi động worker ingest (chỉ cần e5, không cần chờ LLM)
+#   3. faiss_index: mở kho chunk và FAISS index (rag.reload_embeddings)
+#   4. llm: nạp tokenizer + LLM 4-bit, sinh thử 1 token (khởi tạo kernel CUDA)
+# Các endpoint chat trả 503 + Retry-After cho tới khi embedding_model, llm và faiss_index sẵn sàng.
+
+import os
+import time
+import threading
+
+MODEL_WARMUP = os.getenv("MODEL_WARMUP", "1") != "0"
+# Số giây gợi ý client chờ (header Retry-After) khi model chưa sẵn sàng
+READY_RETRY_AFTER = int(os.getenv("READY_RETRY_AFTER", "10"))
+
+COMPONENTS = ("embedding_model", "ingest_workers", "faiss_index", "llm")
+REQUIRED_FOR_CHAT = ("embedding_model", "llm", "faiss_index")
+
+_state = {name: {"status": "pending", "seconds": None, "error": None} for name in COMPONENTS}
+_started_at = time.time()
+_thread = None
+_lock = threading.Lock()
+
+
+def _load_embedding_model() -> None:
+    from .model_registry import get_embedding_model, get_embedding_tokenizer
+
+    model = get_embedding_model()
+    get_embedding_tokenizer()
+    if MODEL_WARMUP:
+        model.encode(["query: khởi động"])
+
+
+def _start_ingest_workers() -> None:
+    from .jobs import start_workers
+
+    start_workers()
+
+
+def _load_faiss_index() -> None:
+    from .rag import reload_embeddings
+
+    reload_embeddings()
+
+
+def _load_llm() -> None:
+    from .model_registry import get_llm, get_llm_tokenizer
+
+    tokenizer = get_llm_tokenizer()
+    model = get_llm()
+    if MODEL_WARMUP:
+        import torch
+
+        encoding = tokenizer("Xin chào", return_tensors="pt").to(model.device)
+        with torch.inference_mode():
+            model.generate(**encoding, max_new_tokens=1, pad_token_id=tokenizer.eos_token_id)
+
+
+_STEPS = (
+    ("embedding_model", _load_embedding_model),
+    ("ingest_workers", _start_ingest_workers),
+    ("faiss_index", _load_faiss_index),
+    ("llm", _load_llm),
+)
+
+
+def _run_step(name: str, fn) -> bool:
+    _state[name].update(status="loading", error=None)
+    started = time.perf_counter()
+    try:
+        fn()
+    except Exception as e:
+        _state[name].update(status="failed", seconds=round(time.perf_counter() - started, 2), error=str(e))
+        print(f"❌ Khởi động {name} lỗi: {str(e)}")
+        return False
+    _state[name].update(status="ready", seconds=round(time.perf_counter() - started, 2))
+    print(f"✅ {name} sẵn sàng sau {_state[name]['seconds']}s")
+    return True
+
+
+def _warmup() -> None:
+    for name, fn in _STEPS:
+        if not _run_step(name, fn) and name == "embedding_model":
+            # Không có e5 thì không ingest/truy xuất được; các bước sau đều bỏ qua
+            for rest, _ in _STEPS[1:]:
+                _state[rest].update(status="failed", error="embedding_model failed")
+            return
+    if is_ready():
+        print(f"🚀 Sẵn sàng phục vụ sau {time.time() - _started_at:.1f}s")
+
+
+def start_background_warmup() -> None:
+    """Chạy nạp model + warm-up trong thread nền (một lần mỗi process)."""
+    global _thread
+    with _lock:
+        if _thread is not None:
+            return
+        _thread = threading.Thread(target=_warmup, name="model-warmup", daemon=True)
+        _thread.start()
+
+
+def is_ready() -> bool:
+    return all(_state[name]["status"] == "ready" for name in REQUIRED_FOR_CHAT)
+
+
+def liveness() -> dict:
+    return {"status": "ok", "uptime_seconds": round(time.time() - _started_at, 1)}
+
+
+def readiness() -> dict:
+    """Trạng thái từng thành phần (pending/loading/ready/failed) kèm thời gian nạp."""
+    from .model_registry import model_stats
+
+    models = model_stats()
+    components = {}
+    for name in COMPONENTS:
+        components[name] = dict(_state[name])
+        if name in models and models[name].get("loaded"):
+            components[name]["memory_mb"] = models[name]["memory_mb"]
+    return {
+        "ready": is_ready(),
+        "uptime_seconds": round(time.time() - _started_at, 1),
+        "components": components,
+    }
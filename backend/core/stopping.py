@@ -0,0 +1,89 @@
+# stopping.py: StoppingCriteria dùng cho bộ lập lịch sinh (generation.py) và model.generate()
+#
+# Bộ lập lịch gọi từng criterion sau mỗi token sinh ra (như transformers); criterion nào trả True thì
+# chuỗi rời lô ngay, finish_reason lấy từ thuộc tính finish_reason của criterion (mặc định "stop").
+# Module import transformers ở đầu file nên chỉ import lười tại chỗ dùng.
+
+import re
+import threading
+
+import torch
+from transformers import StoppingCriteria
+
+
+class CancelToken(StoppingCriteria):
+    """Token hủy: gọi cancel() từ bất kỳ thread nào (vd. khi client ngắt kết nối) để dừng sinh trong một bước giải mã."""
+
+    finish_reason = "cancelled"
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self) -> None:
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self._event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
+# Ranh giới câu giống remove_repetitive_content (". ") cộng thêm ?, ! và xuống dòng
+_SENTENCE_END = re.compile(r"[.!?](?:\s+)|\n+")
+# Dấu hiệu câu trả lời đã xong và model bắt đầu viết lượt/mục mới của prompt
+COMPLETION_MARKERS = ("<|im_end|>", "<|im_start|>", "Câu hỏi:", "Thông tin tham khảo")
+
+
+class RepetitionDetector(StoppingCriteria):
+    """
+    Theo dõi phần text đã sinh theo từng câu (giải mã tăng dần, chỉ phần từ đầu câu hiện tại) và dừng khi:
+      - một câu lặp lại câu đã có (chuẩn hóa như remove_repetitive_content) max_repeats lần
+      - model viết tới dấu hiệu kết thúc lượt / mở mục mới của prompt (COMPLETION_MARKERS)
+    Dùng cho một chuỗi (batch = 1) như bộ lập lịch sinh gọi; prompt_length: số token prompt cần bỏ qua.
+    """
+
+    finish_reason = "repetition"
+
+    def __init__(self, tokenizer, prompt_length: int, max_repeats: int = 1, min_chars: int = 10):
+        self.tokenizer = tokenizer
+        self.max_repeats = max_repeats
+        self.min_chars = min_chars
+        self.repeats = 0
+        self.completed = False
+        self._seen = set()
+        self._start = prompt_length  # token đầu của câu đang viết
+        self._offset = 0  # số ký tự đã xử lý trong text giải mã từ _start
+
+    def _add_sentence(self, sentence: str) -> None:
+        normalized = re.sub(r"[^\w\s]", "", sentence.lower()).strip()
+        if len(normalized) <= self.min_chars:
+            return
+        if normalized in self._seen:
+            self.repeats += 1
+        self._seen.add(normalized)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        ids = input_ids[0].tolist()
+        text = self.tokenizer.decode(ids[self._start:], skip_special_tokens=False)
+        if any(marker in text for marker in COMPLETION_MARKERS):
+            self.completed = True
+        rest = text[self._offset:]
+        last = 0
+        for match in _SENTENCE_END.finditer(rest):
+            if match.end() == len(rest) and not match.group().strip():
+                break  # xuống dòng ở cuối có thể còn nối tiếp ở token sau
+            self._add_sentence(rest[last:match.end()])
+            last = match.end()
+        if last:
+            remainder = rest[last:]
+            if not remainder.strip():
+                self._start, self._offset = len(ids), 0
+            elif self.tokenizer.decode(ids[-1:], skip_special_tokens=False).strip() == remainder.strip():
+                # Phần sau ranh giới câu nằm trọn trong token cuối: câu mới bắt đầu từ token đó
+                self._start, self._offset = len(ids) - 1, 0
+            else:
+                self._offset += last
+        stop = self.completed or self.repeats >= self.max_repeats
+        return torch.full((input_ids.shape[0],), stop, dtype=torch.bool, device=input_ids.device)
@@ -0,0 +1,319 @@
+# vector_index.py: FAISS index toàn cục khóa theo chunk ID 64-bit (IndexIDMap2)
+#
+# Thêm/xóa một tài liệu chỉ đụng tới các vector của tài liệu đó:
+#   - thêm: add_with_ids với dải ID [first_id, first_id + count)
+#   - xóa: remove_ids với IDSelectorRange trên cùng dải ID
+#
+# Chế độ index chọn qua FAISS_INDEX_MODE:
+#   - flat : quét toàn bộ (chính xác, mặc định)
+#   - hnsw : đồ thị HNSW (nhanh, tốn RAM hơn; xóa tài liệu phải dựng lại index)
+#   - ivfpq: IVF + Product Quantization (nhỏ gọn, cần train). Khi kho còn nhỏ hơn
+#            FAISS_IVF_MIN_TRAIN vector thì tạm dùng flat; đủ dữ liệu thì train ngay lúc ingest.
+# Dùng benchmarks/bench_index_modes.py để đo recall@k và độ trễ trước khi chọn chế độ.
+#
+# FAISS_VECTOR_STORAGE (float32 | float16 | int8) nén vector trong index flat/hnsw bằng
+# scalar quantizer (2x / 4x nhỏ hơn float32). Tìm kiếm chạy trên mã nén, sau đó
+# FAISS_RESCORE_FACTOR * k ứng viên được chấm lại bằng vector float32 gốc đọc qua mmap
+# từ kho chunk (chỉ các hàng được truy cập mới nằm trong bộ nhớ).
+# Dùng benchmarks/bench_quantization.py để kiểm tra recall và dung lượng.
+#
+# Ghi file index (thread ghi của ingest, hoặc thread reload khi dựng lại index khác cấu hình) luôn giữ
+# index_lock: hai thread không ghi đè file của nhau và index dựng lại không đè lên bản vừa cập nhật.
+
+import os
+import math
+import threading
+
+import faiss
+import numpy as np
+
+INDEX_MODES = ("flat", "hnsw", "ivfpq")
+INDEX_MODE = os.getenv("FAISS_INDEX_MODE", "flat").lower()
+HNSW_M = int(os.getenv("FAISS_HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("FAISS_HNSW_EF_CONSTRUCTION", "200"))
+EF_SEARCH = int(os.getenv("FAISS_EF_SEARCH", "64"))
+IVF_NLIST = int(os.getenv("FAISS_IVF_NLIST", "0"))  # 0 = tự chọn theo kích thước kho
+IVF_MIN_TRAIN = int(os.getenv("FAISS_IVF_MIN_TRAIN", "10000"))
+IVF_TRAIN_SIZE = int(os.getenv("FAISS_IVF_TRAIN_SIZE", "100000"))
+PQ_M = int(os.getenv("FAISS_PQ_M", "64"))
+PQ_NBITS = int(os.getenv("FAISS_PQ_NBITS", "8"))
+NPROBE = int(os.getenv("FAISS_NPROBE", "16"))
+VECTOR_STORAGE = os.getenv("FAISS_VECTOR_STORAGE", "float32").lower()
+RESCORE_FACTOR = int(os.getenv("FAISS_RESCORE_FACTOR", "4"))
+# Nới rộng khoảng min/max khi train int8 để vector của tài liệu thêm sau ít bị cắt ngưỡng
+SQ_RANGE_MARGIN = float(os.getenv("FAISS_SQ_RANGE_MARGIN", "0.2"))
+
+index_lock = threading.Lock()
+
+_SQ_TYPES = {
+    "float16": faiss.ScalarQuantizer.QT_fp16,
+    "int8": faiss.ScalarQuantizer.QT_8bit,
+}
+
+if INDEX_MODE not in INDEX_MODES:
+    raise ValueError(f"FAISS_INDEX_MODE không hợp lệ: {INDEX_MODE} (chọn một trong {INDEX_MODES})")
+if VECTOR_STORAGE not in ("float32", *_SQ_TYPES):
+    raise ValueError(f"FAISS_VECTOR_STORAGE không hợp lệ: {VECTOR_STORAGE}")
+
+
+def target_mode(num_vectors: int, mode: str | None = None) -> str:
+    """Chế độ thực sự dùng cho một kho có num_vectors vector."""
+    mode = mode or INDEX_MODE
+    if mode == "ivfpq" and num_vectors < IVF_MIN_TRAIN:
+        return "flat"
+    return mode
+
+
+def _auto_nlist(num_vectors: int) -> int:
+    if IVF_NLIST > 0:
+        return IVF_NLIST
+    return int(min(65536, max(16, 4 * math.sqrt(num_vectors))))
+
+
+def _pq_m(dim: int) -> int:
+    # Số sub-quantizer phải chia hết số chiều
+    m = min(PQ_M, dim)
+    while dim % m:
+        m -= 1
+    return m
+
+
+def _set_sq_range(sq) -> None:
+    if SQ_RANGE_MARGIN > 0:
+        sq.rangestat = faiss.ScalarQuantizer.RS_minmax
+        sq.rangestat_arg = SQ_RANGE_MARGIN
+
+
+def _make_base(dim: int, mode: str, num_vectors: int = 0, storage: str | None = None):
+    storage = storage or VECTOR_STORAGE
+    if mode == "hnsw":
+        if storage in _SQ_TYPES:
+            base = faiss.IndexHNSWSQ(dim, _SQ_TYPES[storage], HNSW_M)
+            _set_sq_range(faiss.downcast_index(base.storage).sq)
+        else:
+            base = faiss.IndexHNSWFlat(dim, HNSW_M)
+        base.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        return base
+    if mode == "ivfpq":
+        # PQ đã là dạng nén, không áp dụng FAISS_VECTOR_STORAGE
+        quantizer = faiss.IndexFlatL2(dim)
+        return faiss.IndexIVFPQ(quantizer, dim, _auto_nlist(num_vectors), _pq_m(dim), PQ_NBITS)
+    if storage in _SQ_TYPES:
+        base = faiss.IndexScalarQuantizer(dim, _SQ_TYPES[storage], faiss.METRIC_L2)
+        _set_sq_range(base.sq)
+        return base
+    return faiss.IndexFlatL2(dim)
+
+
+def new_index(dim: int, mode: str | None = None, storage: str | None = None):
+    """Tạo index rỗng ánh xạ theo chunk ID (ivfpq chưa train thì tạm dùng flat)."""
+    mode = target_mode(0, mode)
+    index = faiss.IndexIDMap2(_make_base(dim, mode, storage=storage))
+    configure_search(index)
+    return index
+
+
+def is_id_mapped(index) -> bool:
+    return hasattr(index, "id_map")
+
+
+def index_mode(index) -> str:
+    """Suy ra chế độ của một index đã có."""
+    base = faiss.downcast_index(index.index) if is_id_mapped(index) else index
+    if isinstance(base, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(base, faiss.IndexIVF):
+        return "ivfpq"
+    return "flat"
+
+
+def index_storage(index) -> str:
+    """Kiểu lưu vector của index: float32, float16, int8 hoặc pq."""
+    base = faiss.downcast_index(index.index) if is_id_mapped(index) else index
+    if isinstance(base, faiss.IndexIVFPQ):
+        return "pq"
+    if isinstance(base, faiss.IndexHNSW):
+        base = faiss.downcast_index(base.storage)
+    if isinstance(base, faiss.IndexScalarQuantizer):
+        for name, qtype in _SQ_TYPES.items():
+            if base.sq.qtype == qtype:
+                return name
+    return "float32"
+
+
+def matches_config(index, num_vectors: int) -> bool:
+    """Index có đúng chế độ và kiểu lưu vector đang cấu hình (cho kho num_vectors vector) không."""
+    mode = target_mode(num_vectors)
+    if index_mode(index) != mode:
+        return False
+    expected_storage = "pq" if mode == "ivfpq" else VECTOR_STORAGE
+    return index_storage(index) == expected_storage
+
+
+def is_compressed(index) -> bool:
+    return index is not None and index_storage(index) != "float32"
+
+
+def configure_search(index, nprobe: int | None = None, ef_search: int | None = None) -> None:
+    """Đặt tham số tìm kiếm (nprobe cho IVF, efSearch cho HNSW); bỏ qua nếu không áp dụng."""
+    if index is None:
+        return
+    base = faiss.downcast_index(index.index) if is_id_mapped(index) else index
+    if isinstance(base, faiss.IndexHNSW):
+        base.hnsw.efSearch = ef_search or EF_SEARCH
+    elif isinstance(base, faiss.IndexIVF):
+        base.nprobe = min(nprobe or NPROBE, base.nlist)
+
+
+def _training_sample(view, limit: int):
+    """Lấy mẫu đều (theo bước nhảy) tối đa limit vector từ kho để train IVF-PQ."""
+    step = max(1, math.ceil(len(view) / limit))
+    parts = [np.asarray(embeddings[::step], dtype=np.float32) for embeddings, _ in view.iter_embeddings()]
+    return np.ascontiguousarray(np.vstack(parts)[:limit])
+
+
+def build_from_view(view, mode: str | None = None, storage: str | None = None):
+    """Dựng index từ toàn bộ kho chunk (đọc embedding qua mmap, theo từng tài liệu)."""
+    if len(view) == 0:
+        return None
+    mode = target_mode(len(view), mode)
+    index = None
+    for embeddings, ids in view.iter_embeddings():
+        if index is None:
+            dim = embeddings.shape[1]
+            index = faiss.IndexIDMap2(_make_base(dim, mode, len(view), storage))
+            if not index.is_trained:
+                print(f"🏋️ Train index {mode}/{index_storage(index)} trên {min(len(view), IVF_TRAIN_SIZE)} vector")
+                index.train(_training_sample(view, IVF_TRAIN_SIZE))
+        index.add_with_ids(np.ascontiguousarray(embeddings, dtype=np.float32), ids)
+    configure_search(index)
+    return index
+
+
+def load_index(path: str, view=None):
+    """
+    Đọc index từ đĩa. Index cũ (IndexFlatL2 theo vị trí, chưa có ID) hoặc khác chế độ
+    đang cấu hình được dựng lại từ kho chunk một lần rồi ghi đè. Người gọi giữ index_lock.
+    """
+    if not os.path.exists(path):
+        return None
+    index = faiss.read_index(path)
+    if view is not None:
+        if not is_id_mapped(index):
+            print(f"🔁 Chuyển {path} sang index theo chunk ID")
+            index = build_from_view(view)
+            save_index(index, path)
+        elif not matches_config(index, len(view)):
+            print(f"🔁 Dựng lại {path} theo chế độ {target_mode(len(view))}/{VECTOR_STORAGE}")
+            index = build_from_view(view)
+            save_index(index, path)
+    configure_search(index)
+    return index
+
+
+def save_index(index, path: str) -> None:
+    """
+    Ghi index ra file tạm rồi đổi tên để reader không bao giờ đọc phải file dở dang. Người gọi giữ index_lock;
+    file tạm riêng từng process.
+    """
+    if index is None or index.ntotal == 0:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def add_document(index, embeddings, first_id: int, view=None):
+    """
+    Thêm vector của một tài liệu với dải ID liên tiếp bắt đầu từ first_id.
+    Ở chế độ ivfpq, khi kho (view, đã gồm tài liệu mới) vừa đủ dữ liệu thì train và
+    dựng index IVF-PQ thay cho index flat tạm thời. Trả về index (có thể là index mới).
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    if view is not None and (index is None or not matches_config(index, len(view))):
+        return build_from_view(view)
+    if index is None:
+        index = new_index(embeddings.shape[1])
+    if not index.is_trained:
+        index.train(embeddings)
+    ids = np.arange(first_id, first_id + len(embeddings), dtype=np.int64)
+    index.add_with_ids(embeddings, ids)
+    return index
+
+
+def supports_remove(index) -> bool:
+    return index is not None and index_mode(index) != "hnsw"
+
+
+def remove_document(index, first_id: int, count: int, view=None):
+    """
+    Gỡ dải ID của một tài liệu khỏi index. HNSW không hỗ trợ xóa nên phải dựng lại
+    từ view (đã loại tài liệu). Trả về index (có thể là index mới).
+    """
+    if index is None or count <= 0:
+        return index
+    if not supports_remove(index):
+        return build_from_view(view) if view is not None else index
+    index.remove_ids(faiss.IDSelectorRange(first_id, first_id + count))
+    return index
+
+
+def search(index, view, query_vectors, top_k: int, rescore_factor: int | None = None):
+    """
+    Tìm top_k chunk ID trên index toàn cục. Với index nén (float16/int8/PQ), lấy
+    rescore_factor * top_k ứng viên trên mã nén rồi chấm lại bằng vector float32 gốc
+    trong kho chunk. Trả về (distances, chunk_ids) dạng [n_query, top_k] như faiss.search.
+    """
+    query_vectors = np.ascontiguousarray(query_vectors, dtype=np.float32)
+    factor = RESCORE_FACTOR if rescore_factor is None else rescore_factor
+    if factor <= 1 or not is_compressed(index) or view is None:
+        return index.search(query_vectors, top_k)
+    _, candidates = index.search(query_vectors, top_k * factor)
+    distances = np.full((len(query_vectors), top_k), np.inf, dtype=np.float32)
+    ids = np.full((len(query_vectors), top_k), -1, dtype=np.int64)
+    for row, (query, row_ids) in enumerate(zip(query_vectors, candidates)):
+        row_ids = np.array([i for i in row_ids if i >= 0 and view.has_id(int(i))], dtype=np.int64)
+        if len(row_ids) == 0:
+            continue
+        diff = view.embeddings_by_ids(row_ids) - query
+        exact = np.einsum("ij,ij->i", diff, diff)
+        order = np.argsort(exact, kind="stable")[:top_k]
+        distances[row, :len(order)] = exact[order]
+        ids[row, :len(order)] = row_ids[order]
+    return distances, ids
+
+
+def search_documents(view, query_vector, pdf_names, top_k: int):
+    """
+    Tìm kiếm chính xác chỉ trên vector của các tài liệu trong pdf_names.
+    Đọc embedding của từng tài liệu qua mmap nên chi phí tỉ lệ với kích thước tài liệu,
+    không phụ thuộc kích thước toàn bộ kho. Luôn trả về min(top_k, số chunk trong phạm vi)
+    kết quả dưới dạng (distances, chunk_ids) giống faiss.search cho một truy vấn.
+    """
+    query = np.asarray(query_vector, dtype=np.float32).reshape(-1)
+    all_distances = []
+    all_ids = []
+    for pdf_name in pdf_names:
+        id_range = view.doc_id_range(pdf_name)
+        if id_range is None:
+            continue
+        first_id, count = id_range
+        embeddings = np.asarray(view.doc_embeddings(pdf_name), dtype=np.float32)
+        diff = embeddings - query
+        distances = np.einsum("ij,ij->i", diff, diff)
+        # Giữ top_k của từng tài liệu trước khi gộp để bộ nhớ tạm không phình theo phạm vi
+        if len(distances) > top_k:
+            keep = np.argpartition(distances, top_k - 1)[:top_k]
+        else:
+            keep = np.arange(len(distances))
+        all_distances.append(distances[keep])
+        all_ids.append(keep.astype(np.int64) + first_id)
+    if not all_distances:
+        return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+    distances = np.concatenate(all_distances)
+    ids = np.concatenate(all_ids)
+    order = np.argsort(distances, kind="stable")[:top_k]
+    return distances[order], ids[order]
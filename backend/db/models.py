@@ -55,3 +55,26 @@ class Conversation(Base):
     chats = relationship("Chat", backref="conversation")
 
 
+
+
+class IngestJob(Base):
+    __tablename__ = "ingest_jobs"
+
+    id = Column(String(32), primary_key=True)  # uuid4 hex
+    kind = Column(String(20), nullable=False)  # upload | embed
+    pdf_name = Column(String(255), nullable=False, index=True)
+    pdf_path = Column(Text, nullable=False)
+    doc_id = Column(Integer, ForeignKey("documents.id", ondelete="SET NULL"), nullable=True)
+    status = Column(String(20), nullable=False, default="queued", index=True)  # queued | running | done | failed
+    stage = Column(String(20), nullable=False, default="queued")  # queued | ocr | embed | commit | done
+    pages_done = Column(Integer, nullable=False, default=0)
+    pages_total = Column(Integer, nullable=True)
+    chunks_done = Column(Integer, nullable=False, default=0)
+    attempts = Column(Integer, nullable=False, default=0)
+    owner = Column(String(255), nullable=True)  # process đang chạy job ("host:pid"); heartbeat qua updated_at
+    error = Column(Text, nullable=True)
+    stats = Column(Text, nullable=True)  # JSON thống kê thời gian từng bước khi xong
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    started_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
@@ -1,10 +1,11 @@
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse
 from dotenv import load_dotenv
 import os
 
 load_dotenv()  # Load .env
 
-from .core.rag_core import init_models  # Khởi tạo models
+from .core.startup import start_background_warmup, liveness, readiness  # Nạp model nền
 from .routers.chat import router as chat_router
 from .routers.auth import router as auth_router
 from .routers.admin import router as admin_router
@@ -31,9 +32,23 @@ app.include_router(chat_router, prefix="/api")
 app.include_router(auth_router, prefix="/api")
 app.include_router(admin_router, prefix="/api")
 
-# Khởi tạo models (embedding, LLM, FAISS)
-init_models()
+# Nạp models (embedding, LLM, FAISS) và khởi động worker ingest trong thread nền,
+# để server nhận kết nối ngay; chat trả 503 cho tới khi /readyz báo sẵn sàng
+@app.on_event("startup")
+def warmup_models():
+    start_background_warmup()
 
 @app.get("/")
 def root():
-    return {"message": "Welcome to RAG-Chatbot API"}
\ No newline at end of file
+    return {"message": "Welcome to RAG-Chatbot API"}
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: process còn chạy và phục vụ được request."""
+    return liveness()
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: trạng thái nạp từng thành phần; 503 khi chưa phục vụ chat được."""
+    state = readiness()
+    return JSONResponse(state, status_code=200 if state["ready"] else 503)
\ No newline at end of file
@@ -45,3 +45,18 @@ def create_user(payload: dict, db: Session = Depends(get_db), user=Depends(get_c
     return {"id": user_obj.id, "username": user_obj.username, "role": user_obj.role}
 
 
+
+
+@router.post("/index/search-params")
+def update_search_params(payload: dict, user=Depends(get_current_user)):
+    """Điều chỉnh nprobe/efSearch của FAISS index đang phục vụ (chỉ admin)."""
+    require_admin(user)
+
+    nprobe = payload.get("nprobe")
+    ef_search = payload.get("ef_search")
+    for value in (nprobe, ef_search):
+        if value is not None and (not isinstance(value, int) or value <= 0):
+            raise HTTPException(status_code=400, detail="nprobe and ef_search must be positive integers")
+
+    from ..core.rag import set_search_params
+    return set_search_params(nprobe=nprobe, ef_search=ef_search)
@@ -1,55 +1,129 @@
-from fastapi import APIRouter, Depends, UploadFile, File, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, Depends, UploadFile, File, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, StreamingResponse
 from sqlalchemy.orm import Session
 from ..schemas.chat import ChatRequest, ChatResponse
 from ..db.database import get_db
-from ..db.models import Chat, Document
+from ..db.models import Chat, Document, IngestJob
 from ..core.embeding import (
-    ocr_pdf_to_text,
-    clean_text,
-    split_text_to_chunks_vi_tokenized_with_section,
-    create_embeddings,
-    save_embeddings,
     OUTPUT_DIR,
     is_embedded_by_pdf_name,
     normalize_filename,
 )
-from ..core.rag import rag_answer, rag_answer_stream, reload_embeddings  # Từ core
+from ..core.jobs import enqueue_job, get_job, find_active_job, job_to_dict, remove_document, JobQueueFull
+from ..core.rag import rag_answer, rag_answer_astream, reload_embeddings, get_cache_stats, get_stream_stats  # Từ core
+from ..core.model_registry import model_stats
+from ..core.generation import scheduler_stats
+from ..core.startup import is_ready, READY_RETRY_AFTER
+from ..core.admission import get_admission, admission_stats, AdmissionRejected
 import uuid
 import os
+import asyncio
+import weakref
+import contextlib
 from .auth import get_current_user
 
 router = APIRouter()
 
-@router.post("/chat", response_model=ChatResponse)
-def chat_endpoint(request: ChatRequest, db: Session = Depends(get_db), user=Depends(get_current_user)):
-    if not request.query:
-        raise HTTPException(status_code=400, detail="Query is required")
-    
-    # Xác định tài liệu (nếu có) để lọc ngữ cảnh
-    pdf_name = None
+
+def require_models_ready():
+    """Chặn request chat khi model còn đang nạp (503 + Retry-After thay vì treo request)."""
+    if not is_ready():
+        raise HTTPException(status_code=503, detail="Models are loading, please retry later",
+                            headers={"Retry-After": str(READY_RETRY_AFTER)})
+
+
+def admission_key(http_request: Request, user) -> str:
+    """Khóa công bằng của hàng đợi sinh: người dùng đăng nhập, nếu không thì địa chỉ client."""
+    if user is not None:
+        return f"user:{user.id}"
+    return f"ip:{http_request.client.host if http_request.client else 'unknown'}"
+
+
+def admission_error(e: AdmissionRejected) -> HTTPException:
+    return HTTPException(status_code=e.status_code, detail=e.reason, headers={"Retry-After": str(e.retry_after)})
+
+
+def resolve_scope(request: ChatRequest, db: Session):
+    """
+    Xác định phạm vi tài liệu để tìm ngữ cảnh từ doc_id, pdf_name, pdf_names và category.
+    Trả về None (toàn bộ kho) hoặc danh sách pdf_name. Các nguồn được gộp lại với nhau.
+    """
+    pdf_names = []
     if request.doc_id is not None:
         doc = db.query(Document).filter(Document.id == request.doc_id).first()
         if doc is None:
             raise HTTPException(status_code=404, detail="Document not found")
-        pdf_name = doc.pdf_name
+        pdf_names.append(doc.pdf_name)
     elif request.pdf_name:
-        pdf_name = request.pdf_name
+        pdf_names.append(request.pdf_name)
+    if request.pdf_names:
+        pdf_names.extend(request.pdf_names)
+    if request.category:
+        in_category = [
+            item["pdf_name"] for item in list_documents(db)["items"]
+            if item["category"] == request.category
+        ]
+        if not in_category:
+            raise HTTPException(status_code=404, detail="Category not found")
+        pdf_names.extend(in_category)
+    return pdf_names or None
 
-    # Generate response
-    response = rag_answer(request.query, pdf_name=pdf_name)
+
+@router.post("/chat", response_model=ChatResponse, dependencies=[Depends(require_models_ready)])
+async def chat_endpoint(request: ChatRequest, http_request: Request, db: Session = Depends(get_db),
+                        user=Depends(get_current_user)):
+    if not request.query:
+        raise HTTPException(status_code=400, detail="Query is required")
     
-    # Lưu lịch sử (chỉ khi có user đăng nhập)
+    # Xác định tài liệu (nếu có) để lọc ngữ cảnh
+    pdf_name = await run_in_threadpool(resolve_scope, request, db)
+
+    # Chờ chỗ trong hàng đợi sinh trên event loop (429/503 + Retry-After nếu quá tải): request đang chờ
+    # không giữ thread nào của threadpool, nên các endpoint đồng bộ khác vẫn chạy được
+    admission = get_admission()
+    try:
+        ticket = await admission.acquire_async(admission_key(http_request, user))
+    except AdmissionRejected as e:
+        raise admission_error(e)
+
+    # Generate response (lượt sau cùng session_id nối tiếp KV và chunk của lượt trước). Chỉ client gửi
+    # session_id mới giữ state phiên; ID sinh mới chỉ dùng cho lịch sử chat và response, không chiếm KV
     session_id = request.session_id or str(uuid.uuid4())
+    try:
+        response = await run_in_threadpool(rag_answer, request.query, pdf_name=pdf_name,
+                                           session_id=request.session_id)
+    except TimeoutError:
+        # Sinh quá GENERATION_TIMEOUT (request đã bị hủy trong generate_answer)
+        raise HTTPException(status_code=504, detail="Generation timed out, please retry later")
+    finally:
+        admission.release(ticket)
+    
+    # Lưu lịch sử (chỉ khi có user đăng nhập)
     if user is not None:
         chat = Chat(session_id=session_id, user_query=request.query, ai_response=response, user_id=user.id)
-        db.add(chat)
-        db.commit()
+
+        def save_chat():
+            db.add(chat)
+            db.commit()
+
+        await run_in_threadpool(save_chat)
     
     return ChatResponse(response=response, session_id=session_id)
 
+@router.get("/cache/stats")
+def cache_stats():
+    """Tỉ lệ hit của cache embedding câu hỏi và cache kết quả truy xuất."""
+    return get_cache_stats()
+
+@router.get("/models/stats")
+def models_stats():
+    """Thời gian nạp và bộ nhớ của từng model, thống kê bộ lập lịch sinh, hàng đợi tiếp nhận và token sinh/gửi của luồng stream."""
+    return {**model_stats(), "generation": scheduler_stats(), "admission": admission_stats(),
+            "streams": get_stream_stats()}
+
 @router.post("/upload-pdf")
-def upload_pdf(file: UploadFile = File(...), db: Session = Depends(get_db)):
+def upload_pdf(response: Response, file: UploadFile = File(...), db: Session = Depends(get_db)):
     if not file.filename.lower().endswith(".pdf"):
         raise HTTPException(status_code=400, detail="Only PDF files allowed")
 
@@ -60,6 +134,10 @@ def upload_pdf(file: UploadFile = File(...), db: Session = Depends(get_db)):
     # Nếu đã tồn tại trong DB thì bỏ qua để tránh embed trùng
     existing = db.query(Document).filter(Document.pdf_name == pdf_name).first()
     if existing:
+        active = find_active_job(db, pdf_name)
+        if active is not None:
+            return {"message": "PDF is being embedded", "doc_id": existing.id, "pdf_name": pdf_name,
+                    "job_id": active.id, "status": active.status}
         return {"message": "PDF already embedded", "doc_id": existing.id, "pdf_name": pdf_name}
 
     # Lưu file tạm vào backend/data/uploads để xử lý OCR/Embedding
@@ -70,65 +148,114 @@ def upload_pdf(file: UploadFile = File(...), db: Session = Depends(get_db)):
     with open(saved_pdf_path, "wb") as f:
         f.write(file.file.read())
 
-    # OCR và xử lý văn bản
-    raw_text = ocr_pdf_to_text(saved_pdf_path, OUTPUT_DIR)
-    if not raw_text:
-        raise HTTPException(status_code=500, detail="OCR failed")
-
-    cleaned_text = clean_text(raw_text, saved_pdf_path, OUTPUT_DIR)
-    chunks_local = split_text_to_chunks_vi_tokenized_with_section(cleaned_text)
-    embeddings = create_embeddings(chunks_local)
-    save_embeddings(chunks_local, embeddings, saved_pdf_path, OUTPUT_DIR)
-
-    # Lưu metadata vào DB (lưu cả tên gốc và tên đã chuyển đổi)
+    # Lưu metadata vào DB ngay để trả doc_id (job nền sẽ xóa record nếu OCR/embed thất bại)
     doc = Document(pdf_name=pdf_name, path=saved_pdf_path, original_filename=file.filename)
     db.add(doc)
     db.commit()
 
-    # Reload embeddings để cập nhật RAG system
-    reload_embeddings()
+    # OCR/embed chạy nền; client theo dõi qua GET /api/jobs/{job_id}
+    try:
+        job = enqueue_job("upload", pdf_name, saved_pdf_path, doc_id=doc.id)
+    except JobQueueFull as e:
+        db.delete(doc)
+        db.commit()
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "60"})
+
+    response.status_code = 202
+    return {
+        "message": "PDF queued for embedding",
+        "doc_id": doc.id,
+        "pdf_name": pdf_name,
+        "original_filename": file.filename,
+        "job_id": job["id"],
+        "status": job["status"],
+    }
+
+
+@router.get("/jobs")
+def list_jobs(status: str | None = None, limit: int = 50, db: Session = Depends(get_db)):
+    query = db.query(IngestJob)
+    if status:
+        query = query.filter(IngestJob.status == status)
+    jobs = query.order_by(IngestJob.created_at.desc()).limit(max(1, min(limit, 500))).all()
+    return {"items": [job_to_dict(job) for job in jobs]}
 
-    return {"message": "PDF embedded successfully", "doc_id": doc.id, "pdf_name": pdf_name, "original_filename": file.filename}
 
+@router.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@router.post("/chat/stream", dependencies=[Depends(require_models_ready)])
+async def chat_stream_endpoint(request: ChatRequest, http_request: Request, db: Session = Depends(get_db),
+                               user=Depends(get_current_user)):
+    from ..core.stopping import CancelToken
 
-@router.post("/chat/stream")
-def chat_stream_endpoint(request: ChatRequest, db: Session = Depends(get_db), user=Depends(get_current_user)):
     if not request.query:
         raise HTTPException(status_code=400, detail="Query is required")
 
     session_id = request.session_id or str(uuid.uuid4())
+    cancel_token = CancelToken()
 
-    def event_generator():
-        # Stream từng chunk text ra client theo SSE
-        pdf_name = None
-        if request.doc_id is not None:
-            doc = db.query(Document).filter(Document.id == request.doc_id).first()
-            if doc is None:
-                # Nếu tài liệu không tồn tại, dừng stream với thông báo lỗi
-                yield f"data: Tài liệu không tồn tại.\n\n"
+    # Lấy chỗ trước khi mở stream để còn trả được mã 429/503 thay vì một stream rỗng
+    admission = get_admission()
+    try:
+        ticket = await admission.acquire_async(admission_key(http_request, user))
+    except AdmissionRejected as e:
+        raise admission_error(e)
+
+    async def watch_disconnect():
+        # Body đã được đọc hết; message tiếp theo từ server chỉ có thể là http.disconnect
+        while True:
+            message = await http_request.receive()
+            if message["type"] == "http.disconnect":
+                cancel_token.cancel()
                 return
-            pdf_name = doc.pdf_name
-        elif request.pdf_name:
-            pdf_name = request.pdf_name
-        for chunk in rag_answer_stream(request.query, pdf_name=pdf_name):
-            if not chunk:
-                continue
-            # SSE chuẩn: mỗi dòng dữ liệu đều bắt đầu bằng 'data:'
-            # và một sự kiện kết thúc bằng dòng trống.
-            for line in str(chunk).splitlines():
-                yield f"data: {line}\n"
-            # Kết thúc một sự kiện
-            yield "\n"
+
+    async def event_generator():
+        # Stream từng chunk text ra client theo SSE
+        try:
+            pdf_name = await run_in_threadpool(resolve_scope, request, db)
+        except HTTPException:
+            admission.release(ticket)
+            # Nếu tài liệu không tồn tại, dừng stream với thông báo lỗi
+            yield f"data: Tài liệu không tồn tại.\n\n"
+            return
+        watcher = asyncio.create_task(watch_disconnect())
+        try:
+            async with contextlib.aclosing(rag_answer_astream(request.query, pdf_name=pdf_name, cancel_token=cancel_token,
+                                                              session_id=request.session_id)) as chunks:
+                async for chunk in chunks:
+                    if cancel_token.cancelled:
+                        return
+                    if not chunk:
+                        continue
+                    # SSE chuẩn: mỗi dòng dữ liệu đều bắt đầu bằng 'data:'
+                    # và một sự kiện kết thúc bằng dòng trống.
+                    for line in str(chunk).splitlines():
+                        yield f"data: {line}\n"
+                    # Kết thúc một sự kiện
+                    yield "\n"
+        finally:
+            # Client ngắt kết nối (hoặc stream bị hủy): dừng sinh trong một bước giải mã
+            cancel_token.cancel()
+            watcher.cancel()
+            admission.release(ticket)
         # Kết thúc stream
         yield "data: [DONE]\n\n"
 
-    from fastapi.responses import StreamingResponse
     headers = {
         "Cache-Control": "no-cache, no-transform",
         "Connection": "keep-alive",
         "X-Accel-Buffering": "no",
     }
-    response = StreamingResponse(event_generator(), media_type="text/event-stream", headers=headers)
+    events = event_generator()
+    # Generator không bao giờ chạy (client đi ngay khi nhận header) thì vẫn trả chỗ khi nó bị thu hồi
+    weakref.finalize(events, admission.release, ticket)
+    response = StreamingResponse(events, media_type="text/event-stream", headers=headers)
     return response
 
 
@@ -245,7 +372,7 @@ def view_document(pdf_name: str, category: str | None = None):
 
 
 @router.post("/documents/{pdf_name}/embed")
-def embed_existing_document(pdf_name: str, category: str | None = None):
+def embed_existing_document(pdf_name: str, response: Response, category: str | None = None):
     # Tìm file trong uploads hoặc initial_docs (cả results và data)
     backend_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
     uploads_dirs = [
@@ -297,19 +424,14 @@ def embed_existing_document(pdf_name: str, category: str | None = None):
     if is_embedded_by_pdf_name(pdf_name, OUTPUT_DIR):
         return {"message": "Already embedded", "pdf_name": pdf_name}
 
-    # Thực hiện OCR/clean/chunk/embed
-    raw_text = ocr_pdf_to_text(pdf_path, OUTPUT_DIR)
-    if not raw_text:
-        raise HTTPException(status_code=500, detail="OCR failed")
-    cleaned_text = clean_text(raw_text, pdf_path, OUTPUT_DIR)
-    chunks_local = split_text_to_chunks_vi_tokenized_with_section(cleaned_text)
-    embeddings = create_embeddings(chunks_local)
-    save_embeddings(chunks_local, embeddings, pdf_path, OUTPUT_DIR)
-    
-    # Reload embeddings để cập nhật RAG system
-    reload_embeddings()
-    
-    return {"message": "Embedded successfully", "pdf_name": pdf_name}
+    # OCR/clean/chunk/embed chạy nền; client theo dõi qua GET /api/jobs/{job_id}
+    try:
+        job = enqueue_job("embed", pdf_name, pdf_path)
+    except JobQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "60"})
+
+    response.status_code = 202
+    return {"message": "Embedding queued", "pdf_name": pdf_name, "job_id": job["id"], "status": job["status"]}
 
 
 @router.delete("/documents/{pdf_name}")
@@ -339,9 +461,9 @@ def delete_document(pdf_name: str, db: Session = Depends(get_db), user=Depends(g
         # Xóa file PDF
         os.remove(pdf_path)
         
-        # Xóa embeddings và FAISS index nếu có
-        from ..core.embeding import remove_embeddings_by_pdf_name
-        remove_embeddings_by_pdf_name(pdf_name, OUTPUT_DIR)
+        # Xóa embeddings và FAISS index nếu có, rồi reload RAG: qua thread ghi của jobs (như khi đăng ký
+        # segment) để không chen vào giữa lúc một job ingest đăng ký segment và reload
+        remove_document(pdf_name)
         
         # Xóa record trong database nếu có
         doc = db.query(Document).filter(Document.pdf_name == pdf_name).first()
@@ -349,9 +471,6 @@ def delete_document(pdf_name: str, db: Session = Depends(get_db), user=Depends(g
             db.delete(doc)
             db.commit()
         
-        # Reload embeddings để cập nhật RAG system
-        reload_embeddings()
-        
         return {"message": f"Document {pdf_name} deleted successfully"}
         
     except Exception as e:
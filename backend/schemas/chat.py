@@ -1,11 +1,13 @@
 from pydantic import BaseModel
-from typing import Optional
+from typing import Optional, List
 
 class ChatRequest(BaseModel):
     query: str
     session_id: Optional[str] = None  # Để duy trì lịch sử nếu cần
     doc_id: Optional[int] = None  # Tùy chọn: giới hạn truy vấn theo tài liệu đã upload
     pdf_name: Optional[str] = None  # Tùy chọn: cho tài liệu khởi tạo (không có doc_id)
+    pdf_names: Optional[List[str]] = None  # Tùy chọn: giới hạn truy vấn theo nhiều tài liệu
+    category: Optional[str] = None  # Tùy chọn: giới hạn theo category trong /api/documents
 
 class ChatResponse(BaseModel):
     response: str
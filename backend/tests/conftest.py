@@ -0,0 +1,46 @@
+# conftest.py: cấu hình chung cho các test của backend
+#
+# Chạy từ thư mục gốc repo:
+#   python -m pytest -q backend/tests
+# Các test chỉ dùng dữ liệu tổng hợp nhỏ và model giả, không cần model thật hay GPU.
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from backend.core import chunk_store  # noqa: E402
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """Kho chunk rỗng trong thư mục tạm; tắt compact tự động để test tự gọi compact()."""
+    monkeypatch.setattr(chunk_store, "MAX_SEGMENTS", 1000)
+    monkeypatch.setattr(chunk_store, "COMPACT_DEAD_RATIO", 1.0)
+    return chunk_store.ChunkStore(str(tmp_path / "chunks"))
+
+
+def word_level_tokenizer(words, special=("[PAD]", "[UNK]", "[CLS]", "[SEP]")):
+    """Tokenizer nhanh dựng trong bộ nhớ (mỗi từ một token, tách theo khoảng trắng/dấu câu) cho model giả."""
+    from tokenizers import Tokenizer, models, pre_tokenizers, processors
+    from transformers import PreTrainedTokenizerFast
+
+    vocab = {token: i for i, token in enumerate(dict.fromkeys([*special, *words]))}
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="[CLS] $A [SEP]", special_tokens=[("[CLS]", vocab["[CLS]"]), ("[SEP]", vocab["[SEP]"])])
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="[PAD]", unk_token="[UNK]",
+                                   cls_token="[CLS]", sep_token="[SEP]", model_max_length=512)
+
+
+def synthetic_doc(name: str, count: int, dim: int = 8, seed: int = 0):
+    """(chunks, embeddings) giả cho một tài liệu: văn bản có dấu tiếng Việt để kiểm tra mã hóa UTF-8."""
+    rng = np.random.default_rng(seed)
+    chunks = [f"{name} - đoạn {i}: an toàn thông tin mạng" for i in range(count)]
+    return chunks, rng.standard_normal((count, dim)).astype(np.float32)
@@ -0,0 +1,127 @@
+import asyncio
+
+import pytest
+
+from backend.core.admission import AdmissionController, AdmissionRejected
+
+
+def _controller(**kwargs):
+    options = {"max_concurrent": 1, "max_queue": 16, "max_queue_per_user": 3, "queue_timeout": 60}
+    return AdmissionController(**{**options, **kwargs})
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_free_slot_is_granted_immediately():
+    controller = _controller(max_concurrent=2)
+    first, second = controller.acquire("a"), controller.acquire("a")
+    assert controller.stats()["active"] == 2
+    controller.release(first)
+    controller.release(first)  # gọi lại không trả chỗ hai lần
+    assert controller.stats()["active"] == 1
+    controller.release(second)
+    assert controller.stats()["active"] == 0
+
+
+def test_slots_rotate_between_users():
+    async def scenario():
+        controller = _controller()
+        holder = await controller.acquire_async("holder")
+        order = []
+
+        async def request(user, label):
+            ticket = await controller.acquire_async(user)
+            order.append(label)
+            return ticket
+
+        tasks = []
+        for user, label in [("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1"), ("c", "c1")]:
+            tasks.append(asyncio.create_task(request(user, label)))
+            await _settle()
+        assert controller.stats()["queue_depth"] == 5
+
+        controller.release(holder)
+        for _ in tasks:
+            await _settle()
+            granted = [t for t in tasks if t.done() and not t.result().released]
+            assert len(granted) == 1
+            controller.release(granted[0].result())
+        await asyncio.gather(*tasks)
+        return order, controller.stats()
+
+    order, stats = asyncio.run(scenario())
+    # Người gửi dồn dập (a) không chặn b, c: mỗi vòng mỗi người một lượt
+    assert order == ["a1", "b1", "c1", "a2", "a3"]
+    assert stats["admitted"] == 6 and stats["active"] == 0 and stats["queue_depth"] == 0
+
+
+def test_per_user_limit_rejects_with_429():
+    async def scenario():
+        controller = _controller()
+        holder = await controller.acquire_async("holder")
+        waiting = [asyncio.create_task(controller.acquire_async("a")) for _ in range(3)]
+        await _settle()
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.acquire_async("a")
+        # Người dùng khác vẫn được xếp hàng
+        other = asyncio.create_task(controller.acquire_async("b"))
+        await _settle()
+        stats = controller.stats()
+        for task in waiting + [other]:
+            task.cancel()
+        await asyncio.gather(*waiting, other, return_exceptions=True)
+        controller.release(holder)
+        return rejected.value, stats, controller.stats()
+
+    rejected, stats, after = asyncio.run(scenario())
+    assert rejected.status_code == 429 and rejected.retry_after >= 1
+    assert stats["rejected_user_limit"] == 1 and stats["queue_depth"] == 4
+    # Client bỏ đi khi đang chờ: hàng đợi và chỗ được trả lại hết
+    assert after["queue_depth"] == 0 and after["active"] == 0
+
+
+def test_full_queue_rejects_with_503():
+    async def scenario():
+        controller = _controller(max_queue=2)
+        holder = await controller.acquire_async("holder")
+        waiting = [asyncio.create_task(controller.acquire_async(user)) for user in ("a", "b")]
+        await _settle()
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.acquire_async("c")
+        for task in waiting:
+            task.cancel()
+        await asyncio.gather(*waiting, return_exceptions=True)
+        controller.release(holder)
+        return rejected.value, controller.stats()
+
+    rejected, stats = asyncio.run(scenario())
+    assert rejected.status_code == 503 and rejected.retry_after >= 1
+    assert stats["rejected_queue_full"] == 1
+
+
+def test_estimated_wait_beyond_deadline_rejects_immediately():
+    controller = _controller()
+    holder = controller.acquire("holder")
+    controller._service_seconds = 10.0
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire("a", timeout=1)
+    assert rejected.value.status_code == 503
+    assert rejected.value.retry_after == 10
+    assert controller.stats()["rejected_wait_estimate"] == 1
+    controller.release(holder)
+
+
+def test_queue_timeout_returns_503():
+    controller = _controller()
+    holder = controller.acquire("holder")
+    controller._service_seconds = 0.01
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire("a", timeout=0.05)
+    assert rejected.value.status_code == 503
+    stats = controller.stats()
+    assert stats["timed_out"] == 1 and stats["queue_depth"] == 0
+    controller.release(holder)
+    assert controller.acquire("a", timeout=0.05).admitted_at is not None
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from backend.core import rag
+from backend.core.cache import AnswerCache
+
+QUESTION = "luật an toàn thông tin mạng áp dụng cho ai"
+
+
+@pytest.fixture
+def cache():
+    return AnswerCache(1024 * 1024, similarity_threshold=0.95)
+
+
+@pytest.fixture(autouse=True)
+def fresh_prompt_version(monkeypatch):
+    monkeypatch.setattr(rag, "_prompt_version", None)
+
+
+def test_context_key_changes_invalidate_answer(cache):
+    key = rag._answer_context_key([3, 1, 2], "luat.pdf", 512)
+    cache.put(QUESTION, key, "answer")
+
+    # Cùng tập chunk (khác thứ tự), cùng phạm vi: dùng lại
+    assert cache.get(QUESTION, rag._answer_context_key([1, 2, 3], ["luat.pdf"], 512)) == "answer"
+    for other in (
+        rag._answer_context_key([1, 2, 4], "luat.pdf", 512),              # chunk truy xuất khác (kho đã đổi)
+        rag._answer_context_key([1, 2, 3], ["luat.pdf", "nd.pdf"], 512),  # phạm vi tài liệu khác
+        rag._answer_context_key([1, 2, 3], None, 512),
+        rag._answer_context_key([1, 2, 3], "luat.pdf", 256),              # giới hạn sinh khác (stream vs chat)
+    ):
+        assert other != key
+        assert cache.get(QUESTION, other) is None
+    assert cache.get("câu hỏi khác", key) is None
+
+
+def test_prompt_or_model_change_invalidates_answer(cache, monkeypatch):
+    key = rag._answer_context_key([1, 2], None, 512)
+    cache.put(QUESTION, key, "answer")
+
+    monkeypatch.setattr(rag, "_prompt_version", None)
+    monkeypatch.setattr(rag, "LLM_MODEL_PATH", rag.LLM_MODEL_PATH + "-v2")
+    new_key = rag._answer_context_key([1, 2], None, 512)
+    assert new_key != key
+    assert cache.get(QUESTION, new_key) is None
+
+    monkeypatch.setattr(rag, "_prompt_version", None)
+    monkeypatch.setattr(rag, "GENERATION_KWARGS", {**rag.GENERATION_KWARGS, "temperature": 0.123})
+    assert rag._answer_context_key([1, 2], None, 512) not in (key, new_key)
+
+
+def test_semantic_hit_only_within_same_context(cache):
+    vector = np.array([1.0, 0.0, 0.0], dtype=np.float32)
+    near = np.array([0.99, 0.05, 0.0], dtype=np.float32)
+    far = np.array([0.0, 1.0, 0.0], dtype=np.float32)
+    key = rag._answer_context_key([1], None, 512)
+    cache.put(QUESTION, key, "answer", vector)
+
+    assert cache.get("câu hỏi diễn đạt khác", key, near) == "answer"
+    assert cache.get("câu hỏi diễn đạt khác", key, far) is None
+    assert cache.get("câu hỏi diễn đạt khác", rag._answer_context_key([2], None, 512), near) is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["semantic_hits"], stats["misses"]) == (1, 1, 2)
+
+
+def test_byte_limit_evicts_oldest():
+    cache = AnswerCache(1000)
+    for i in range(5):
+        cache.put(f"q{i}", "ctx", "x" * 300)
+    stats = cache.stats()
+    assert stats["bytes"] <= 1000 and stats["evictions"] > 0
+    assert cache.get("q0", "ctx") is None
+    assert cache.get("q4", "ctx") == "x" * 300
+    # Câu trả lời lớn hơn cả cache thì không lưu
+    cache.put("big", "ctx", "x" * 2000)
+    assert cache.get("big", "ctx") is None
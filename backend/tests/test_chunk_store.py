@@ -0,0 +1,93 @@
+import os
+
+import numpy as np
+
+from backend.core.chunk_store import ChunkStore
+
+from conftest import synthetic_doc
+
+
+def _assert_doc(view, name, chunks, embeddings, first_id):
+    assert view.doc_id_range(name) == (first_id, len(chunks))
+    ids = list(range(first_id, first_id + len(chunks)))
+    assert [view.text_by_id(i) for i in ids] == chunks
+    assert [view.metadata_by_id(i)["chunk_index"] for i in ids] == list(range(len(chunks)))
+    np.testing.assert_array_equal(view.embeddings_by_ids(ids), embeddings)
+    np.testing.assert_array_equal(np.asarray(view.doc_embeddings(name)), embeddings)
+
+
+def test_append_round_trip(store):
+    docs = {name: synthetic_doc(name, count, seed=i) for i, (name, count) in enumerate([("a.pdf", 3), ("b.pdf", 5)])}
+    entries = {name: store.append(name, chunks, embeddings) for name, (chunks, embeddings) in docs.items()}
+
+    view = store.view()
+    assert len(view) == 8
+    assert view.doc_names() == ["a.pdf", "b.pdf"]
+    for name, (chunks, embeddings) in docs.items():
+        _assert_doc(view, name, chunks, embeddings, entries[name]["first_id"])
+
+    # Mở lại từ đĩa (process khác) cho cùng dữ liệu
+    reopened = ChunkStore(store.root).view()
+    for name, (chunks, embeddings) in docs.items():
+        _assert_doc(reopened, name, chunks, embeddings, entries[name]["first_id"])
+
+
+def test_token_stats_round_trip(store):
+    chunks, embeddings = synthetic_doc("a.pdf", 3)
+    entry = store.append("a.pdf", chunks, embeddings, token_stats=[(10, 0, 0), (12, 5, 2), (9, 4, 1)])
+    view = store.view()
+    first = entry["first_id"]
+    assert [view.token_stats_by_id(first + i) for i in range(3)] == [(10, 0, 0), (12, 5, 2), (9, 4, 1)]
+
+    store.append("b.pdf", *synthetic_doc("b.pdf", 2))
+    assert store.view().token_stats_by_id(store.view().doc_id_range("b.pdf")[0]) is None
+
+
+def test_replace_and_remove_keep_ids_stable(store):
+    store.append("a.pdf", *synthetic_doc("a.pdf", 3, seed=1))
+    b_chunks, b_embeddings = synthetic_doc("b.pdf", 4, seed=2)
+    b_entry = store.append("b.pdf", b_chunks, b_embeddings)
+
+    new_chunks, new_embeddings = synthetic_doc("a.pdf v2", 2, seed=3)
+    entry = store.append("a.pdf", new_chunks, new_embeddings)
+    assert [(old["first_id"], old["count"]) for old in entry["replaced"]] == [(0, 3)]
+    assert entry["first_id"] == 7  # ID không được dùng lại
+
+    removed = store.remove("b.pdf")
+    assert [(doc["first_id"], doc["count"]) for doc in removed] == [(b_entry["first_id"], 4)]
+    assert store.remove("b.pdf") == []
+
+    view = store.view()
+    assert view.doc_names() == ["a.pdf"]
+    assert not view.has_id(0) and not view.has_id(b_entry["first_id"])
+    _assert_doc(view, "a.pdf", new_chunks, new_embeddings, 7)
+
+
+def test_compaction_merges_segments_and_preserves_data(store):
+    docs = {f"doc{i}.pdf": synthetic_doc(f"doc{i}.pdf", 2 + i, seed=i) for i in range(4)}
+    entries = {name: store.append(name, chunks, embeddings, token_stats=[(i + 1, 0, 0) for i in range(len(chunks))])
+               for name, (chunks, embeddings) in docs.items()}
+    store.remove("doc1.pdf")
+    before = store.view()
+    assert len(store._read_manifest()["segments"]) == 3
+
+    assert store.compact()
+    manifest = store._read_manifest()
+    assert len(manifest["segments"]) == 1
+    assert manifest["segments"][0]["rows"] == len(before)
+
+    view = store.view()
+    assert view.version > before.version
+    assert view.doc_names() == ["doc0.pdf", "doc2.pdf", "doc3.pdf"]
+    for name in view.doc_names():
+        chunks, embeddings = docs[name]
+        _assert_doc(view, name, chunks, embeddings, entries[name]["first_id"])
+        first = entries[name]["first_id"]
+        assert view.token_stats_by_id(first + 1) == (2, 0, 0)
+    # Ảnh chụp cũ vẫn đọc được sau khi compact (segment nguồn vẫn còn mở qua mmap)
+    _assert_doc(before, "doc0.pdf", *docs["doc0.pdf"], entries["doc0.pdf"]["first_id"])
+
+    # Segment nguồn đã bị dọn khỏi đĩa; chỉ còn segment mới
+    segment_dirs = sorted(p for p in os.listdir(store.root) if p.startswith("seg_"))
+    assert segment_dirs == [manifest["segments"][0]["name"]]
+    assert not store.compact()
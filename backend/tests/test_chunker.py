@@ -0,0 +1,74 @@
+import random
+
+import pytest
+
+pytest.importorskip("underthesea")
+
+from backend.benchmarks.bench_chunker import _WORDS, reference_split, synthetic_text  # noqa: E402
+from backend.core import embeding, model_registry, pipeline  # noqa: E402
+
+from conftest import word_level_tokenizer  # noqa: E402
+
+_TRICKY = [
+    "Theo Điều 5.2 của Luật ATTT", "tại TP. Hồ Chí Minh", "ông Nguyễn V. A. đã ký", "tỷ lệ 3.5% và 12.000 đồng",
+    "xem mục a), b) v.v.", "\"Hệ thống phải được giám sát.\"", "Số: 123/QĐ-BTTTT", "ngày 01.01.2023", "Đúng vậy!",
+]
+
+
+def tricky_text(num_sections=30, seed=1):
+    """Văn bản có viết tắt, số thập phân, dấu ngoặc kép và xuống dòng giữa các câu (khó cho tách câu)."""
+    rng = random.Random(seed)
+    sections = []
+    for i in range(num_sections):
+        parts = []
+        for _ in range(rng.randint(3, 50)):
+            sentence = " ".join(rng.choice(_TRICKY) for _ in range(rng.randint(1, 4)))
+            parts.append(sentence + rng.choice([".", ".", "?", "!", ";", ""]) + rng.choice([" ", " ", "\n"]))
+        sections.append(f"{i + 1}. " + "".join(parts).strip())
+    return "\n".join(sections)
+
+
+TEXTS = {
+    "synthetic": synthetic_text(40, seed=0),
+    "tricky": tricky_text(),
+}
+
+
+@pytest.fixture
+def tokenizer(monkeypatch):
+    tokenizer = word_level_tokenizer(_WORDS)
+    monkeypatch.delitem(model_registry._entries, "embedding_tokenizer", raising=False)
+    model_registry.set_model("embedding_tokenizer", tokenizer)
+    return tokenizer
+
+
+@pytest.mark.parametrize("name", TEXTS)
+@pytest.mark.parametrize("chunk_size, overlap", [(64, 10), (128, 20), (512, 50)])
+def test_chunker_matches_reference(tokenizer, name, chunk_size, overlap):
+    text = TEXTS[name]
+    expected = reference_split(tokenizer, text, chunk_size, overlap)
+    assert len(expected) > 1
+    assert embeding.split_text_to_chunks_vi_tokenized_with_section(text, chunk_size, overlap, workers=1) == expected
+
+
+def test_parallel_sentence_split_matches_reference(tokenizer, monkeypatch):
+    monkeypatch.setattr(embeding, "CHUNKER_PARALLEL_MIN_CHARS", 0)
+    text = TEXTS["tricky"]
+    try:
+        chunks = embeding.split_text_to_chunks_vi_tokenized_with_section(text, 128, 20, workers=2)
+    finally:
+        if embeding._sentence_pool is not None:
+            embeding._sentence_pool.shutdown()
+            embeding._sentence_pool = None
+    assert chunks == reference_split(tokenizer, text, 128, 20)
+
+
+@pytest.mark.parametrize("name", TEXTS)
+@pytest.mark.parametrize("section_chars, page_chars", [(300, 97), (700, 500), (1500, 2500)])
+def test_chunk_stream_matches_whole_text(tokenizer, monkeypatch, name, section_chars, page_chars):
+    # Ngưỡng section nhỏ để section dài bị chunk dần theo câu khi văn bản đến theo từng trang
+    monkeypatch.setattr(pipeline, "PIPELINE_MAX_SECTION_CHARS", section_chars)
+    text = TEXTS[name]
+    expected = embeding.split_text_to_chunks_vi_tokenized_with_section(text, 128, 20, workers=1)
+    pages = [text[i:i + page_chars] for i in range(0, len(text), page_chars)]
+    assert [chunk for chunk, _ in pipeline.chunk_stream(pages, 128, 20)] == expected
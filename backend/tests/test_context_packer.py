@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from backend.core.context_packer import overlap_prefix, pack_context, SEPARATOR_TOKENS
+
+# Ba chunk liền nhau của một tài liệu, mỗi chunk gối đầu bằng câu cuối của chunk trước (như chunker)
+CHUNKS = [
+    "Điều 1. Phạm vi điều chỉnh của luật an toàn thông tin mạng.",
+    "Phạm vi điều chỉnh của luật an toàn thông tin mạng. Điều 2. Đối tượng áp dụng là cơ quan, tổ chức.",
+    "Đối tượng áp dụng là cơ quan, tổ chức. Điều 3. Giải thích từ ngữ trong luật.",
+]
+OTHER = ["Nghị định quy định chi tiết về ứng cứu sự cố."]
+
+
+def _token_stats(chunks):
+    stats = []
+    for i, chunk in enumerate(chunks):
+        chars = overlap_prefix(chunks[i - 1], chunk) if i else 0
+        stats.append((len(chunk.split()), chars, len(chunk[:chars].split())))
+    return stats
+
+
+@pytest.fixture(params=["ingest_stats", "legacy"])
+def packed_view(request, store):
+    """Kho có số liệu token lúc ingest, hoặc segment cũ chưa có (bộ xếp tự so khớp chuỗi)."""
+    with_stats = request.param == "ingest_stats"
+    for name, chunks in (("luat.pdf", CHUNKS), ("nghidinh.pdf", OTHER)):
+        embeddings = np.zeros((len(chunks), 4), dtype=np.float32)
+        store.append(name, chunks, embeddings, token_stats=_token_stats(chunks) if with_stats else None)
+    return store.view()
+
+
+def test_overlap_prefix_matches_word_boundaries():
+    chars = overlap_prefix(CHUNKS[0], CHUNKS[1])
+    assert CHUNKS[1][chars:] == "Điều 2. Đối tượng áp dụng là cơ quan, tổ chức."
+    assert overlap_prefix(CHUNKS[0], OTHER[0]) == 0
+    # Trùng ngắn hơn OVERLAP_MIN_WORDS từ không bị coi là phần gối đầu
+    assert overlap_prefix("một hai ba bốn", "ba bốn năm") == 0
+
+
+def test_adjacent_chunks_are_joined_without_repeated_overlap(packed_view):
+    first, _ = packed_view.doc_id_range("luat.pdf")
+    other, _ = packed_view.doc_id_range("nghidinh.pdf")
+    packed = pack_context(packed_view, [first + 1, other, first, first + 2])
+
+    assert packed.chunk_ids == [first + 1, other, first, first + 2]
+    assert packed.chunks == [
+        "Điều 1. Phạm vi điều chỉnh của luật an toàn thông tin mạng.\n"
+        "Điều 2. Đối tượng áp dụng là cơ quan, tổ chức.\n"
+        "Điều 3. Giải thích từ ngữ trong luật.",
+        OTHER[0],
+    ]
+    joined = "\n".join(packed.chunks)
+    for sentence in ("Phạm vi điều chỉnh", "Đối tượng áp dụng"):
+        assert joined.count(sentence) == 1
+    assert packed.tokens_deduplicated > 0
+    assert packed.tokens == packed.tokens_full - packed.tokens_deduplicated - 2 * SEPARATOR_TOKENS
+    assert packed.dropped == 0
+
+
+def test_chunks_already_in_prompt_are_not_repeated(packed_view):
+    first, _ = packed_view.doc_id_range("luat.pdf")
+    packed = pack_context(packed_view, [first, first + 1], present=[first])
+    assert packed.chunk_ids == [first + 1]
+    assert packed.chunks == ["Điều 2. Đối tượng áp dụng là cơ quan, tổ chức."]
+
+
+def test_budget_drops_less_relevant_chunks(packed_view):
+    first, _ = packed_view.doc_id_range("luat.pdf")
+    other, _ = packed_view.doc_id_range("nghidinh.pdf")
+    full = pack_context(packed_view, [first, other])
+    packed = pack_context(packed_view, [first, other], budget=full.tokens - 1)
+    assert packed.chunk_ids == [first]
+    assert packed.dropped == 1
+    assert packed.tokens <= packed.budget
+    # Bỏ qua chunk ID không còn trong kho (tài liệu đã xóa)
+    assert pack_context(packed_view, [10_000]).chunks == []
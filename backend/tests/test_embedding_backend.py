@@ -0,0 +1,70 @@
+import random
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("sentence_transformers")
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+from backend.core import embedding_backend  # noqa: E402
+
+from conftest import word_level_tokenizer  # noqa: E402
+
+WORDS = (
+    "an toàn thông tin mạng hệ thống cơ quan tổ chức cá nhân trách nhiệm bảo vệ dữ liệu "
+    "sự cố ứng cứu giám sát phát hiện tấn công mã độc phần mềm máy chủ quy định điều khoản"
+).split()
+# Ngưỡng như benchmarks/bench_embedding_backends.py (--min-cosine / --min-cosine-int8)
+MIN_COSINE = {"": 0.9999, "int8": 0.98}
+
+
+@pytest.fixture(scope="module")
+def tiny_model_path(tmp_path_factory):
+    """Model SentenceTransformer kiểu e5 thu nhỏ (2 lớp, trọng số ngẫu nhiên): mean pooling + Normalize."""
+    import torch
+    from sentence_transformers import SentenceTransformer, models
+    from transformers import BertConfig, BertModel
+
+    torch.manual_seed(0)
+    root = tmp_path_factory.mktemp("tiny_e5")
+    tokenizer = word_level_tokenizer(WORDS)
+    config = BertConfig(vocab_size=len(tokenizer), hidden_size=64, num_hidden_layers=2, num_attention_heads=4,
+                        intermediate_size=128, max_position_embeddings=128, pad_token_id=tokenizer.pad_token_id)
+    BertModel(config).save_pretrained(root / "hf")
+    tokenizer.save_pretrained(root / "hf")
+    transformer = models.Transformer(str(root / "hf"), max_seq_length=96)
+    pooling = models.Pooling(transformer.get_word_embedding_dimension(), "mean")
+    SentenceTransformer(modules=[transformer, pooling, models.Normalize()]).save(str(root / "model"))
+    return str(root / "model")
+
+
+def _texts(count=40, seed=0):
+    # Độ dài lệch (có cả văn bản bị cắt ở max_seq_length) để kiểm tra padding/attention mask
+    rng = random.Random(seed)
+    return [" ".join(rng.choice(WORDS) for _ in range(rng.choice([2, 5, 20, 60, 150]))) for _ in range(count)]
+
+
+@pytest.mark.parametrize("quantize", ["", "int8"])
+def test_onnx_matches_torch(tiny_model_path, tmp_path, monkeypatch, quantize):
+    monkeypatch.setattr(embedding_backend, "EMBEDDING_ONNX_DIR", str(tmp_path / "onnx"))
+    torch_backend = embedding_backend.load_embedding_backend(tiny_model_path, "torch", device="cpu")
+    onnx_backend = embedding_backend.load_embedding_backend(tiny_model_path, "onnx", quantize=quantize)
+
+    assert (onnx_backend.pooling, onnx_backend.normalize) == ("mean", True)
+    assert onnx_backend.dimension == torch_backend.dimension
+    assert onnx_backend.max_seq_length == torch_backend.max_seq_length
+
+    texts = _texts()
+    expected = torch_backend.encode(texts, batch_size=8)
+    actual = onnx_backend.encode(texts, batch_size=8)
+    assert actual.shape == expected.shape
+    np.testing.assert_allclose(np.linalg.norm(actual, axis=1), 1.0, rtol=1e-5)
+    cosines = np.sum(actual * expected, axis=1)
+    assert cosines.min() >= MIN_COSINE[quantize]
+    # Một lô đơn (đường truy vấn) cho cùng kết quả với encode theo lô có sắp xếp lại
+    # (int8 động lượng tử hóa activation theo từng lô nên chỉ so được với float32)
+    if not quantize:
+        np.testing.assert_allclose(onnx_backend.embed_batch(texts[:1]), actual[:1], atol=1e-5)
+    assert onnx_backend.encode([]).shape == (0, onnx_backend.dimension)
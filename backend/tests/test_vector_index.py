@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from backend.core import vector_index
+
+TOP_K = 10
+
+
+@pytest.fixture
+def corpus_view(store):
+    """Kho ~2000 vector dạng cụm (giống embedding thật hơn nhiễu đều), chia thành nhiều tài liệu."""
+    rng = np.random.default_rng(42)
+    centers = rng.standard_normal((20, 32)).astype(np.float32)
+    for doc in range(10):
+        labels = rng.integers(0, len(centers), 200)
+        embeddings = centers[labels] + 0.3 * rng.standard_normal((200, 32)).astype(np.float32)
+        store.append(f"doc{doc}.pdf", [f"chunk {doc}-{i}" for i in range(200)], embeddings)
+    return store.view()
+
+
+def _queries(view, count=50, seed=7):
+    rng = np.random.default_rng(seed)
+    ids = rng.choice(view.num_chunks, count, replace=False)
+    base = view.embeddings_by_ids(ids)
+    return base + 0.2 * rng.standard_normal(base.shape).astype(np.float32)
+
+
+def _recall(found, truth):
+    return np.mean([len(set(f) & set(t)) / len(t) for f, t in zip(found, truth)])
+
+
+@pytest.mark.parametrize("storage", ["float16", "int8"])
+def test_quantized_storage_recall_with_rescoring(corpus_view, storage):
+    queries = _queries(corpus_view)
+    exact = vector_index.build_from_view(corpus_view, mode="flat", storage="float32")
+    truth_distances, truth = exact.search(queries, TOP_K)
+
+    index = vector_index.build_from_view(corpus_view, mode="flat", storage=storage)
+    assert vector_index.index_storage(index) == storage
+    distances, found = vector_index.search(index, corpus_view, queries, TOP_K, rescore_factor=4)
+
+    assert _recall(found, truth) >= 0.99
+    # Khoảng cách sau khi chấm lại là khoảng cách float32 chính xác
+    matched = found[:, 0] == truth[:, 0]
+    np.testing.assert_allclose(distances[matched, 0], truth_distances[matched, 0], rtol=1e-4, atol=1e-4)
+
+
+def test_rescoring_skips_removed_documents(corpus_view, store):
+    index = vector_index.build_from_view(corpus_view, mode="flat", storage="int8")
+    first_id, count = corpus_view.doc_id_range("doc3.pdf")
+    store.remove("doc3.pdf")
+    view = store.view()
+    index = vector_index.remove_document(index, first_id, count, view)
+
+    queries = view.embeddings_by_ids(np.arange(first_id - 5, first_id))
+    queries = np.vstack([queries, corpus_view.embeddings_by_ids(np.arange(first_id, first_id + 5))])
+    _, found = vector_index.search(index, view, queries, TOP_K, rescore_factor=4)
+    found = found[found >= 0]
+    assert len(found) and not np.any((found >= first_id) & (found < first_id + count))
+
+
+def test_search_documents_limits_scope(corpus_view):
+    query = corpus_view.embeddings_by_ids([5])[0]
+    distances, ids = vector_index.search_documents(corpus_view, query, ["doc1.pdf", "doc2.pdf"], TOP_K)
+    first, count = corpus_view.doc_id_range("doc1.pdf")
+    second, _ = corpus_view.doc_id_range("doc2.pdf")
+    assert len(ids) == TOP_K
+    assert all(first <= i < second + count for i in ids)
+    assert list(distances) == sorted(distances)
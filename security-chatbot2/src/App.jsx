@@ -4,6 +4,7 @@ import ChatWindow from './components/ChatWindow';
 import InputBox from './components/InputBox';
 import Sidebar from './components/Sidebar';
 import DocumentManagerModal from './components/DocumentManagerModal';
+import { waitForJob } from './jobs';
 
 function App() {
   // Loại bỏ đăng nhập/phân quyền
@@ -67,7 +68,12 @@ function App() {
 
     // Lấy session cho cuộc hội thoại (anonymous vẫn dùng session local, nhưng không lưu server)
     const sessionKey = `session:${currentConversationId}`;
-    const sessionId = localStorage.getItem(sessionKey);
+    let sessionId = localStorage.getItem(sessionKey);
+    if (!sessionId && window.crypto?.randomUUID) {
+      // Giữ cùng session_id cho cả cuộc hội thoại để server nối tiếp ngữ cảnh các lượt trước
+      sessionId = window.crypto.randomUUID();
+      localStorage.setItem(sessionKey, sessionId);
+    }
 
     try {
       // Dùng SSE stream
@@ -81,6 +87,15 @@ function App() {
         signal: controller.signal
       });
 
+      if (res.status === 503 || res.status === 429) {
+        // 503: server vẫn đang nạp model (xem /readyz) hoặc hàng đợi sinh đã đầy; 429: gửi quá nhiều câu hỏi cùng lúc
+        const retryAfter = res.headers.get('Retry-After');
+        const detail = await res.json().then(body => body.detail || '').catch(() => '');
+        const reason = res.status === 429
+          ? 'Bạn đang có quá nhiều câu hỏi chờ xử lý'
+          : detail.startsWith('Models are loading') ? 'Hệ thống đang khởi động' : 'Hệ thống đang quá tải';
+        throw new Error(`${reason}, vui lòng thử lại sau${retryAfter ? ` ${retryAfter} giây` : ''}.`);
+      }
       if (!res.ok || !res.body) throw new Error('Network response was not ok');
 
       const reader = res.body.getReader();
@@ -150,7 +165,8 @@ function App() {
       if (err?.name !== 'AbortError') {
         setConversations(prev => prev.map(conv => {
           if (conv.id === currentConversationId) {
-            return { ...conv, messages: [...conv.messages, { sender: 'bot', text: 'Có lỗi khi gọi API.' }] };
+            const text = err?.message?.startsWith('Hệ thống đang khởi động') ? err.message : 'Có lỗi khi gọi API.';
+            return { ...conv, messages: [...conv.messages, { sender: 'bot', text }] };
           }
           return conv;
         }));
@@ -172,7 +188,7 @@ function App() {
     setUploading(true);
     setUploadProgress(0);
     try {
-      await new Promise((resolve, reject) => {
+      const data = await new Promise((resolve, reject) => {
         const xhr = new XMLHttpRequest();
         xhr.open('POST', '/api/upload-pdf');
         xhr.upload.onprogress = (e) => {
@@ -189,7 +205,7 @@ function App() {
               } else if (data && data.message === 'PDF already embedded' && data.doc_id) {
                 setActiveDoc({ id: data.doc_id, pdf_name: data.pdf_name });
               }
-              resolve();
+              resolve(data);
             } catch (err) {
               reject(err);
             }
@@ -202,6 +218,15 @@ function App() {
         form.append('file', file);
         xhr.send(form);
       });
+      // OCR/embed chạy nền: theo dõi job, thanh tiến độ chuyển sang tiến độ xử lý
+      if (data && data.job_id) {
+        setUploadProgress(0);
+        const job = await waitForJob(data.job_id, (j) => setUploadProgress((j.progress || 0) * 100));
+        if (!job || job.status !== 'done') {
+          setActiveDoc(null);
+          throw new Error((job && job.error) || 'Embedding failed');
+        }
+      }
       setDocsRefreshKey((k) => k + 1);
     } catch (e) {
       console.error(e);
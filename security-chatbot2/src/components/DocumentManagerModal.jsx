@@ -1,4 +1,5 @@
 import { useEffect, useRef, useState } from 'react';
+import { waitForJob } from '../jobs';
 
 const DocumentManagerModal = ({ onClose, onSelect, activeDoc, refreshKey = 0 }) => {
   const [items, setItems] = useState([]);
@@ -38,21 +39,17 @@ const DocumentManagerModal = ({ onClose, onSelect, activeDoc, refreshKey = 0 })
 
   const handleEmbed = async (it) => {
     const key = `${it.pdf_name}|${it.category || ''}`;
-    // Bật trạng thái embedding và khởi động tiến độ giả lập
+    const setProgress = (progress) => setItems(prev => prev.map(p => (
+      p.pdf_name === it.pdf_name && p.category === it.category
+        ? { ...p, progress: Math.max(5, Math.round(progress)) }
+        : p
+    )));
+    // Bật trạng thái embedding; tiến độ thật lấy từ job nền
     setItems(prev => prev.map(p => (
       p.pdf_name === it.pdf_name && p.category === it.category
         ? { ...p, embedding: true, progress: 5 }
         : p
     )));
-    timersRef.current[key] = setInterval(() => {
-      setItems(prev => prev.map(p => {
-        if (p.pdf_name === it.pdf_name && p.category === it.category) {
-          const next = Math.min(90, (p.progress || 0) + 5);
-          return { ...p, progress: next };
-        }
-        return p;
-      }));
-    }, 300);
 
     try {
       let url = `/api/documents/${encodeURIComponent(it.pdf_name)}/embed`;
@@ -60,7 +57,13 @@ const DocumentManagerModal = ({ onClose, onSelect, activeDoc, refreshKey = 0 })
         url += `?category=${encodeURIComponent(it.category)}`;
       }
       const res = await fetch(url, { method: 'POST' });
-      if (res.ok) {
+      let ok = res.ok;
+      const data = ok ? await res.json() : null;
+      if (ok && data && data.job_id) {
+        const job = await waitForJob(data.job_id, (j) => setProgress((j.progress || 0) * 100));
+        ok = !!job && job.status === 'done';
+      }
+      if (ok) {
         // Hoàn tất: đặt 100% và chuyển sang Đã nhúng
         setItems(prev => prev.map(p => (
           p.pdf_name === it.pdf_name && p.category === it.category
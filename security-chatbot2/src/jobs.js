@@ -0,0 +1,11 @@
+// Theo dõi job ingest nền (OCR/embed) cho tới khi xong hoặc lỗi
+export const waitForJob = async (jobId, onProgress, intervalMs = 1000) => {
+  for (;;) {
+    const res = await fetch(`/api/jobs/${encodeURIComponent(jobId)}`);
+    if (!res.ok) return null;
+    const job = await res.json();
+    if (onProgress) onProgress(job);
+    if (job.status === 'done' || job.status === 'failed') return job;
+    await new Promise((resolve) => setTimeout(resolve, intervalMs));
+  }
+};